@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""ESF APR data consistency checks.
+
+Python module for evaluating the consistency rules declared in the
+'rules' section of an aprMap configuration file. Each rule is an
+expression over the mapped fields of one worksheet that must hold for
+every data row, such as a remaining amount equaling the allocated
+amount minus the expended amount. The fields each worksheet's rules
+need are read in a single pass, and every rule is evaluated over the
+whole columns at once, so the checks can run before any APR is
+rendered.
+
+@author: Keith.Tucker
+"""
+import csv
+import json
+import logging
+import pathlib
+from typing import List
+
+import numpy as np
+from openpyxl.workbook.workbook import Workbook
+
+from esf_columns import read_columns, worksheet_maps
+from esf_expressions import Expression
+
+VIOLATION_COLUMNS = ['rule', 'worksheet_name', 'key', 'row', 'message', 'values']
+
+
+def _value(value):
+    """Convert a NumPy scalar to the equivalent Python value for reporting."""
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def check_rules(wb: Workbook, config: dict) -> List[dict]:
+    """Evaluate the configuration's consistency rules, returning a list of violations.
+    Each violation names the rule, worksheet, grantee key and worksheet row number,
+    along with the values of the fields the rule uses."""
+    violations = []
+    maps = worksheet_maps(config)
+    # Group the rules by worksheet, so each worksheet is read only once.
+    rules_by_worksheet = {}
+    for rule in config.get('rules', ()):
+        worksheet_name = rule.get('worksheet_name', config['primary_grantee_worksheet_name'])
+        if worksheet_name not in maps:
+            logging.error(f"Rule {rule['name']} names worksheet {worksheet_name}, which is not in the configuration.")
+            continue
+        try:
+            expression = Expression(rule['expression'])
+        except ValueError as e:
+            logging.error(f"Rule {rule['name']} has an invalid expression.", exc_info=e)
+            continue
+        rules_by_worksheet.setdefault(worksheet_name, []).append((rule, expression))
+
+    for worksheet_name, rules in rules_by_worksheet.items():
+        field_map, key_index = maps[worksheet_name]
+        fields_by_name = {}
+        for field in field_map:
+            fields_by_name.setdefault(field['name'], field)
+        needed = set()
+        for rule, expression in rules:
+            missing = expression.names - fields_by_name.keys()
+            if missing:
+                logging.error(f"Rule {rule['name']} uses fields {sorted(missing)} not mapped in worksheet {worksheet_name}.")
+            needed |= expression.names & fields_by_name.keys()
+        keys, columns = read_columns(wb[worksheet_name], [fields_by_name[name] for name in sorted(needed)], key_index)
+        present = np.array([key is not None for key in keys], dtype=bool)
+
+        for rule, expression in rules:
+            if not expression.names <= columns.keys():
+                continue
+            try:
+                result = np.broadcast_to(expression.evaluate(columns, tolerance=rule.get('tolerance', 0.0)), keys.shape)
+            except Exception as e:
+                logging.error(f"Exception encountered evaluating rule {rule['name']}.", exc_info=e)
+                continue
+            for position in np.flatnonzero(present & ~result.astype(bool)):
+                violations.append({
+                    'rule': rule['name'],
+                    'worksheet_name': worksheet_name,
+                    'key': keys[position],
+                    # Worksheet rows start at 1 and the first row holds the column headings.
+                    'row': int(position) + 2,
+                    'message': rule.get('message', rule['expression']),
+                    'values': {name: _value(columns[name][position]) for name in sorted(expression.names)},
+                })
+    return violations
+
+
+def write_violations(violations: List[dict], filename: pathlib.Path) -> None:
+    """Write the violations as JSON if the file name ends in .json, and as CSV otherwise."""
+    filename = pathlib.Path(filename)
+    try:
+        with filename.open(mode='wt', encoding='utf-8', newline='') as vfp:
+            if filename.suffix.lower() == '.json':
+                json.dump(violations, vfp, indent=2, default=str)
+            else:
+                writer = csv.DictWriter(vfp, fieldnames=VIOLATION_COLUMNS)
+                writer.writeheader()
+                for violation in violations:
+                    writer.writerow(dict(violation, values=json.dumps(violation['values'], default=str)))
+    except Exception as e:
+        logging.error(f'Exception encountered storing check results {filename}.', exc_info=e)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""ESF APR columnar export.
+
+Python module for writing the data extracted for each APR into
+columnar files, so the values can be analyzed without reparsing the
+Excel workbook. One table holds the 'main' record for each grantee,
+and one table holds the records of each entry in the 'subs' list,
+keyed by the primary grantee key. Rows are buffered and written in
+batches as the APRs are built.
+
+Parquet output requires the optional pyarrow package.
+
+@author: Keith.Tucker
+"""
+import csv
+import datetime
+import json
+import logging
+import pathlib
+from typing import Any, Dict, Iterable, Iterator, List
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from esf_workbook_actions import ESF_APR
+
+EXPORT_FORMATS = ('csv', 'jsonl', 'parquet')
+
+_COMMON_FIELDS = [
+    {'name': 'omb_control_number', 'type': 'str'},
+    {'name': 'expiration_date', 'type': 'str'},
+    {'name': 'cui_official', 'type': 'str'},
+    {'name': 'reporting_year', 'type': 'str'},
+]
+
+
+def _unique_fields(fields: Iterable[dict]) -> List[dict]:
+    """Return the named fields in order, keeping only the first entry for each name."""
+    unique = {}
+    for field in fields:
+        name = field.get('name', None)
+        if name is not None and name not in unique:
+            unique[name] = {'name': name, 'type': field.get('type', 'str')}
+    return list(unique.values())
+
+
+def _text(value: Any) -> str:
+    if value is None:
+        return None
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+class _TableWriter:
+    """Write batches of row dictionaries with a fixed list of columns to a single file."""
+
+    def __init__(self, filename: pathlib.Path, fields: List[dict], export_format: str):
+        self.filename = filename
+        self.fields = fields
+        self.columns = [field['name'] for field in fields]
+        self.export_format = export_format
+        self.rows = 0
+        self._fp = None
+        self._writer = None
+        if export_format == 'parquet':
+            types = {'bool': pyarrow.bool_(), 'int': pyarrow.int64(), 'float': pyarrow.float64()}
+            self._schema = pyarrow.schema([(field['name'], types.get(field['type'], pyarrow.string()))
+                                           for field in fields])
+            self._writer = pyarrow.parquet.ParquetWriter(str(filename), self._schema)
+        else:
+            self._fp = filename.open(mode='wt', encoding='utf-8', newline='')
+            if export_format == 'csv':
+                self._writer = csv.writer(self._fp)
+                self._writer.writerow(self.columns)
+
+    def write_batch(self, batch: List[dict]) -> None:
+        if not batch:
+            return
+        if self.export_format == 'parquet':
+            columns = {}
+            for field in self.fields:
+                name = field['name']
+                values = [row.get(name) for row in batch]
+                if field['type'] not in ('bool', 'int', 'float'):
+                    values = [_text(value) for value in values]
+                columns[name] = values
+            self._writer.write_table(pyarrow.Table.from_pydict(columns, schema=self._schema))
+        elif self.export_format == 'csv':
+            self._writer.writerows([[_text(row.get(name)) for name in self.columns] for row in batch])
+        else:
+            for row in batch:
+                self._fp.write(json.dumps({name: row.get(name) for name in self.columns}, default=_text))
+                self._fp.write('\n')
+        self.rows += len(batch)
+
+    def close(self) -> None:
+        if self.export_format == 'parquet':
+            self._writer.close()
+        else:
+            self._fp.close()
+
+
+class ColumnarExporter:
+    """Stream the records extracted for each APR into columnar files.
+
+    The 'main' table has a column for each common APR attribute and each
+    field in the configuration's 'main' map. Each 'subs' entry has its own
+    table, with the primary grantee key in the first column followed by the
+    fields of all its child worksheets.
+
+    When the APRs are generated in shards, the shard, given as (i, N), is
+    added to the file names, so the shards can export to the same folder.
+    """
+
+    def __init__(self, config: dict, directory: pathlib.Path, export_format: str = 'csv', batch_size: int = 500,
+                 shard: tuple = None):
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f'Unsupported export format {export_format}.')
+        if export_format == 'parquet' and pyarrow is None:
+            raise ValueError('Parquet export requires the pyarrow package.')
+        self._key_name = config['primary_grantee_key_name']
+        self._batch_size = max(batch_size, 1)
+        self._sub_names = []
+        self._tables: Dict[str, _TableWriter] = {}
+        self._batches: Dict[str, List[dict]] = {}
+
+        directory = pathlib.Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        base_name = f"{config['subfund']}-{config['reporting_year']}"
+        shard_suffix = f'-shard-{shard[0]}-of-{shard[1]}' if shard is not None else ''
+        tables = {'main': _unique_fields(_COMMON_FIELDS + config['main'])}
+        for sub in config.get('subs', ()):
+            sub_name = sub.get('name', None)
+            if sub_name is None:
+                continue
+            self._sub_names.append(sub_name)
+            key_type = 'str'
+            for field in config['main']:
+                if field.get('name') == self._key_name:
+                    key_type = field.get('type', 'str')
+            fields = [{'name': self._key_name, 'type': key_type}]
+            for child in sub.get('children', ()):
+                fields.extend(child.get('field_map', ()))
+            tables[sub_name] = _unique_fields(fields)
+        for table_name, fields in tables.items():
+            filename = directory / f'{base_name}-{table_name}{shard_suffix}.{export_format}'
+            self._tables[table_name] = _TableWriter(filename, fields, export_format)
+            self._batches[table_name] = []
+
+    def _append(self, table_name: str, row: dict) -> None:
+        batch = self._batches[table_name]
+        batch.append(row)
+        if len(batch) >= self._batch_size:
+            self._tables[table_name].write_batch(batch)
+            self._batches[table_name] = []
+
+    def add(self, apr: ESF_APR) -> None:
+        """Buffer the main record and all the subordinate records of an APR for writing."""
+        self._append('main', vars(apr))
+        key = getattr(apr, self._key_name, None)
+        for sub_name in self._sub_names:
+            for record in getattr(apr, sub_name, None) or ():
+                row = dict(vars(record))
+                row[self._key_name] = key
+                self._append(sub_name, row)
+
+    def tee(self, aprs: Iterable[ESF_APR]) -> Iterator[ESF_APR]:
+        """Yield each APR from the passed iterable after adding it to the export."""
+        for apr in aprs:
+            if apr is not None:
+                self.add(apr)
+            yield apr
+
+    def close(self) -> Dict[str, int]:
+        """Write any buffered rows, close the files, and return the number of rows in each table."""
+        counts = {}
+        for table_name, table in self._tables.items():
+            try:
+                table.write_batch(self._batches[table_name])
+                self._batches[table_name] = []
+                table.close()
+            except Exception as e:
+                logging.error(f'Exception encountered closing export file {table.filename}.', exc_info=e)
+            counts[table_name] = table.rows
+        return counts
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""ESF APR computed fields.
+
+Python module for evaluating the computed fields declared in the
+'computed' section of an aprMap configuration file. Each computed field
+is an expression over the mapped fields of one worksheet, such as a
+remaining amount equal to the allocated amount minus the expended
+amount, or a total across the ESSER I, II and III awards. The fields a
+worksheet's computed fields use are read in a single pass, and each
+expression is evaluated over the whole columns at once, before any APR
+is built. The values are then added to the APR objects and subordinate
+records built from each worksheet row, as ordinary attributes.
+
+Computed fields may use the computed fields declared before them for
+the same worksheet.
+
+@author: Keith.Tucker
+"""
+import logging
+from typing import Dict, List
+
+import numpy as np
+from openpyxl.workbook.workbook import Workbook
+
+from esf_columns import read_columns, worksheet_maps
+from esf_expressions import Expression
+
+COMPUTED_TYPES = {'float': np.float64, 'int': np.int64, 'bool': np.bool_}
+
+
+def _coerce(result: np.ndarray, field_type: str) -> list:
+    """Convert an evaluated column to a list of Python values of the field type.
+    As when coercing worksheet values, numbers that can not be represented,
+    such as the result of dividing by zero, become 0."""
+    if field_type != 'bool':
+        result = np.where(np.isfinite(result.astype(np.float64)), result, 0)
+    return result.astype(COMPUTED_TYPES[field_type]).tolist()
+
+
+def computed_fields(config: dict) -> Dict[str, List[dict]]:
+    """Return the computed field definitions of a configuration, by worksheet name.
+    Computed fields without a worksheet_name apply to the primary grantee worksheet."""
+    by_worksheet = {}
+    for computed in config.get('computed', ()):
+        worksheet_name = computed.get('worksheet_name', config['primary_grantee_worksheet_name'])
+        by_worksheet.setdefault(worksheet_name, []).append(computed)
+    return by_worksheet
+
+
+def compute_fields(wb: Workbook, config: dict) -> Dict[str, Dict[str, list]]:
+    """Evaluate the configuration's computed fields over every data row of their worksheets.
+
+    Returns a dictionary, by worksheet name, of dictionaries holding a list of
+    values for each computed field name, with one element per worksheet row
+    after the header row."""
+    maps = worksheet_maps(config)
+    values = {}
+    for worksheet_name, definitions in computed_fields(config).items():
+        if worksheet_name not in maps:
+            logging.error(f'Computed fields name worksheet {worksheet_name}, which is not in the configuration.')
+            continue
+        field_map, key_index = maps[worksheet_name]
+        fields_by_name = {}
+        for field in field_map:
+            fields_by_name.setdefault(field['name'], field)
+        expressions = []
+        needed = set()
+        computed_names = set()
+        for computed in definitions:
+            try:
+                expression = Expression(computed['expression'])
+            except ValueError as e:
+                logging.error(f"Computed field {computed['name']} has an invalid expression.", exc_info=e)
+                continue
+            missing = expression.names - fields_by_name.keys() - computed_names
+            if missing:
+                logging.error(f"Computed field {computed['name']} uses fields {sorted(missing)} not mapped in worksheet {worksheet_name}.")
+                continue
+            needed |= expression.names & fields_by_name.keys()
+            computed_names.add(computed['name'])
+            expressions.append((computed, expression))
+
+        keys, columns = read_columns(wb[worksheet_name], [fields_by_name[name] for name in sorted(needed)], key_index)
+        values[worksheet_name] = {}
+        for computed, expression in expressions:
+            try:
+                result = np.broadcast_to(expression.evaluate(columns), keys.shape)
+                coerced = _coerce(result, computed.get('type', 'float'))
+            except Exception as e:
+                logging.error(f"Exception encountered evaluating computed field {computed['name']}.", exc_info=e)
+                continue
+            # Later computed fields use the coerced values, as the template would.
+            columns[computed['name']] = np.array(coerced, dtype=COMPUTED_TYPES[computed.get('type', 'float')])
+            values[worksheet_name][computed['name']] = coerced
+    return values
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""ESF APR field expressions.
+
+Python module for parsing and evaluating the arithmetic and comparison
+expressions used in aprMap configuration files. Expressions refer to
+mapped fields by name and are restricted to a small, safe subset of
+Python syntax: numbers, strings and booleans; the operators + - * /
+and unary minus; comparisons; and, or and not; and the functions abs,
+min and max. The operations are applied with NumPy, so the same
+expression evaluates over whole columns of values or over single
+values. Over single values, and and or stop at the first operand that
+decides the result, as in Python and Jinja.
+
+Usage examples:
+>>> bool(Expression('remaining == allocated - expended').evaluate({'remaining': 5.0, 'allocated': 7.0, 'expended': 2.0}))
+True
+>>> bool(Expression('isLea and amount > 0').evaluate({'isLea': False, 'amount': None}))
+False
+>>> sorted(Expression('planned <= remaining').names)
+['planned', 'remaining']
+
+@author: Keith.Tucker
+"""
+import ast
+from typing import Any, Dict
+
+import numpy as np
+
+_BINARY_OPERATORS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.divide,
+}
+
+_COMPARISONS = {
+    ast.Eq: np.equal,
+    ast.NotEq: np.not_equal,
+    ast.Lt: np.less,
+    ast.LtE: np.less_equal,
+    ast.Gt: np.greater,
+    ast.GtE: np.greater_equal,
+}
+
+_FUNCTIONS = {
+    'abs': (1, np.abs),
+    'min': (2, np.minimum),
+    'max': (2, np.maximum),
+}
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float, np.number, np.ndarray)) and not (
+        isinstance(value, np.ndarray) and value.dtype == object)
+
+
+class Expression:
+    """A parsed field expression.
+
+    The names attribute holds the set of field names the expression uses.
+    Parsing raises ValueError for any syntax outside the supported subset.
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        try:
+            self._tree = ast.parse(source, mode='eval')
+        except SyntaxError as e:
+            raise ValueError(f'Invalid expression {source!r}: {e.msg}') from e
+        self.names = set()
+        self._validate(self._tree.body)
+
+    def _validate(self, node: ast.AST) -> None:
+        match node:
+            case ast.Name():
+                self.names.add(node.id)
+            case ast.Constant() if isinstance(node.value, (int, float, str, bool)):
+                pass
+            case ast.BinOp() if type(node.op) in _BINARY_OPERATORS:
+                self._validate(node.left)
+                self._validate(node.right)
+            case ast.UnaryOp() if isinstance(node.op, (ast.USub, ast.UAdd, ast.Not)):
+                self._validate(node.operand)
+            case ast.BoolOp():
+                for value in node.values:
+                    self._validate(value)
+            case ast.Compare() if all(type(op) in _COMPARISONS for op in node.ops):
+                self._validate(node.left)
+                for comparator in node.comparators:
+                    self._validate(comparator)
+            case ast.Call() if (isinstance(node.func, ast.Name) and node.func.id in _FUNCTIONS
+                                and not node.keywords
+                                and len(node.args) == _FUNCTIONS[node.func.id][0]):
+                for arg in node.args:
+                    self._validate(arg)
+            case _:
+                raise ValueError(f'Unsupported syntax {ast.dump(node)} in expression {self.source!r}')
+
+    def evaluate(self, namespace: Dict[str, Any], tolerance: float = 0.0) -> Any:
+        """Evaluate the expression with field values (scalars or arrays) from namespace.
+        When tolerance is greater than zero, numeric ==, !=, <= and >= comparisons
+        treat values within the tolerance of each other as equal."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self._evaluate(self._tree.body, namespace, tolerance)
+
+    def _evaluate(self, node: ast.AST, namespace: Dict[str, Any], tolerance: float) -> Any:
+        match node:
+            case ast.Name():
+                try:
+                    return namespace[node.id]
+                except KeyError:
+                    raise ValueError(f'Unknown field {node.id} in expression {self.source!r}') from None
+            case ast.Constant():
+                return node.value
+            case ast.BinOp():
+                return _BINARY_OPERATORS[type(node.op)](self._evaluate(node.left, namespace, tolerance),
+                                                        self._evaluate(node.right, namespace, tolerance))
+            case ast.UnaryOp():
+                operand = self._evaluate(node.operand, namespace, tolerance)
+                if isinstance(node.op, ast.Not):
+                    return np.logical_not(operand)
+                if isinstance(node.op, ast.USub):
+                    return np.negative(operand)
+                return operand
+            case ast.BoolOp():
+                combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+                result = self._evaluate(node.values[0], namespace, tolerance)
+                for value in node.values[1:]:
+                    # A single value that decides the result skips the remaining operands.
+                    if np.ndim(result) == 0 and bool(result) == isinstance(node.op, ast.Or):
+                        return np.bool_(bool(result))
+                    result = combine(result, self._evaluate(value, namespace, tolerance))
+                return result
+            case ast.Compare():
+                left = self._evaluate(node.left, namespace, tolerance)
+                result = True
+                for op, comparator in zip(node.ops, node.comparators):
+                    right = self._evaluate(comparator, namespace, tolerance)
+                    result = np.logical_and(result, self._compare(op, left, right, tolerance))
+                    left = right
+                return result
+            case ast.Call():
+                function = _FUNCTIONS[node.func.id][1]
+                return function(*(self._evaluate(arg, namespace, tolerance) for arg in node.args))
+
+    @staticmethod
+    def _compare(op: ast.cmpop, left: Any, right: Any, tolerance: float) -> Any:
+        if tolerance > 0 and _is_number(left) and _is_number(right):
+            difference = np.abs(np.subtract(left, right))
+            match op:
+                case ast.Eq():
+                    return difference <= tolerance
+                case ast.NotEq():
+                    return difference > tolerance
+                case ast.LtE():
+                    return np.less_equal(left, np.add(right, tolerance))
+                case ast.GtE():
+                    return np.greater_equal(np.add(left, tolerance), right)
+        return _COMPARISONS[type(op)](left, right)
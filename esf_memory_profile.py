@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""ESF APR memory profiling.
+
+Python module for measuring memory use at the stage boundaries of an
+APR generation run. Python allocations are traced with tracemalloc,
+the peak resident set size (RSS) of the process is read from the
+operating system before and after each stage, so the growth of the
+peak is charged to the stage that caused it, and the approximate size
+of each APR object and subordinate record is tallied.
+
+@author: Keith.Tucker
+"""
+from contextlib import contextmanager, nullcontext
+import json
+import logging
+import pathlib
+import sys
+import tracemalloc
+from typing import Dict
+
+try:
+    import resource
+except ImportError:
+    # The resource module is not available on Windows.
+    resource = None
+
+
+def peak_rss() -> int:
+    """Return the peak resident set size of the process in bytes, or None if it cannot be determined."""
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, while macOS reports bytes.
+        if sys.platform == 'darwin':
+            return maxrss
+        return maxrss * 1024
+    try:
+        import psutil
+        memory_info = psutil.Process().memory_info()
+        return getattr(memory_info, 'peak_wset', memory_info.rss)
+    except Exception:
+        return None
+
+
+def _object_size(obj, seen: set) -> int:
+    """Approximate the memory used by a data object, its attribute dictionary and attribute values.
+    Objects already counted (tracked in seen) are not counted again."""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    attrs = getattr(obj, '__dict__', None)
+    if attrs is not None:
+        size += sys.getsizeof(attrs)
+        # Lists are counted as containers only; the records in them are tallied separately.
+        for value in attrs.values():
+            if id(value) not in seen:
+                seen.add(id(value))
+                size += sys.getsizeof(value)
+    return size
+
+
+class MemoryProfiler:
+    """Record allocation growth, traced peaks and peak RSS growth for each named stage.
+
+    Stages that run repeatedly (such as building each APR) accumulate into a
+    single entry, and the allocation sites responsible for the growth are
+    totalled across all the calls of a stage. The process never lowers its
+    peak RSS, so each stage records how much the peak rose while it ran,
+    and the stages with the largest growth are the ones that drove the
+    process to its peak.
+    """
+
+    def __init__(self, top: int = 10, frames: int = 1):
+        self.top = top
+        self.frames = frames
+        self.stages: Dict[str, dict] = {}
+        self.objects: Dict[str, dict] = {}
+
+    def start(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+    def stop(self) -> None:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name: str):
+        """Snapshot traced allocations before and after the enclosed block."""
+        self.start()
+        before = tracemalloc.take_snapshot()
+        rss_before = peak_rss()
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            peak = tracemalloc.get_traced_memory()[1]
+            rss_after = peak_rss()
+            after = tracemalloc.take_snapshot()
+            rss_growth = rss_after - rss_before if rss_before is not None and rss_after is not None else None
+            self._add_stage(name, after.compare_to(before, 'lineno'), peak, rss_growth)
+
+    def _add_stage(self, name: str, differences: list, peak: int, rss_growth: int = None) -> None:
+        entry = self.stages.setdefault(name, {'calls': 0, 'net_bytes': 0,
+            'peak_traced_bytes': 0, 'peak_rss_growth_bytes': None, 'sites': {}})
+        entry['calls'] += 1
+        entry['net_bytes'] += sum(diff.size_diff for diff in differences)
+        entry['peak_traced_bytes'] = max(entry['peak_traced_bytes'], peak)
+        if rss_growth is not None:
+            entry['peak_rss_growth_bytes'] = (entry['peak_rss_growth_bytes'] or 0) + rss_growth
+        sites = entry['sites']
+        for diff in differences:
+            if diff.size_diff == 0:
+                continue
+            site = str(diff.traceback)
+            sites[site] = sites.get(site, 0) + diff.size_diff
+
+    def record_object(self, kind: str, obj) -> int:
+        """Tally the approximate size of a data object under the passed kind, returning the size."""
+        size = _object_size(obj, set())
+        entry = self.objects.setdefault(kind, {'count': 0, 'total_bytes': 0, 'max_bytes': 0})
+        entry['count'] += 1
+        entry['total_bytes'] += size
+        entry['max_bytes'] = max(entry['max_bytes'], size)
+        return size
+
+    def report(self) -> dict:
+        stages = []
+        for name, entry in self.stages.items():
+            sites = sorted(entry['sites'].items(), key=lambda item: item[1], reverse=True)
+            stages.append({'stage': name,
+                           'calls': entry['calls'],
+                           'net_bytes': entry['net_bytes'],
+                           'peak_traced_bytes': entry['peak_traced_bytes'],
+                           'peak_rss_growth_bytes': entry['peak_rss_growth_bytes'],
+                           'top_sites': [{'site': site, 'size_diff': size}
+                                         for site, size in sites[:self.top]]})
+        objects = []
+        for kind, entry in self.objects.items():
+            objects.append(dict(kind=kind,
+                mean_bytes=entry['total_bytes'] / entry['count'] if entry['count'] else 0,
+                **entry))
+        return {'peak_rss_bytes': peak_rss(), 'stages': stages, 'objects': objects}
+
+    def write_json(self, filename: pathlib.Path) -> None:
+        try:
+            with pathlib.Path(filename).open(mode='wt', encoding='utf-8') as mfp:
+                json.dump(self.report(), mfp, indent=2)
+        except Exception as e:
+            logging.error(f'Exception encountered storing memory report {filename}.', exc_info=e)
+
+
+def stage(profiler: MemoryProfiler, name: str):
+    """Return the profiler's context for the named stage, or a no-op context when not profiling."""
+    if profiler is None:
+        return nullcontext()
+    return profiler.stage(name)
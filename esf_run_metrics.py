@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""ESF APR run metrics.
+
+Python module for timing the phases of an APR generation run and
+exporting the results as a JSON run report or as a Prometheus
+textfile collector file.
+
+@author: Keith.Tucker
+"""
+from contextlib import contextmanager
+import datetime
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+from typing import Dict, Tuple
+
+
+def _escape_label(value) -> str:
+    """Escape a label value for the Prometheus text exposition format."""
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels: dict) -> str:
+    """Format a dictionary of labels as a Prometheus label set."""
+    if not labels:
+        return ''
+    pairs = ','.join(f'{name}="{_escape_label(value)}"' for name, value in labels.items())
+    return '{' + pairs + '}'
+
+
+class RunMetrics:
+    """Collect phase timings and per-grantee figures for one run.
+
+    Phases are identified by a name and an optional worksheet, so
+    repeated phases (such as scanning the same worksheet for each
+    grantee) accumulate into a single total with a call count.
+    Per-grantee figures are keyed by the output file base name.
+    Phases may be recorded from several threads at once.
+    """
+
+    def __init__(self, labels: dict = None):
+        self.labels = dict(labels or {})
+        self.started = datetime.datetime.now(tz=datetime.timezone.utc)
+        self._start_counter = time.perf_counter()
+        self.elapsed = None
+        self.phases: Dict[Tuple[str, str], dict] = {}
+        self.grantees: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str, worksheet: str = None):
+        """Time the enclosed block and add it to the named phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start, worksheet=worksheet)
+
+    def add_phase(self, name: str, seconds: float, worksheet: str = None) -> None:
+        with self._lock:
+            entry = self.phases.setdefault((name, worksheet or ''), {'calls': 0, 'seconds': 0.0})
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+
+    def grantee(self, name: str) -> dict:
+        """Return the dictionary of figures recorded for the named grantee output."""
+        with self._lock:
+            return self.grantees.setdefault(name, {})
+
+    def finish(self) -> None:
+        """Record the elapsed time for the whole run."""
+        self.elapsed = time.perf_counter() - self._start_counter
+
+    def report(self) -> dict:
+        """Return the collected metrics as a dictionary suitable for JSON serialization."""
+        elapsed = self.elapsed
+        if elapsed is None:
+            elapsed = time.perf_counter() - self._start_counter
+        return {
+            'labels': self.labels,
+            'started': self.started.isoformat(),
+            'elapsed_seconds': elapsed,
+            'phases': [{'phase': name, 'worksheet': worksheet or None,
+                        'calls': entry['calls'], 'seconds': entry['seconds']}
+                       for (name, worksheet), entry in self.phases.items()],
+            'grantees': [dict(output_file_base_name=name, **values)
+                         for name, values in self.grantees.items()],
+        }
+
+    def write_json(self, filename: pathlib.Path) -> None:
+        try:
+            with pathlib.Path(filename).open(mode='wt', encoding='utf-8') as rfp:
+                json.dump(self.report(), rfp, indent=2, default=str)
+        except Exception as e:
+            logging.error(f'Exception encountered storing run report {filename}.', exc_info=e)
+
+    def prometheus_lines(self) -> list:
+        """Return the collected metrics as lines in the Prometheus text exposition format."""
+        report = self.report()
+        lines = ['# HELP esf_apr_run_seconds Elapsed time for the APR generation run.',
+                 '# TYPE esf_apr_run_seconds gauge',
+                 f'esf_apr_run_seconds{_format_labels(self.labels)} {report["elapsed_seconds"]:.6f}',
+                 '# HELP esf_apr_run_timestamp_seconds Start time of the APR generation run.',
+                 '# TYPE esf_apr_run_timestamp_seconds gauge',
+                 f'esf_apr_run_timestamp_seconds{_format_labels(self.labels)} {self.started.timestamp():.3f}',
+                 '# HELP esf_apr_grantees_total Number of grantee APRs built in the run.',
+                 '# TYPE esf_apr_grantees_total gauge',
+                 f'esf_apr_grantees_total{_format_labels(self.labels)} {len(self.grantees)}']
+
+        lines.append('# HELP esf_apr_phase_seconds_total Time spent in each phase of the run.')
+        lines.append('# TYPE esf_apr_phase_seconds_total counter')
+        for phase in report['phases']:
+            labels = dict(self.labels, phase=phase['phase'])
+            if phase['worksheet']:
+                labels['worksheet'] = phase['worksheet']
+            lines.append(f'esf_apr_phase_seconds_total{_format_labels(labels)} {phase["seconds"]:.6f}')
+        lines.append('# HELP esf_apr_phase_calls_total Number of times each phase ran.')
+        lines.append('# TYPE esf_apr_phase_calls_total counter')
+        for phase in report['phases']:
+            labels = dict(self.labels, phase=phase['phase'])
+            if phase['worksheet']:
+                labels['worksheet'] = phase['worksheet']
+            lines.append(f'esf_apr_phase_calls_total{_format_labels(labels)} {phase["calls"]}')
+
+        # Collect the names of all per-grantee figures, so each one becomes a metric family.
+        figures = []
+        for values in self.grantees.values():
+            for figure in values:
+                if figure not in figures:
+                    figures.append(figure)
+        for figure in figures:
+            metric = f'esf_apr_grantee_{figure}'
+            lines.append(f'# HELP {metric} Per-grantee {figure.replace("_", " ")}.')
+            lines.append(f'# TYPE {metric} gauge')
+            for name, values in self.grantees.items():
+                value = values.get(figure)
+                if value is None:
+                    continue
+                labels = dict(self.labels, grantee=name)
+                lines.append(f'{metric}{_format_labels(labels)} {value}')
+        return lines
+
+    def write_prometheus(self, filename: pathlib.Path) -> None:
+        """Write the metrics for a Prometheus textfile collector.
+        The file is written under a temporary name and renamed into place,
+        so the collector never reads a partially written file."""
+        filename = pathlib.Path(filename)
+        temp_name = filename.with_name(f'.{filename.name}.{os.getpid()}.tmp')
+        try:
+            with temp_name.open(mode='wt', encoding='utf-8') as pfp:
+                for line in self.prometheus_lines():
+                    pfp.write(f'{line}\n')
+            os.replace(temp_name, filename)
+        except Exception as e:
+            logging.error(f'Exception encountered storing Prometheus metrics {filename}.', exc_info=e)
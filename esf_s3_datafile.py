@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""ESF APR datafiles in cloud storage.
+
+Python module for reading APR datafiles straight from S3. A datafile
+pattern of the form s3://bucket/key-pattern names the objects to choose
+from, where the key pattern may use the shell wildcards *, ? and [...].
+The newest matching object is found by listing only the keys that begin
+with the literal part of the pattern. Objects no larger than a memory
+limit are read into memory; larger ones are stored in a local cache
+under a name derived from the object's ETag, so a workbook that has not
+changed is only downloaded once. Cached copies are downloaded through
+verified, resumable part files.
+
+@author: Keith.Tucker
+"""
+import fnmatch
+import io
+import logging
+import pathlib
+import re
+from typing import Tuple, Union
+
+from s3download import download_object
+
+S3_SCHEME = 's3://'
+DEFAULT_CACHE_DIR = 'S3_Cache'
+DEFAULT_MEMORY_LIMIT = 64 * 1024 * 1024
+
+
+def is_s3_uri(datafile_pattern: str) -> bool:
+    return datafile_pattern.lower().startswith(S3_SCHEME)
+
+
+def parse_s3_uri(uri: str) -> Tuple[str, str]:
+    """Split an s3://bucket/key URI into the bucket name and key (or key pattern)."""
+    bucket, _, key = uri[len(S3_SCHEME):].partition('/')
+    if not bucket or not key:
+        raise ValueError(f'{uri} must have the form s3://bucket/key')
+    return bucket, key
+
+
+def glob_prefix(key_pattern: str) -> str:
+    """Return the literal text before the first wildcard in a key pattern."""
+    match = re.search(r'[*?\[]', key_pattern)
+    return key_pattern[:match.start()] if match else key_pattern
+
+
+def find_latest_s3_object(client, bucket: str, key_pattern: str) -> dict:
+    """Return the listing entry (Key, LastModified, ETag and Size) of the most recently
+    modified object whose key matches the pattern, or None if no object matches."""
+    latest = None
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=glob_prefix(key_pattern)):
+        for obj in page.get('Contents', ()):
+            if fnmatch.fnmatchcase(obj['Key'], key_pattern):
+                logging.info(f"Checking s3://{bucket}/{obj['Key']}")
+                if latest is None or obj['LastModified'] > latest['LastModified']:
+                    latest = obj
+    return latest
+
+
+def _cache_path(cache_dir: pathlib.Path, obj: dict) -> pathlib.Path:
+    # The ETag identifies the object's content, so it names the cached copy.
+    etag = re.sub(r'[^0-9A-Za-z\-]', '', obj['ETag'])
+    return cache_dir / f"{etag}{pathlib.PurePosixPath(obj['Key']).suffix}"
+
+
+def fetch_s3_datafile(client, uri: str, cache_dir: pathlib.Path = pathlib.Path(DEFAULT_CACHE_DIR),
+                      memory_limit: int = DEFAULT_MEMORY_LIMIT) -> Union[io.BytesIO, pathlib.Path, None]:
+    """Find the newest object matching an s3://bucket/key-pattern URI and return it as
+    something the workbook loader can open: an in-memory file for objects no larger
+    than memory_limit bytes, or the path of a cached copy. Returns None if no object matches."""
+    bucket, key_pattern = parse_s3_uri(uri)
+    obj = find_latest_s3_object(client, bucket, key_pattern)
+    if obj is None:
+        return None
+    source = f"{S3_SCHEME}{bucket}/{obj['Key']}"
+    print(f'Using cloud storage object {source} ({obj["Size"]} bytes, ETag {obj["ETag"]})')
+
+    if obj['Size'] <= memory_limit:
+        datafile = io.BytesIO()
+        client.download_fileobj(bucket, obj['Key'], datafile)
+        datafile.seek(0)
+        datafile.name = source
+        return datafile
+
+    cache_dir = pathlib.Path(cache_dir)
+    cached = _cache_path(cache_dir, obj)
+    if cached.exists() and cached.stat().st_size == obj['Size']:
+        logging.info(f'Using cached copy {cached} of {source}')
+        return cached
+    download_object(client, bucket, obj['Key'], cached)
+    return cached
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""ESF APR subordinate list views.
+
+Python module for computing the views declared in the 'views' section of
+a 'subs' entry in an aprMap configuration file. A view is a filtered,
+sorted or grouped copy of a subordinate list, such as the LEA subawards
+with an ESSER I SEA reserve award, computed once when an APR is built
+and attached to the APR under its own name, so templates iterate over
+ready-made lists instead of filtering the whole list in every loop.
+
+Filters are expressions over the record fields (see esf_expressions),
+evaluated over all the records of a list at once. Records missing a
+field the filter uses are left out of the view, as a template test of
+"is defined" would leave them out. When the whole-list evaluation fails,
+for instance on a blank (None) value compared with a number, the filter
+is evaluated one record at a time, with and and or skipping the operands
+they do not need, as the template loop would; a record whose evaluation
+still fails because of a blank value is left out of the view, like a
+record missing the field.
+
+Usage examples:
+>>> class Record:
+...     def __init__(self, **fields):
+...         self.__dict__.update(fields)
+>>> records = [Record(name='a', isLea=True, amount=5.0), Record(name='b', isLea=True, amount=None),
+...            Record(name='c', isLea=False, amount=None), Record(name='d', isLea=True, amount=0.0)]
+>>> [record.name for record in build_views(records, [{'name': 'leas', 'filter': 'amount > 1'}])['leas']]
+['a']
+>>> views = build_views(records, [{'name': 'funded', 'filter': 'not isLea or amount > 1', 'count': 'fundedCount'}])
+>>> [record.name for record in views['funded']], views['fundedCount']
+(['a', 'c'], 2)
+>>> guarded = [records[0], records[2], records[3]]
+>>> [record.name for record in build_views(guarded, [{'name': 'leas', 'filter': 'isLea and amount > 1'}])['leas']]
+['a']
+>>> build_views(records, [{'name': 'named', 'filter': 'name > 1'}])  # doctest: +ELLIPSIS
+Traceback (most recent call last):
+    ...
+ValueError: Error computing view named: ...
+
+@author: Keith.Tucker
+"""
+import functools
+import logging
+from collections import namedtuple
+from typing import Any, Dict, List
+
+import numpy as np
+
+from esf_expressions import Expression
+
+# The groups of a grouped view, matching the records returned by the Jinja groupby filter.
+SubGroup = namedtuple('SubGroup', ['grouper', 'list'])
+
+
+@functools.lru_cache(maxsize=None)
+def _expression(source: str) -> Expression:
+    """Parse a filter expression once for all the APRs built from a configuration."""
+    return Expression(source)
+
+
+def _column(values: List[Any]) -> np.ndarray:
+    # Use a typed array for numeric and boolean fields, so they compare as numbers.
+    if all(isinstance(value, (bool, int, float)) for value in values):
+        return np.array(values)
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def _matches(expression: Expression, record: Any, names: List[str]) -> bool:
+    """Evaluate a filter for one record. A record whose evaluation fails with a blank
+    value in a field the filter uses does not match; any other failure is raised."""
+    namespace = {name: getattr(record, name) for name in names}
+    try:
+        return bool(expression.evaluate(namespace))
+    except TypeError:
+        if any(value is None for value in namespace.values()):
+            return False
+        raise
+
+
+def _filter(records: list, source: str) -> list:
+    expression = _expression(source)
+    names = sorted(expression.names)
+    defined = [record for record in records if all(hasattr(record, name) for name in names)]
+    if not defined:
+        return []
+    columns = {name: _column([getattr(record, name) for record in defined]) for name in names}
+    try:
+        result = np.asarray(expression.evaluate(columns))
+    except TypeError:
+        # Blank values in an object column; evaluate the records one at a time instead.
+        return [record for record in defined if _matches(expression, record, names)]
+    if result.ndim == 0:
+        return defined if bool(result) else []
+    if result.dtype != np.bool_:
+        result = np.fromiter((bool(value) for value in result), dtype=np.bool_, count=len(result))
+    return [record for record, keep in zip(defined, result) if keep]
+
+
+def _sort(records: list, sort_fields: List[str]) -> list:
+    """Sort the records by each field in turn, descending for names starting with -.
+    Records missing a field, or with no value for it, sort after the others."""
+    records = list(records)
+    for sort_field in reversed(sort_fields):
+        descending = sort_field.startswith('-')
+        name = sort_field.lstrip('-')
+        present = [record for record in records if getattr(record, name, None) is not None]
+        missing = [record for record in records if getattr(record, name, None) is None]
+        present.sort(key=lambda record: getattr(record, name), reverse=descending)
+        records = present + missing
+    return records
+
+
+def _group(records: list, group_by: str) -> List[SubGroup]:
+    """Group the records by a field, in the order each value first appears."""
+    groups = {}
+    for record in records:
+        groups.setdefault(getattr(record, group_by, None), []).append(record)
+    return [SubGroup(grouper, group) for grouper, group in groups.items()]
+
+
+def build_views(records: list, views: List[dict]) -> Dict[str, Any]:
+    """Compute the declared views of a subordinate list, returning the attributes
+    to add to the APR: a list (or list of groups) for each view, and the number
+    of records in the view for each view naming a count attribute. Raises
+    ValueError if a view can not be computed, rather than leaving it empty."""
+    attributes = {}
+    for view in views:
+        name = view.get('name')
+        if name is None:
+            logging.info(f'Missing view name in {view}')
+            continue
+        try:
+            selected = records
+            if view.get('filter'):
+                selected = _filter(selected, view['filter'])
+            if view.get('sort'):
+                sort_fields = view['sort']
+                selected = _sort(selected, [sort_fields] if isinstance(sort_fields, str) else sort_fields)
+            if view.get('count'):
+                attributes[view['count']] = len(selected)
+            if view.get('group_by'):
+                attributes[name] = _group(selected, view['group_by'])
+            else:
+                attributes[name] = list(selected)
+        except Exception as e:
+            raise ValueError(f'Error computing view {name}: {e}') from e
+    return attributes
+
+
+def view_fields(view: dict) -> set:
+    """Return the names of the record fields a view uses."""
+    names = set()
+    if view.get('filter'):
+        names |= _expression(view['filter']).names
+    sort_fields = view.get('sort') or []
+    for sort_field in [sort_fields] if isinstance(sort_fields, str) else sort_fields:
+        names.add(sort_field.lstrip('-'))
+    if view.get('group_by'):
+        names.add(view['group_by'])
+    return names
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""ESF APR table row rendering.
+
+Python module providing a Jinja extension for rendering the rows of the
+large subaward tables in APR templates. The tablerows tag is written
+like a for loop over a list of records:
+
+    {% tablerows sub in apr.subawards %}
+    <tr>
+        <td data-entityName{{loop.index}}="{{sub.entityName|e}}">{{sub.entityName|e}}</td>
+        <td class="rightAlign">{{sub.esser3PerPupilStateFundingFy22|dollars}}</td>
+    </tr>
+    {% endtablerows %}
+
+When the template is compiled, the row body is turned into a list of
+its fixed text and its cells, each naming a record attribute (or
+loop.index or loop.index0) and the filters applied to it. When the
+template is rendered, the filter functions are looked up once for
+the table and bound to the cells using them. Each row then takes one
+attrgetter call for the record attributes, one call of the bound filters
+for each distinct filtered value and one string conversion of each
+distinct value, and the fixed text and cell strings of all the rows are
+joined in a single call, rather than Jinja evaluating every cell of
+every row. The output is the same as the for loop's.
+
+A row body using anything else, such as filter arguments, other loop
+attributes, other variables or statements, or a loop with an if test,
+is rendered as an ordinary for loop.
+
+@author: Keith.Tucker
+"""
+from functools import partial
+from itertools import chain
+from operator import attrgetter, itemgetter
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+from jinja2 import nodes
+from jinja2.exceptions import TemplateRuntimeError
+from jinja2.ext import Extension
+from markupsafe import Markup, escape
+
+RENDER_METHOD = '_render_rows'
+LOOP_ATTRIBUTES = {'index': 1, 'index0': 0}
+
+
+def _cell(node: nodes.Node, target: str) -> Optional[tuple]:
+    """Return the cell for an output expression: ('field', attribute, filters) for an
+    attribute of the loop target, or ('loop', attribute, filters) for loop.index or
+    loop.index0, where filters are the names of the filters applied in order.
+    Returns None for any other expression."""
+    filters = []
+    while isinstance(node, nodes.Filter):
+        if node.node is None or node.args or node.kwargs or node.dyn_args or node.dyn_kwargs:
+            return None
+        filters.insert(0, node.name)
+        node = node.node
+    if not isinstance(node, nodes.Getattr) or not isinstance(node.node, nodes.Name):
+        return None
+    if node.node.name == target:
+        return ('field', node.attr, tuple(filters))
+    if node.node.name == 'loop' and node.attr in LOOP_ATTRIBUTES:
+        return ('loop', node.attr, tuple(filters))
+    return None
+
+
+def compile_row(body: List[nodes.Node], target: str) -> Optional[tuple]:
+    """Compile a row body into a tuple of ('text', data) parts and cells,
+    or return None if the body can not be rendered by the formatter."""
+    parts = []
+    for node in body:
+        if not isinstance(node, nodes.Output):
+            return None
+        for child in node.nodes:
+            if isinstance(child, nodes.TemplateData):
+                parts.append(('text', child.data))
+                continue
+            cell = _cell(child, target)
+            if cell is None:
+                return None
+            parts.append(cell)
+    return tuple(parts)
+
+
+class TableRowsExtension(Extension):
+    """Jinja extension adding the tablerows tag."""
+    tags = {'tablerows'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        target = parser.parse_assign_target(extra_end_rules=('name:in',))
+        parser.stream.expect('name:in')
+        records = parser.parse_tuple(with_condexpr=False, extra_end_rules=('name:if',))
+        test = None
+        if parser.stream.skip_if('name:if'):
+            test = parser.parse_expression()
+        body = parser.parse_statements(('name:endtablerows',), drop_needle=True)
+        spec = None
+        if test is None and isinstance(target, nodes.Name):
+            spec = compile_row(body, target.name)
+        if spec is None:
+            return nodes.For(target, records, body, [], test, False, lineno=lineno)
+        call = self.call_method(RENDER_METHOD, [nodes.ContextReference(), records, nodes.Const(spec)], lineno=lineno)
+        return nodes.Output([call], lineno=lineno)
+
+    def _filter(self, names: Tuple[str, ...], context) -> Callable[[Any], Any]:
+        """Return a function applying the named filters in order."""
+        functions = []
+        for name in names:
+            function = self.environment.filters.get(name)
+            if function is None:
+                raise TemplateRuntimeError(f'No filter named {name!r}.')
+            if getattr(function, 'jinja_pass_arg', None) is not None:
+                # Filters taking the context or environment are called through Jinja.
+                function = partial(self.environment.call_filter, name, context=context)
+            functions.append(function)
+        if len(functions) == 1:
+            return functions[0]
+
+        def apply(value):
+            for function in functions:
+                value = function(value)
+            return value
+        return apply
+
+    def _render_rows(self, context, records: Iterable[Any], spec: tuple) -> str:
+        # Each row's values start with loop.index and loop.index0, followed by the
+        # record attributes the cells use, read with one attrgetter call, and then the
+        # filtered values. Cells repeating the same value refer to the same position.
+        attributes = list(dict.fromkeys(part[1] for part in spec if part[0] == 'field'))
+        positions = {('loop', 'index'): 0, ('loop', 'index0'): 1}
+        positions.update({('field', attribute): offset + 2 for offset, attribute in enumerate(attributes)})
+        filtered = []
+        texts = ['']
+        order = []
+        for kind, *rest in spec:
+            if kind == 'text':
+                texts[-1] += rest[0]
+                continue
+            attribute, filter_names = rest
+            key = (kind, attribute, filter_names) if filter_names else (kind, attribute)
+            if key not in positions:
+                positions[key] = len(positions)
+                filtered.append((positions[(kind, attribute)], self._filter(filter_names, context)))
+            order.append(positions[key])
+            texts.append('')
+        last_text = texts.pop()
+
+        getattr_ = self.environment.getattr
+        read = attrgetter(*attributes) if attributes else (lambda record: ())
+        if len(attributes) == 1:
+            read = lambda record, read=read: (read(record),)
+        pick = itemgetter(*order) if order else (lambda strings: ())
+        if len(order) == 1:
+            pick = lambda strings, pick=pick: (pick(strings),)
+        # Values are converted to strings as Jinja would output them.
+        to_string = escape if context.eval_ctx.autoescape else str
+        if self.environment.finalize is not None:
+            finalize, convert = self.environment.finalize, to_string
+            to_string = lambda value: convert(finalize(value))
+
+        # The text and cell strings of every row are joined once, at the end.
+        pieces = []
+        for index, record in enumerate(records, 1):
+            try:
+                values = [index, index - 1, *read(record)]
+            except AttributeError:
+                # Missing attributes are looked up as Jinja would, giving undefined values.
+                values = [index, index - 1, *(getattr_(record, attribute) for attribute in attributes)]
+            for position, function in filtered:
+                values.append(function(values[position]))
+            pieces.extend(chain.from_iterable(zip(texts, pick(list(map(to_string, values))))))
+            pieces.append(last_text)
+        return Markup(''.join(pieces)) if context.eval_ctx.autoescape else ''.join(pieces)
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""ESF APR template field usage.
+
+Python module for finding which mapped fields an APR template uses, by
+walking the Jinja abstract syntax tree of the template and of the
+templates it extends, includes or imports (such as common.html). The
+analysis records every apr.<name> attribute the templates read, and,
+for the records in each subordinate list, every attribute read through
+a loop variable, an index or the attribute arguments of filters such as
+selectattr, including the records in the declared views of each list
+and the cells of tablerows tags (see esf_table_rows).
+Where an APR object or a subordinate record is used in a
+way the analysis cannot follow, such as being output whole or passed to
+a macro, all of its fields are treated as used.
+
+The usage is then used to prune a configuration, so that extraction
+reads and coerces only the columns the template renders, along with the
+columns the computed fields it renders are computed from, and to list
+the mapped fields that are never rendered.
+
+@author: Keith.Tucker
+"""
+import copy
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Set
+
+from jinja2 import Environment, nodes
+
+from esf_computed_fields import computed_fields
+from esf_expressions import Expression
+from esf_sub_views import view_fields
+from esf_table_rows import RENDER_METHOD, TableRowsExtension
+
+# Sources of the values tracked through a template.
+_APR = ('apr', None)
+
+# Filters returning a subset or reordering of the records in a list.
+_LIST_FILTERS = {'selectattr', 'rejectattr', 'sort', 'reverse', 'list', 'unique', 'batch', 'slice'}
+# Filters returning a single record from a list.
+_RECORD_FILTERS = {'first', 'last', 'random'}
+# Filters on a list that use no record attributes, other than those named by their arguments.
+_SCALAR_FILTERS = {'length', 'count', 'sum', 'min', 'max', 'join', 'map'}
+
+
+@dataclass
+class FieldUsage:
+    """The fields a template uses. apr_fields holds the names of the APR attributes read,
+    and sub_fields the names of the record attributes read for each subordinate list.
+    all_apr is set, or a list name is in all_subs, when every field must be kept."""
+    apr_fields: Set[str] = field(default_factory=set)
+    sub_fields: Dict[str, Set[str]] = field(default_factory=dict)
+    all_apr: bool = False
+    all_subs: Set[str] = field(default_factory=set)
+
+    def uses_apr_field(self, name: str) -> bool:
+        return self.all_apr or name in self.apr_fields
+
+    def uses_sub_field(self, sub_name: str, name: str) -> bool:
+        return sub_name in self.all_subs or name in self.sub_fields.get(sub_name, ())
+
+
+class _TemplateAnalyzer:
+    def __init__(self, env: Environment, sub_names: Set[str], views: Dict[str, tuple] = None):
+        self._env = env
+        self._sub_names = sub_names
+        # The source of each view: the records of a list, or groups of them.
+        self._views = views or {}
+        self._seen = set()
+        self.usage = FieldUsage(sub_fields={name: set() for name in sub_names})
+
+    def analyze(self, template_name: str, scope: dict) -> None:
+        if template_name in self._seen:
+            return
+        self._seen.add(template_name)
+        source, _, _ = self._env.loader.get_source(self._env, template_name)
+        self._visit(self._env.parse(source, name=template_name), scope)
+
+    def _escape(self, source) -> None:
+        """Keep every field of a value used in a way the analysis can not follow."""
+        if source is None:
+            return
+        kind, sub_name = source
+        if kind == 'apr':
+            self.usage.all_apr = True
+        else:
+            self.usage.all_subs.add(sub_name)
+
+    def _attribute(self, source, name: str):
+        """Record reading the named attribute of a value, returning the source of the result."""
+        if source is None:
+            return None
+        kind, sub_name = source
+        if kind == 'apr':
+            if name in self._sub_names:
+                return ('list', name)
+            if name in self._views:
+                return self._views[name]
+            self.usage.apr_fields.add(name)
+        elif kind == 'record':
+            self.usage.sub_fields[sub_name].add(name.split('.')[0])
+        elif kind == 'group':
+            if name == 'list':
+                return ('list', sub_name)
+            if name != 'grouper':
+                self._escape(source)
+        elif kind == 'loop':
+            if name in ('previtem', 'nextitem'):
+                return ('record', sub_name)
+        else:
+            self._escape(source)
+        return None
+
+    def _filter_attributes(self, node: nodes.Filter, sub_name: str) -> None:
+        # selectattr and rejectattr name the attribute in their first argument, and
+        # the other filters in an attribute keyword argument. Without one, map and
+        # join use the records themselves.
+        if node.name in ('map', 'join') and not any(kwarg.key == 'attribute' for kwarg in node.kwargs):
+            self.usage.all_subs.add(sub_name)
+        if node.name in ('selectattr', 'rejectattr') and node.args:
+            if isinstance(node.args[0], nodes.Const) and isinstance(node.args[0].value, str):
+                self._attribute(('record', sub_name), node.args[0].value)
+            else:
+                self.usage.all_subs.add(sub_name)
+        for kwarg in node.kwargs:
+            if kwarg.key == 'attribute':
+                if isinstance(kwarg.value, nodes.Const) and isinstance(kwarg.value.value, str):
+                    self._attribute(('record', sub_name), kwarg.value.value)
+                else:
+                    self.usage.all_subs.add(sub_name)
+
+    def _expr(self, node: nodes.Node, scope: dict):
+        """Record the fields an expression reads, returning the source of its value:
+        the APR, a subordinate list or record, or None for any other value."""
+        match node:
+            case nodes.Name():
+                return scope.get(node.name)
+            case nodes.Getattr():
+                return self._attribute(self._expr(node.node, scope), node.attr)
+            case nodes.Getitem():
+                source = self._expr(node.node, scope)
+                if isinstance(node.arg, nodes.Const) and isinstance(node.arg.value, str):
+                    return self._attribute(source, node.arg.value)
+                self._value(node.arg, scope)
+                if source is not None and source[0] in ('list', 'groups'):
+                    return ('record' if source[0] == 'list' else 'group', source[1])
+                self._escape(source)
+                return None
+            case nodes.Filter() if node.node is not None:
+                source = self._expr(node.node, scope)
+                for arg in node.args:
+                    self._value(arg, scope)
+                for kwarg in node.kwargs:
+                    self._value(kwarg.value, scope)
+                if source is None:
+                    return None
+                kind, sub_name = source
+                if kind == 'groups' and node.name in ('length', 'count'):
+                    return None
+                if kind == 'list' and node.name in _LIST_FILTERS | _RECORD_FILTERS | _SCALAR_FILTERS:
+                    self._filter_attributes(node, sub_name)
+                    if node.name in _RECORD_FILTERS:
+                        return ('record', sub_name)
+                    return source if node.name in _LIST_FILTERS else None
+                if kind in ('apr', 'record') and node.name == 'attr' and node.args \
+                        and isinstance(node.args[0], nodes.Const):
+                    return self._attribute(source, node.args[0].value)
+                self._escape(source)
+                return None
+            case nodes.Call() if isinstance(node.node, nodes.ExtensionAttribute) \
+                    and node.node.identifier == TableRowsExtension.identifier and node.node.name == RENDER_METHOD:
+                # A compiled tablerows tag reads the attributes named by its field cells.
+                _, records, spec = node.args
+                source = self._expr(records, scope)
+                if source is None or source[0] != 'list':
+                    self._escape(source)
+                    return None
+                for kind, *rest in spec.value:
+                    if kind == 'field':
+                        self._attribute(('record', source[1]), rest[0])
+                return None
+            case nodes.Test():
+                # Tests such as "is defined" use the value, but not its fields.
+                self._expr(node.node, scope)
+                for arg in node.args:
+                    self._value(arg, scope)
+                return None
+            case nodes.Not():
+                self._expr(node.node, scope)
+                return None
+            case nodes.And() | nodes.Or():
+                self._expr(node.left, scope)
+                self._expr(node.right, scope)
+                return None
+            case nodes.CondExpr():
+                self._expr(node.test, scope)
+                left = self._expr(node.expr1, scope)
+                right = self._expr(node.expr2, scope) if node.expr2 is not None else None
+                if left == right:
+                    return left
+                self._escape(left)
+                self._escape(right)
+                return None
+            case _:
+                for child in node.iter_child_nodes():
+                    self._value(child, scope)
+                return None
+
+    def _value(self, node: nodes.Node, scope: dict) -> None:
+        """Record the fields an expression reads where its value may be used in any way."""
+        if isinstance(node, nodes.Expr):
+            self._escape(self._expr(node, scope))
+        else:
+            self._visit(node, scope)
+
+    def _visit(self, node: nodes.Node, scope: dict) -> None:
+        match node:
+            case nodes.For():
+                source = self._expr(node.iter, scope)
+                inner = dict(scope)
+                if source is not None and source[0] == 'list' and isinstance(node.target, nodes.Name):
+                    inner[node.target.name] = ('record', source[1])
+                    inner['loop'] = ('loop', source[1])
+                elif source is not None and source[0] == 'groups' and isinstance(node.target, nodes.Name):
+                    inner[node.target.name] = ('group', source[1])
+                    inner.pop('loop', None)
+                elif source is not None and source[0] == 'groups' and isinstance(node.target, nodes.Tuple) \
+                        and len(node.target.items) == 2 and all(isinstance(item, nodes.Name) for item in node.target.items):
+                    # for grouper, records in apr.view
+                    inner.pop(node.target.items[0].name, None)
+                    inner[node.target.items[1].name] = ('list', source[1])
+                    inner.pop('loop', None)
+                else:
+                    self._escape(source)
+                    for name in node.target.find_all(nodes.Name):
+                        inner.pop(name.name, None)
+                if node.test is not None:
+                    self._expr(node.test, inner)
+                for child in node.body:
+                    self._visit(child, inner)
+                for child in node.else_:
+                    self._visit(child, scope)
+            case nodes.If():
+                self._expr(node.test, scope)
+                for child in node.body + node.elif_ + node.else_:
+                    self._visit(child, scope)
+            case nodes.Assign() if isinstance(node.target, nodes.Name):
+                source = self._expr(node.node, scope)
+                if source is None:
+                    scope.pop(node.target.name, None)
+                else:
+                    scope[node.target.name] = source
+            case nodes.Macro() | nodes.CallBlock():
+                inner = dict(scope)
+                for arg in node.args:
+                    inner.pop(arg.name, None)
+                for default in node.defaults:
+                    self._value(default, scope)
+                if isinstance(node, nodes.CallBlock):
+                    self._value(node.call, scope)
+                for child in node.body:
+                    self._visit(child, inner)
+            case nodes.Extends() | nodes.Include() | nodes.Import() | nodes.FromImport():
+                if isinstance(node.template, nodes.Const) and isinstance(node.template.value, str):
+                    self.analyze(node.template.value, dict(scope))
+                else:
+                    logging.warning('A template named by an expression can not be analyzed; keeping every field.')
+                    self.usage.all_apr = True
+                    self.usage.all_subs.update(self._sub_names)
+            case nodes.Output():
+                for child in node.nodes:
+                    if not isinstance(child, nodes.TemplateData):
+                        self._value(child, scope)
+            case nodes.Expr():
+                self._value(node, scope)
+            case _:
+                for child in node.iter_child_nodes():
+                    self._visit(child, scope)
+
+
+def template_field_usage(env: Environment, template_name: str, config: dict) -> FieldUsage:
+    """Find the fields of a configuration that the named template, and the templates
+    it extends, includes or imports, use."""
+    sub_names = {sub['name'] for sub in config.get('subs', ()) if sub.get('name')}
+    views = {view['name']: ('groups' if view.get('group_by') else 'list', sub['name'])
+             for sub in config.get('subs', ()) if sub.get('name')
+             for view in sub.get('views', ()) if view.get('name')}
+    analyzer = _TemplateAnalyzer(env, sub_names, views)
+    analyzer.analyze(template_name, {'apr': _APR})
+    return analyzer.usage
+
+
+def _required_fields(config: dict, usage: FieldUsage) -> FieldUsage:
+    """Return the fields extraction needs whether or not the template uses them:
+    the grantee key, the output file name components, the merge fields, the
+    fields the declared views filter, sort or group by, and the fields the
+    used computed fields are computed from."""
+    required = FieldUsage(apr_fields={config.get('primary_grantee_key_name')} | set(config.get('filename_components', ())))
+    for sub in config.get('subs', ()):
+        required.sub_fields[sub.get('name')] = {sub.get('merge_field')}
+        for view in sub.get('views', ()):
+            required.sub_fields[sub.get('name')] |= view_fields(view)
+    _used_computed(config, usage, required)
+    return required
+
+
+def _used_computed(config: dict, usage: FieldUsage, required: FieldUsage) -> List[dict]:
+    """Return the computed field definitions used by the template, the views or other
+    used computed fields, adding the fields they are computed from to required."""
+    primary_name = config.get('primary_grantee_worksheet_name')
+    worksheet_subs = {child.get('worksheet_name'): sub.get('name')
+                      for sub in config.get('subs', ()) for child in sub.get('children', ())}
+
+    def uses(sub_name, name: str) -> bool:
+        if sub_name is None:
+            return usage.uses_apr_field(name) or required.uses_apr_field(name)
+        return usage.uses_sub_field(sub_name, name) or required.uses_sub_field(sub_name, name)
+
+    used = []
+    for worksheet_name, definitions in computed_fields(config).items():
+        if worksheet_name == primary_name:
+            sub_name, fields = None, required.apr_fields
+        elif worksheet_name in worksheet_subs:
+            sub_name = worksheet_subs[worksheet_name]
+            fields = required.sub_fields.setdefault(sub_name, set())
+        else:
+            continue
+        # Computed fields may use the ones declared before them, so walk them in reverse.
+        for computed in reversed(definitions):
+            if uses(sub_name, computed['name']):
+                fields |= Expression(computed['expression']).names
+                used.append(id(computed))
+    return [computed for computed in config.get('computed', ()) if id(computed) in used]
+
+
+def unused_fields(config: dict, usage: FieldUsage) -> List[str]:
+    """List the mapped fields the template never uses, as name or sub_name.name."""
+    required = _required_fields(config, usage)
+    unused = [entry['name'] for entry in config.get('main', ())
+              if not usage.uses_apr_field(entry['name']) and not required.uses_apr_field(entry['name'])]
+    for sub in config.get('subs', ()):
+        for child in sub.get('children', ()):
+            for entry in child.get('field_map', ()):
+                if not usage.uses_sub_field(sub['name'], entry['name']) \
+                        and not required.uses_sub_field(sub['name'], entry['name']):
+                    unused.append(f"{sub['name']}.{entry['name']}")
+    return list(dict.fromkeys(unused))
+
+
+def prune_config(config: dict, usage: FieldUsage) -> dict:
+    """Return a copy of the configuration whose main and field_map lists hold only
+    the fields the template uses, along with those extraction needs, and whose
+    computed list holds only the computed fields used."""
+    required = _required_fields(config, usage)
+    pruned = copy.deepcopy(config)
+    if 'computed' in config:
+        pruned['computed'] = copy.deepcopy(_used_computed(config, usage, required))
+    pruned['main'] = [entry for entry in config.get('main', ())
+                      if usage.uses_apr_field(entry['name']) or required.uses_apr_field(entry['name'])]
+    for sub in pruned.get('subs', ()):
+        for child in sub.get('children', ()):
+            child['field_map'] = [entry for entry in child.get('field_map', ())
+                                  if usage.uses_sub_field(sub['name'], entry['name'])
+                                  or required.uses_sub_field(sub['name'], entry['name'])]
+    return pruned
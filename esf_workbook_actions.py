@@ -8,13 +8,19 @@ grants.
 @author: Keith.Tucker
 """
 from collections.abc import Iterable
+from contextlib import nullcontext
 from dataclasses import dataclass
+import hashlib
 import logging
-from typing import List, Any
+import time
+from typing import Dict, List, Any, Tuple
 
 from openpyxl.workbook.workbook import Workbook
 from openpyxl.worksheet.worksheet import Worksheet
 
+from esf_memory_profile import stage
+from esf_sub_views import build_views
+
 class _ESF_Sub:
     """Child class for all subordinate pieces of an APR.
 
@@ -61,7 +67,7 @@ def _key_gen(keys: List[str]):
     yield from keys
 
 
-def _force_bool(input_value: Any) -> bool:
+def force_bool(input_value: Any) -> bool:
     """Coerce a value to boolean type."""
     if isinstance(input_value,bool):
         return input_value
@@ -69,7 +75,7 @@ def _force_bool(input_value: Any) -> bool:
     return string_value.lower() == "true"
 
 
-def _force_float(input_value: Any) -> float:
+def force_float(input_value: Any) -> float:
     """Coerce a value to float type."""
     if isinstance(input_value,float):
         return input_value
@@ -80,7 +86,7 @@ def _force_float(input_value: Any) -> float:
         return 0.0
 
 
-def _force_int(input_value: Any) -> int:
+def force_int(input_value: Any) -> int:
     """Coerce a value to int type."""
     if isinstance(input_value,int):
         return input_value
@@ -91,6 +97,20 @@ def _force_int(input_value: Any) -> int:
         return 0
 
 
+def _phase(metrics, name: str, worksheet: str = None):
+    """Return a timing context for the named phase, or a no-op context when no metrics are collected."""
+    if metrics is None:
+        return nullcontext()
+    return metrics.phase(name, worksheet=worksheet)
+
+
+def _column_count(field_map: list, *offsets: int) -> int:
+    """Return the number of worksheet columns to read for a field map: through the
+    highest mapped index, and through any of the passed offsets."""
+    indexes = [element['index'] for element in field_map if element.get('index') is not None]
+    return max(indexes + list(offsets)) + 1
+
+
 def _find_row(ws: Worksheet, key: str, key_column: int) -> int:
     """Find a row within a worksheet in which the passed key equals the value in the passed key_column."""
     for row in ws.iter_rows(min_row=2, min_col=key_column, max_col=key_column):
@@ -102,12 +122,29 @@ def _find_row(ws: Worksheet, key: str, key_column: int) -> int:
     return -1
 
 
-def _extract_sub_worksheet(ws: Worksheet, workbook_map: list, key: str, key_offset: int) -> List[_ESF_Sub]:
+def _extract_sub_worksheet(ws: Worksheet, workbook_map: list, key: str, key_offset: int,
+                           metrics=None, computed: Dict[str, list] = None) -> List[_ESF_Sub]:
+    with _phase(metrics, 'worksheet_scan', worksheet=ws.title):
+        return _scan_sub_worksheet(ws=ws, workbook_map=workbook_map, key=key, key_offset=key_offset,
+                                   computed=computed)
+
+
+def _add_computed(obj, computed: Dict[str, list], position: int) -> None:
+    """Add the values of the computed fields for the worksheet row at position (starting at 0
+    for the first row after the header row) to an APR object or subordinate record."""
+    for attr_name, values in (computed or {}).items():
+        if position < len(values):
+            setattr(obj, attr_name, values[position])
+
+
+def _scan_sub_worksheet(ws: Worksheet, workbook_map: list, key: str, key_offset: int,
+                        computed: Dict[str, list] = None) -> List[_ESF_Sub]:
     subs = []
     try:
         logging.info(f'Iterating {ws.title} for key {key}')
-        for row in ws.iter_rows(min_row=2, min_col=1,
-                                max_col=len(workbook_map), values_only=True):
+        for position, row in enumerate(ws.iter_rows(min_row=2, min_col=1,
+                                                    max_col=_column_count(workbook_map, key_offset),
+                                                    values_only=True)):
             if row[key_offset] == key:
                 sub = _ESF_Sub()
                 # Loop over the entries in the workbook_map, creating an attribute on
@@ -129,14 +166,15 @@ def _extract_sub_worksheet(ws: Worksheet, workbook_map: list, key: str, key_offs
                         continue
                     match element.get('type', None):
                         case 'bool':
-                            val = _force_bool(row[index])
+                            val = force_bool(row[index])
                         case 'int':
-                            val = _force_int(row[index])
+                            val = force_int(row[index])
                         case 'float':
-                            val = _force_float(row[index])
+                            val = force_float(row[index])
                         case _:
                             val = row[index]
                     setattr(sub, attr_name, val)
+                _add_computed(sub, computed, position)
                 subs.append(sub)
         logging.info(f'Extracted {len(subs)} data rows.')
         return subs
@@ -146,7 +184,8 @@ def _extract_sub_worksheet(ws: Worksheet, workbook_map: list, key: str, key_offs
         return subs
 
 
-def _build_apr(wb: Workbook, row: tuple, wb_map: dict) -> ESF_APR:
+def _build_apr(wb: Workbook, row: tuple, wb_map: dict, metrics=None,
+               computed: Dict[str, Dict[str, list]] = None, position: int = None) -> ESF_APR:
     # Create an instance of the ESF_APR class with the common
     # attributes for all APRs.
     apr = ESF_APR(omb_control_number=wb_map['omb_control_number'],
@@ -172,11 +211,11 @@ def _build_apr(wb: Workbook, row: tuple, wb_map: dict) -> ESF_APR:
         try:
             match attr.get('type', None):
                 case 'bool':
-                    val = _force_bool(row[index])
+                    val = force_bool(row[index])
                 case 'int':
-                    val = _force_int(row[index])
+                    val = force_int(row[index])
                 case 'float':
-                    val = _force_float(row[index])
+                    val = force_float(row[index])
                 case _:
                     val = row[index]
             setattr(apr, attr_name, val)
@@ -185,6 +224,9 @@ def _build_apr(wb: Workbook, row: tuple, wb_map: dict) -> ESF_APR:
             logging.error(row)
             logging.error(attr)
             logging.error(f'Index {index}')
+    computed = computed or {}
+    if position is not None:
+        _add_computed(apr, computed.get(wb_map['primary_grantee_worksheet_name']), position)
 
     sublist = wb_map.get('subs',None)
     if sublist is not None:
@@ -214,7 +256,8 @@ def _build_apr(wb: Workbook, row: tuple, wb_map: dict) -> ESF_APR:
                     key_offset = sub_pieces[0].get('key_offset')
                     subvals = _extract_sub_worksheet(ws=ws,
                         workbook_map=field_map, key=apr_key,
-                        key_offset=key_offset)
+                        key_offset=key_offset, metrics=metrics,
+                        computed=computed.get(ws.title))
                 else:
                     for sub_piece in sub_pieces:
                         ws = wb[sub_piece.get('worksheet_name')]
@@ -222,52 +265,181 @@ def _build_apr(wb: Workbook, row: tuple, wb_map: dict) -> ESF_APR:
                         key_offset = sub_piece.get('key_offset')
                         partial_subvals = _extract_sub_worksheet(ws=ws,
                             workbook_map=field_map, key=apr_key,
-                            key_offset=key_offset)
+                            key_offset=key_offset, metrics=metrics,
+                            computed=computed.get(ws.title))
                         # Merge all the objects extracted from the child worksheet
                         # into the subvals list of dictionaries, using the key_field to
                         # determine whether there's an existing entry in the main list
                         # to update, or a new entry is needed.
-                        for subval in partial_subvals:
-                            merge_key = getattr(subval,merge_field, None)
-                            if merge_key is None:
-                                logging.error(f'Merge field {merge_field} missing in {subval}')
-                                continue
-                            else:
-                                should_append = True
-                                for val in subvals:
-                                    merge_val = getattr(val,merge_field, None)
-                                    if merge_key is not None and merge_key == merge_val:
-                                        val.merge(subval)
-                                        should_append = False
-                                        break
-                                if should_append:
-                                    subvals.append(subval)
+                        with _phase(metrics, 'merge', worksheet=ws.title):
+                            for subval in partial_subvals:
+                                merge_key = getattr(subval,merge_field, None)
+                                if merge_key is None:
+                                    logging.error(f'Merge field {merge_field} missing in {subval}')
+                                    continue
+                                else:
+                                    should_append = True
+                                    for val in subvals:
+                                        merge_val = getattr(val,merge_field, None)
+                                        if merge_key is not None and merge_key == merge_val:
+                                            val.merge(subval)
+                                            should_append = False
+                                            break
+                                    if should_append:
+                                        subvals.append(subval)
                 setattr(apr, sub_name, subvals)
+                # Attach the declared views of the list, computed once for all the template's loops.
+                # An APR whose views can not be computed is not generated, rather than
+                # being generated with sections missing.
+                if sub.get('views'):
+                    try:
+                        with _phase(metrics, 'views'):
+                            views = build_views(subvals, sub['views'])
+                    except ValueError as e:
+                        logging.error(f'Not generating the APR for {apr_key}.', exc_info=e)
+                        return None
+                    for view_name, view in views.items():
+                        setattr(apr, view_name, view)
 
     return apr
 
 
+def _key_hash(key: Any) -> int:
+    """Hash a grantee key to an integer that is stable across processes and platforms."""
+    digest = hashlib.sha256(str(key).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+def assign_shards(keys: List[Any], shard_count: int, weights: Dict[Any, int] = None) -> Dict[Any, int]:
+    """Assign each grantee key to one of shard_count shards.
+
+    Without weights, a key's shard is its stable hash modulo the shard count.
+    With weights, keys are placed in order of decreasing weight (ties broken by
+    the stable hash) onto the shard with the least total weight so far, which
+    balances the work while giving every node the same assignment."""
+    if weights is None:
+        return {key: _key_hash(key) % shard_count for key in keys}
+    loads = [0] * shard_count
+    assignment = {}
+    for key in sorted(keys, key=lambda k: (-weights.get(k, 0), _key_hash(k), str(k))):
+        shard = loads.index(min(loads))
+        assignment[key] = shard
+        # Count every grantee as at least one unit of work, even without subawards.
+        loads[shard] += weights.get(key, 0) + 1
+    return assignment
+
+
+def _primary_keys(wb: Workbook, config: dict) -> List[Any]:
+    """Return the distinct grantee keys to generate, in worksheet or configuration order."""
+    keys = config.get('primary_grantee_keys', None)
+    if keys is None:
+        apr_ws = wb[config['primary_grantee_worksheet_name']]
+        key_column = config['primary_grantee_key_worksheet_column']
+        keys = [row[0] for row in apr_ws.iter_rows(min_row=2, min_col=key_column,
+                                                   max_col=key_column, values_only=True)]
+    return list(dict.fromkeys(key for key in keys if key is not None))
+
+
+def _subaward_weights(wb: Workbook, config: dict) -> Dict[Any, int]:
+    """Count the subordinate worksheet rows for each grantee key, reading only the key columns."""
+    weights = {}
+    for sub in config.get('subs', _empty_gen()):
+        for sub_piece in sub.get('children', _empty_gen()):
+            ws = wb[sub_piece.get('worksheet_name')]
+            key_column = sub_piece.get('key_offset') + 1
+            for row in ws.iter_rows(min_row=2, min_col=key_column, max_col=key_column, values_only=True):
+                weights[row[0]] = weights.get(row[0], 0) + 1
+    return weights
+
+
+def _subaward_count(apr: ESF_APR, wb_map: dict) -> int:
+    """Count the records in all the subordinate lists attached to an APR."""
+    count = 0
+    for sub in wb_map.get('subs', _empty_gen()):
+        count += len(getattr(apr, sub.get('name', ''), None) or ())
+    return count
+
+
 class APRWorkbookList(Iterable):
-    def __init__(self, wb: Workbook, config: dict):
-        """Abstract iterating over any APR workbook."""
+    def __init__(self, wb: Workbook, config: dict, metrics=None, memory=None,
+                 shard: Tuple[int, int] = None, shard_weighted: bool = False,
+                 computed: Dict[str, Dict[str, list]] = None):
+        """Abstract iterating over any APR workbook.
+
+        If a RunMetrics instance is passed as metrics, the time spent building
+        each APR and scanning each worksheet is recorded in it. If a MemoryProfiler
+        instance is passed as memory, building each APR is profiled as the 'build'
+        stage and the size of each APR object and subordinate record is tallied.
+
+        If shard is passed as a tuple of (index, count), only the grantees assigned
+        to that shard by assign_shards are generated, where index starts at 0. With
+        shard_weighted, the assignment balances the subaward rows in each shard.
+        After iteration starts, all_keys holds every grantee key and shard_keys holds
+        the keys assigned to this shard.
+
+        If the computed field values returned by esf_computed_fields.compute_fields
+        are passed as computed, they are added to the APR objects and subordinate
+        records built from each worksheet row."""
         self._key_iterator = None
         self._apr_iterator = None
         self._wb = wb
         self._config = config
+        self._metrics = metrics
+        self._memory = memory
+        if shard is not None:
+            index, count = shard
+            if count < 1 or not 0 <= index < count:
+                raise ValueError(f'Invalid shard {index}/{count}.')
+        self._shard = shard
+        self._shard_weighted = shard_weighted
+        self._computed = computed
+        self.all_keys = None
+        self.shard_keys = None
 
     def __iter__(self):
+        shard_keys = None
+        if self._shard is not None:
+            index, count = self._shard
+            self.all_keys = _primary_keys(self._wb, self._config)
+            weights = None
+            if self._shard_weighted:
+                weights = _subaward_weights(self._wb, self._config)
+            assignment = assign_shards(self.all_keys, count, weights=weights)
+            self.shard_keys = [key for key in self.all_keys if assignment[key] == index]
+            shard_keys = set(self.shard_keys)
         if self._config.get('primary_grantee_keys',None) is None:
             # Extract the worksheet named in the configuration.
             apr_ws = self._wb[self._config['primary_grantee_worksheet_name']]
             # Store an iterator for the entire APR worksheet.
-            self._apr_iterator = apr_ws.iter_rows(min_row=2, min_col=1, max_col=len(self._config['main']), values_only=True)
+            # Each row is paired with its position, for looking up computed field values.
+            self._apr_iterator = enumerate(apr_ws.iter_rows(min_row=2, min_col=1, max_col=self._main_columns(), values_only=True))
+            if shard_keys is not None:
+                key_index = self._config['primary_grantee_key_worksheet_column'] - 1
+                self._apr_iterator = ((position, row) for position, row in self._apr_iterator
+                                      if row[key_index] in shard_keys)
+        elif shard_keys is not None:
+            self._key_iterator = _key_gen(self.shard_keys)
         else:
             self._key_iterator = _key_gen(self._config['primary_grantee_keys'])
         return self
 
+    def _main_columns(self) -> int:
+        return _column_count(self._config['main'], self._config['primary_grantee_key_worksheet_column'] - 1)
+
     def __next__(self):
+        with stage(self._memory, 'build'):
+            apri = self._next_apr()
+        if self._memory is not None and apri is not None:
+            self._memory.record_object('ESF_APR', apri)
+            for sub in self._config.get('subs', _empty_gen()):
+                for record in getattr(apri, sub.get('name', ''), None) or ():
+                    self._memory.record_object('_ESF_Sub', record)
+        return apri
+
+    def _next_apr(self):
         apri = None
         apr_row = None
+        start = time.perf_counter()
         if self._key_iterator is not None:
             # Find the specific row matching the next key.
             key = next(self._key_iterator)
@@ -279,18 +451,28 @@ class APRWorkbookList(Iterable):
                 return None
             else:
                 apr_iterator = apr_ws.iter_rows(min_row=row, max_row=row,
-                    min_col=1, max_col=len(self._config['main']),
+                    min_col=1, max_col=self._main_columns(),
                     values_only=True)
                 apr_row = next(apr_iterator)
+                position = row - 2
         else:
-            apr_row = next(self._apr_iterator)
+            position, apr_row = next(self._apr_iterator)
         if apr_row is None:
             logging.error('No row retrieved from primary worksheet in APRWorkbookList.__next()__')
-        apri = _build_apr(wb=self._wb, row=apr_row, wb_map=self._config)
+        apri = _build_apr(wb=self._wb, row=apr_row, wb_map=self._config, metrics=self._metrics,
+                          computed=self._computed, position=position)
+        if apri is None:
+            return None
         output_file_base_name = f"{self._config['subfund']}-{self._config['reporting_year']}"
         for fnc in self._config['filename_components']:
             component = getattr(apri,fnc,None)
             if component is not None:
                 output_file_base_name = f'{output_file_base_name}-{component}'
         setattr(apri,'output_file_base_name',output_file_base_name)
+        if self._metrics is not None:
+            build_seconds = time.perf_counter() - start
+            self._metrics.add_phase('build', build_seconds)
+            self._metrics.grantee(output_file_base_name).update(
+                build_seconds=build_seconds,
+                subawards=_subaward_count(apri, self._config))
         return apri
@@ -9,20 +9,40 @@ Python class for generating an Annual Performance Report
 
 """
 
+import copy
+from collections import defaultdict
 from datetime import datetime
+import functools
 import logging
+import time
 from typing import List
 
 from dataclasses import dataclass
 
 from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, LongTable
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib.enums import TA_CENTER, TA_RIGHT
 from reportlab.lib.units import inch
 
 ISO="Keith Tucker"
 
+# Table modes: 'table' builds each table as a single Table, 'long' builds the tables with a row
+# for every subgrantee as LongTables of at most chunk_rows rows, repeating the header row.
+TABLE_MODES = ('table', 'long')
+DEFAULT_CHUNK_ROWS = 100
+
+# Table styles shared by every APR.
+NAME_TABLE_STYLE = TableStyle([('BACKGROUND',(0,0),(-1,0),(0.85,0.85,0.85)),
+                               ('GRID',(0,0),(-1,-1),0.25,(0,0,0))])
+HEADER_TABLE_STYLE = TableStyle([('ALIGN',(0,0),(-1,0),'CENTER'),
+                                 ('BACKGROUND',(0,0),(-1,0),(0.75,0.75,0.75)),
+                                 ('GRID',(0,0),(-1,-1),0.25,(0,0,0))])
+LABELED_TABLE_STYLE = TableStyle([('ALIGN',(0,0),(-1,0),'CENTER'),
+                                  ('BACKGROUND',(0,0),(-1,0),(0.75,0.75,0.75)),
+                                  ('BACKGROUND',(0,1),(0,-1),(0.75,0.75,0.75)),
+                                  ('GRID',(0,0),(-1,-1),0.25,(0,0,0))])
+
 @dataclass
 class GEER_Grantee:
     stateCode: str
@@ -171,7 +191,35 @@ class GEER_Subgrantee:
 
 
 
+class TimedLongTable(LongTable):
+    """LongTable that adds the time spent laying it out, including the parts it is split
+    into across pages, to a tally of seconds keyed by the table's label."""
+    def __init__(self, *args, tally=None, label=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tally = tally
+        self.label = label
+
+    def _timed(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            if self.tally is not None:
+                self.tally[self.label] += time.perf_counter() - start
+
+    def wrap(self, availWidth, availHeight):
+        return self._timed(super().wrap, availWidth, availHeight)
+
+    def split(self, availWidth, availHeight):
+        parts = self._timed(super().split, availWidth, availHeight)
+        for part in parts:
+            part.tally, part.label = self.tally, self.label
+        return parts
+
+
 class GEER_APR:
+    # The styles are shared by every APR, so they are set up here once and never
+    # changed while APRs are generated.
     styles = getSampleStyleSheet()
     styles.add(styles["Normal"].clone("Centered",alignment=TA_CENTER))
     styles.add(styles["Normal"].clone("Right",alignment=TA_RIGHT))
@@ -180,10 +228,47 @@ class GEER_APR:
     styles.add(styles["Normal"].clone("BL3",bulletIndent=0.375 * inch))
     styles.add(styles["Normal"].clone("BL4",bulletIndent=0.5*inch))
     styles.add(styles["Normal"].clone("BL5",bulletIndent=0.625*inch))
+    styles["Normal"].spaceBefore=9
+    styles["Centered"].spaceAfter=9
+    styles["Heading1"].spaceBefore=0.5*inch
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _parsed_paragraph(text: str, style: str) -> Paragraph:
+        return Paragraph(text, style=GEER_APR.styles[style])
+
+    @staticmethod
+    def _static_paragraph(text: str, style: str) -> Paragraph:
+        """Return a paragraph for text that is the same in every APR. The markup is parsed
+        only once; each use gets a shallow copy, since building a document marks the
+        flowables it places."""
+        return copy.copy(GEER_APR._parsed_paragraph(text, style))
 
-    def __init__(self, version=1):
+    def __init__(self, version=1, table_mode='table', chunk_rows=DEFAULT_CHUNK_ROWS):
         self.width, self.height = letter
         self.version = version
+        if table_mode not in TABLE_MODES:
+            raise ValueError(f'table_mode must be one of {", ".join(TABLE_MODES)}')
+        self.table_mode = table_mode
+        self.chunk_rows = max(chunk_rows, 1)
+        self.layout_times = defaultdict(float)
+        self.table_counts = defaultdict(int)
+
+    def _add_long_table_rows(self, flowables: list, rows: list, label: str, final: bool = False) -> None:
+        """In long table mode, move the rows after the header row into a new LongTable each
+        time there are chunk_rows of them (or, if final, any at all), so that no table
+        grows longer than chunk_rows rows."""
+        while len(rows) > self.chunk_rows or (final and len(rows) > 1):
+            block = rows[1:self.chunk_rows + 1]
+            del rows[1:self.chunk_rows + 1]
+            self.table_counts[label] += 1
+            flowables.append(TimedLongTable([rows[0]] + block,
+                                            repeatRows=1,
+                                            spaceBefore=9,
+                                            spaceAfter=6,
+                                            style=HEADER_TABLE_STYLE,
+                                            tally=self.layout_times,
+                                            label=f'{label} table {self.table_counts[label]}'))
 
     @staticmethod
     def _header_footer(canvas, document):
@@ -223,7 +308,7 @@ class GEER_APR:
                     "the purposes for which the funds were expended by the "+
                     "LEA. (If the SEA operates as a unitary system then report "+
                     "for the entire SEA.)")
-        line=Paragraph(lineText, style=GEER_APR.styles["Normal"])
+        line=self._static_paragraph(lineText, "Normal")
         leaFlowables.append(line)
 
         iheFlowables = []
@@ -231,7 +316,7 @@ class GEER_APR:
                     "the State, provide the amount expended and additional "+ 
                     "information if GEER funds were used by the IHE to provide "+
                     "financial aid to students at the IHE.")
-        line=Paragraph(lineText, style=GEER_APR.styles["Normal"])
+        line=self._static_paragraph(lineText, "Normal")
         iheFlowables.append(line)
 
         entityFlowables = []
@@ -240,19 +325,19 @@ class GEER_APR:
                     " or will be served by the entity? Did the funding awarded to "+
                     "the entity support distance-learning and remote education or "+
                     "provide financial support to students?")
-        line=Paragraph(lineText, style=GEER_APR.styles["Normal"])
+        line=self._static_paragraph(lineText, "Normal")
         entityFlowables.append(line)
 
         fteFlowables = []
         lineText = "7. Provide the number of full-time equivalent (FTE) positions for the LEA, IHE, or Entity as of the listed reporting dates. (The number of FTE positions includes all staff regardless of whether the position is funded by Federal, State, local, or other funds —including instructional and non-instructional staff and contractors—and equals the sum of the number of full-time positions plus the full-time equivalent of the number of part-time positions.)"
-        line=Paragraph(lineText, style=GEER_APR.styles["Normal"])
+        line=self._static_paragraph(lineText, "Normal")
         fteFlowables.append(line)
-        heading1=Paragraph("<b>LEA Name/IHE/Entity Name</b>", style=GEER_APR.styles["Normal"])
-        heading2=Paragraph("<b>DUNS number</b>", style=GEER_APR.styles["Normal"])
-        heading3=Paragraph("<b>Full-time equivalent (FTE) positions as of September 30, 2018</b>", style=GEER_APR.styles["Normal"])
-        heading4=Paragraph("<b>Full-time equivalent (FTE) positions as of September 30, 2019</b>", style=GEER_APR.styles["Normal"])
-        heading5=Paragraph("<b>Full-time equivalent (FTE) positions as of March 13, 2020</b>", style=GEER_APR.styles["Normal"])
-        heading6=Paragraph("<b>Full-time equivalent (FTE) positions on September 30, 2020</b>", style=GEER_APR.styles["Normal"])
+        heading1=self._static_paragraph("<b>LEA Name/IHE/Entity Name</b>", "Normal")
+        heading2=self._static_paragraph("<b>DUNS number</b>", "Normal")
+        heading3=self._static_paragraph("<b>Full-time equivalent (FTE) positions as of September 30, 2018</b>", "Normal")
+        heading4=self._static_paragraph("<b>Full-time equivalent (FTE) positions as of September 30, 2019</b>", "Normal")
+        heading5=self._static_paragraph("<b>Full-time equivalent (FTE) positions as of March 13, 2020</b>", "Normal")
+        heading6=self._static_paragraph("<b>Full-time equivalent (FTE) positions on September 30, 2020</b>", "Normal")
         fteValues = [[heading1,heading2,heading3,heading4,heading5,heading6]]
 
         for sub in subs:
@@ -261,16 +346,15 @@ class GEER_APR:
                 line=Paragraph(lineText, style=GEER_APR.styles["Normal"])
                 table = Table([[line]],
                               spaceBefore=9,
-                              style=[('BACKGROUND',(0,0),(-1,0),(0.85,0.85,0.85)),
-                                     ('GRID',(0,0),(-1,-1),0.25,(0,0,0))])
+                              style=NAME_TABLE_STYLE)
                 leaFlowables.append(table)
                 lineText=f"<b>DUNS #:</b> {sub.dunsNumber}"
                 line=Paragraph(lineText, style=GEER_APR.styles["Normal"])
                 leaFlowables.append(line)
-                heading1 = Paragraph("<b>Total amount awarded to the LEA</b>",style=GEER_APR.styles["Normal"])
-                heading2 = Paragraph("<b>Amount expended by the LEA for Public Schools:</b>",style=GEER_APR.styles["Normal"])
-                heading3 = Paragraph("<b>Amount expended by the LEA for equitable services for Non-public School students and teachers</b>",style=GEER_APR.styles["Normal"])
-                heading4 = Paragraph("<b>Total amount expended by the LEA:</b>",style=GEER_APR.styles["Normal"])
+                heading1 = self._static_paragraph("<b>Total amount awarded to the LEA</b>", "Normal")
+                heading2 = self._static_paragraph("<b>Amount expended by the LEA for Public Schools:</b>", "Normal")
+                heading3 = self._static_paragraph("<b>Amount expended by the LEA for equitable services for Non-public School students and teachers</b>", "Normal")
+                heading4 = self._static_paragraph("<b>Total amount expended by the LEA:</b>", "Normal")
                 tableContent = [[heading1,heading2,heading3, heading4],
                                 [f"${sub.awardedAmount:,.2f}" if sub.awardedAmount else '', 
                                 f"${sub.fundsExpendedOnPublicSchools:,.2f}" if sub.fundsExpendedOnPublicSchools else '', 
@@ -279,51 +363,49 @@ class GEER_APR:
                 table = Table(tableContent,
                               spaceBefore=6,
                               spaceAfter=6,
-                              style=[('ALIGN',(0,0),(-1,0),'CENTER'),
-                                    ('BACKGROUND',(0,0),(-1,0),(0.75,0.75,0.75)),
-                                    ('GRID',(0,0),(-1,-1),0.25,(0,0,0))])
+                              style=HEADER_TABLE_STYLE)
                 leaFlowables.append(table)
                 lineText=f"<b>Who is the LEA serving with these funds?:</b> {sub.servedPopulation}"
                 line=Paragraph(lineText, style=GEER_APR.styles["Normal"])
                 leaFlowables.append(line)
                 lineText="<b>Uses of GEER funds:</b>"
-                line=Paragraph(lineText, style=GEER_APR.styles["Normal"])
+                line=self._static_paragraph(lineText, "Normal")
                 leaFlowables.append(line)
                 if sub.usedFundsForEducationalTechnology:
                     lineText=("<bullet>1.</bullet><b>Purchasing educational technology</b> "+
                     "(including hardware, software, and connectivity), which "+
                     "may include assistive technology or adaptive equipment. ")
-                    line=Paragraph(lineText, style=GEER_APR.styles["BL1"])
+                    line=self._static_paragraph(lineText, "BL1")
                     leaFlowables.append(line)
                     if sub.usedFundsToProvideInternet:
                         lineText="<bullet>b.</bullet>Did this LEA use GEER funds to provide home Internet access for any students? Y"
-                        line=Paragraph(lineText, style=GEER_APR.styles["BL2"])
+                        line=self._static_paragraph(lineText, "BL2")
                         leaFlowables.append(line)
                         lineText="If yes, what types of home Internet services were provided by the district using GEER funds?"
-                        line=Paragraph(lineText, style=GEER_APR.styles["BL2"])
+                        line=self._static_paragraph(lineText, "BL2")
                         leaFlowables.append(line)
                         if sub.usedFundsForMobileHotspots:
                             lineText="<bullet>&bull;</bullet>Mobile hotspots with paid data plans"
-                            line=Paragraph(lineText, style=GEER_APR.styles["BL3"])
+                            line=self._static_paragraph(lineText, "BL3")
                             leaFlowables.append(line)
                         if sub.usedFundsForInternetDevices:
                             lineText="<bullet>&bull;</bullet>Internet connected devices with paid data plans"
-                            line=Paragraph(lineText, style=GEER_APR.styles["BL3"])
+                            line=self._static_paragraph(lineText, "BL3")
                             leaFlowables.append(line)
                         if sub.usedFundsForHomeInternet:
                             lineText="<bullet>&bull;</bullet>District pays for the cost of home Internet subscription for student"
-                            line=Paragraph(lineText, style=GEER_APR.styles["BL3"])
+                            line=self._static_paragraph(lineText, "BL3")
                             leaFlowables.append(line)
                         if sub.usedFundsForDistrictInternet:
                             lineText="<bullet>&bull;</bullet>District provides home Internet access through a district-managed wireless network"
-                            line=Paragraph(lineText, style=GEER_APR.styles["BL3"])
+                            line=self._static_paragraph(lineText, "BL3")
                             leaFlowables.append(line)
                         if sub.usedFundsForOtherInternet:
                             lineText=f"<bullet>&bull;</bullet>Other; If yes, please specify: {sub.usedFundsForOtherInternetDescription}"
                             line=Paragraph(lineText, style=GEER_APR.styles["BL3"])
                             leaFlowables.append(line)
                         lineText="<bullet>c.</bullet>Among students enrolled on September 30, 2020, what proportion of students by district had a dedicated LEA-provided device funded by GEER for the following grade bands? For the purposes of this survey, include desktop, laptop, and tablet computers (including Chromebooks and iPads). Do not include smartphone devices. “Elementary” is defined as “a school classified as elementary by state and local practice and composed of any span of grades not above grade 8” and “Secondary” is defined as “a school comprising any span of grades beginning with the next grade following an elementary or middle school (usually 7, 8, or 9) and ending with or below grade 12. Both junior high schools and senior high schools are included."
-                        line=Paragraph(lineText, style=GEER_APR.styles["BL2"])
+                        line=self._static_paragraph(lineText, "BL2")
                         leaFlowables.append(line)
                         tableContent=[["Grade level",
                                        "Students with dedicated device provided by the LEA (Numerator)",
@@ -334,12 +416,10 @@ class GEER_APR:
                         table = Table(tableContent,
                               spaceBefore=6,
                               spaceAfter=6,
-                              style=[('ALIGN',(0,0),(-1,0),'CENTER'),
-                                    ('BACKGROUND',(0,0),(-1,0),(0.75,0.75,0.75)),
-                                    ('GRID',(0,0),(-1,-1),0.25,(0,0,0))])
+                              style=HEADER_TABLE_STYLE)
                     else:
                         lineText="<bullet>b.</bullet>Did this LEA use GEER funds to provide home Internet access for any students? N"
-                        line=Paragraph(lineText, style=GEER_APR.styles["BL2"])
+                        line=self._static_paragraph(lineText, "BL2")
                         leaFlowables.append(line)
                     
                 if sub.usedFundsToAssistDisadvantaged:
@@ -349,12 +429,12 @@ class GEER_APR:
                                  "disabilities, English learners, racial and "+
                                  "ethnic minorities, students experiencing "+
                                  "homelessness, and foster care youth. ")
-                    line=Paragraph(lineText, style=GEER_APR.styles["BL1"])
+                    line=self._static_paragraph(lineText, "BL1")
                     leaFlowables.append(line)
                 if sub.usedFundsForMentalHealth:
                     lineText=("<bullet>3.</bullet>Providing mental health services and "+
                                  "supports. ")
-                    line=Paragraph(lineText, style=GEER_APR.styles["BL1"])
+                    line=self._static_paragraph(lineText, "BL1")
                     leaFlowables.append(line)
                 if sub.usedFundsForSanitization:
                     lineText=("<bullet>4.</bullet>Sanitization and minimizing the spread "+
@@ -362,12 +442,12 @@ class GEER_APR:
                                  "supplies and staff training to address "+
                                  "sanitization and minimizing the spread of "+
                                  "infectious diseases. ")
-                    line=Paragraph(lineText, style=GEER_APR.styles["BL1"])
+                    line=self._static_paragraph(lineText, "BL1")
                     leaFlowables.append(line)
                 if sub.usedFundsForSummerAndAfterSchool:
                     lineText=("<bullet>5.</bullet>Summer learning and supplemental "+
                                  "afterschool programs. ")
-                    line=Paragraph(lineText, style=GEER_APR.styles["BL1"])
+                    line=self._static_paragraph(lineText, "BL1")
                     leaFlowables.append(line)
                 if sub.usedFundsForOther:
                     lineText=("<bullet>6.</bullet>Other (uses of funds not included above)."+
@@ -375,21 +455,22 @@ class GEER_APR:
                     line=Paragraph(lineText, style=GEER_APR.styles["BL1"])
                     leaFlowables.append(line)
                 fteValues.append([sub.leaName,sub.dunsNumber,sub.ftePositionsAsOf09302018,sub.ftePositionsAsOf09302019,sub.ftePositionsAsOf03132020,sub.ftePositionsAsOf09302020])
+                if self.table_mode == 'long':
+                    self._add_long_table_rows(fteFlowables, fteValues, 'FTE')
             if sub.iheName:
                 lineText=f"<b>IHE Name:</b> {sub.iheName}"
                 line=Paragraph(lineText, style=GEER_APR.styles["Normal"])
                 table = Table([[line]],
                               spaceBefore=9,
-                              style=[('BACKGROUND',(0,0),(-1,0),(0.85,0.85,0.85)),
-                                     ('GRID',(0,0),(-1,-1),0.25,(0,0,0))])
+                              style=NAME_TABLE_STYLE)
                 iheFlowables.append(table)
                 lineText=f"<b>DUNS #:</b> {sub.dunsNumber}"
                 line=Paragraph(lineText, style=GEER_APR.styles["Normal"])
                 iheFlowables.append(line)
-                heading1 = Paragraph("<b>Amount awarded to the IHE</b>",style=GEER_APR.styles["Normal"])
-                heading2 = Paragraph("<b>Amount expended by the IHE</b>",style=GEER_APR.styles["Normal"])
-                heading3 = Paragraph("<b>Amount of expended funds used by the IHE to provide student financial aid grants</b>",style=GEER_APR.styles["Normal"])
-                heading4 = Paragraph("<b>Number students who received financial aid grants as result of GEER funds</b>",style=GEER_APR.styles["Normal"])
+                heading1 = self._static_paragraph("<b>Amount awarded to the IHE</b>", "Normal")
+                heading2 = self._static_paragraph("<b>Amount expended by the IHE</b>", "Normal")
+                heading3 = self._static_paragraph("<b>Amount of expended funds used by the IHE to provide student financial aid grants</b>", "Normal")
+                heading4 = self._static_paragraph("<b>Number students who received financial aid grants as result of GEER funds</b>", "Normal")
                 tableContent = [[heading1,heading2,heading3, heading4],
                                 [f"${sub.awardedAmount:,.2f}" if sub.awardedAmount else '', 
                                 f"${sub.fundsExpendedByIhe:,.2f}" if sub.fundsExpendedByIhe else '', 
@@ -398,29 +479,28 @@ class GEER_APR:
                 table = Table(tableContent,
                               spaceBefore=6,
                               spaceAfter=6,
-                              style=[('ALIGN',(0,0),(-1,0),'CENTER'),
-                                    ('BACKGROUND',(0,0),(-1,0),(0.75,0.75,0.75)),
-                                    ('GRID',(0,0),(-1,-1),0.25,(0,0,0))])
+                              style=HEADER_TABLE_STYLE)
                 iheFlowables.append(table)
                 fteValues.append([sub.iheName,sub.dunsNumber,sub.ftePositionsAsOf09302018,sub.ftePositionsAsOf09302019,sub.ftePositionsAsOf03132020,sub.ftePositionsAsOf09302020])
+                if self.table_mode == 'long':
+                    self._add_long_table_rows(fteFlowables, fteValues, 'FTE')
             if sub.entityName:
                 lineText=f"<b>Other Education-Related Entity:</b> {sub.entityName}"
                 line=Paragraph(lineText, style=GEER_APR.styles["Normal"])
                 table = Table([[line]],
                               spaceBefore=9,
-                              style=[('BACKGROUND',(0,0),(-1,0),(0.85,0.85,0.85)),
-                                     ('GRID',(0,0),(-1,-1),0.25,(0,0,0))])
+                              style=NAME_TABLE_STYLE)
                 entityFlowables.append(table)
                 lineText=f"<b>DUNS #:</b> {sub.dunsNumber}"
                 line=Paragraph(lineText, style=GEER_APR.styles["Normal"])
                 entityFlowables.append(line)
-                heading1 = Paragraph("<b>Amount awarded to Entity</b>",style=GEER_APR.styles["Normal"])
-                heading2 = Paragraph("<b>Amount expended by the Entity</b>",style=GEER_APR.styles["Normal"])
-                heading3 = Paragraph("<b>Served Pre-K</b>",style=GEER_APR.styles["Normal"])
-                heading4 = Paragraph("<b>Served K-12</b>",style=GEER_APR.styles["Normal"])
-                heading4 = Paragraph("<b>Served Post-Sec</b>",style=GEER_APR.styles["Normal"])
-                heading5 = Paragraph("<b>Supporting distance-learning and remote education</b>",style=GEER_APR.styles["Normal"])
-                heading6 = Paragraph("<b>Direct financial support of students (e.g. scholarships)</b>",style=GEER_APR.styles["Normal"])
+                heading1 = self._static_paragraph("<b>Amount awarded to Entity</b>", "Normal")
+                heading2 = self._static_paragraph("<b>Amount expended by the Entity</b>", "Normal")
+                heading3 = self._static_paragraph("<b>Served Pre-K</b>", "Normal")
+                heading4 = self._static_paragraph("<b>Served K-12</b>", "Normal")
+                heading4 = self._static_paragraph("<b>Served Post-Sec</b>", "Normal")
+                heading5 = self._static_paragraph("<b>Supporting distance-learning and remote education</b>", "Normal")
+                heading6 = self._static_paragraph("<b>Direct financial support of students (e.g. scholarships)</b>", "Normal")
                 isPreK = 'Y' if sub.isPreKServed else 'N'
                 isK12 = 'Y' if sub.isK12Served else 'N'
                 isPost = 'Y' if sub.isPostSecServed else 'N'
@@ -433,18 +513,19 @@ class GEER_APR:
                 table = Table(tableContent,
                               spaceBefore=6,
                               spaceAfter=6,
-                              style=[('ALIGN',(0,0),(-1,0),'CENTER'),
-                                    ('BACKGROUND',(0,0),(-1,0),(0.75,0.75,0.75)),
-                                    ('GRID',(0,0),(-1,-1),0.25,(0,0,0))])
+                              style=HEADER_TABLE_STYLE)
                 entityFlowables.append(table)
                 fteValues.append([sub.entityName,sub.dunsNumber,sub.ftePositionsAsOf09302018,sub.ftePositionsAsOf09302019,sub.ftePositionsAsOf03132020,sub.ftePositionsAsOf09302020])
-                table = Table(fteValues,
-                              spaceBefore=9,
-                              spaceAfter=6,
-                              style=[('ALIGN',(0,0),(-1,0),'CENTER'),
-                                    ('BACKGROUND',(0,0),(-1,0),(0.75,0.75,0.75)),
-                                    ('GRID',(0,0),(-1,-1),0.25,(0,0,0))])
-                fteFlowables.append(table)
+                if self.table_mode == 'long':
+                    self._add_long_table_rows(fteFlowables, fteValues, 'FTE')
+                else:
+                    table = Table(fteValues,
+                                  spaceBefore=9,
+                                  spaceAfter=6,
+                                  style=HEADER_TABLE_STYLE)
+                    fteFlowables.append(table)
+        if self.table_mode == 'long':
+            self._add_long_table_rows(fteFlowables, fteValues, 'FTE', final=True)
 
         return leaFlowables+iheFlowables+entityFlowables+fteFlowables
 
@@ -453,6 +534,8 @@ class GEER_APR:
     def generate(self, row: GEER_Grantee, subs: List[GEER_Subgrantee]):
         # Name the PDF after the grantee and grant PR Number
         pdfName = row.stateCode + '-' + row.prNumber + ".pdf"
+        self.layout_times.clear()
+        self.table_counts.clear()
         pdf = SimpleDocTemplate(pdfName,
                                 pagesize=letter,
                                 rightMargin=36,
@@ -464,21 +547,19 @@ class GEER_APR:
 
         introText = ("Education Stabilization Fund--Governor's Emergency "+
                      "Education Relief Fund")
-        introParagraph = Paragraph(introText, style=GEER_APR.styles["Title"])
+        introParagraph = self._static_paragraph(introText, "Title")
         flowables.append(introParagraph)
 
         introText = "(GEER Fund) Recipient Reporting Data Collection Form"
-        introParagraph = Paragraph(introText, style=GEER_APR.styles["Title"])
+        introParagraph = self._static_paragraph(introText, "Title")
         flowables.append(introParagraph)
 
         introText = "Final Version: December 2020"
-        oos = GEER_APR.styles["Centered"]
-        oos.spaceAfter=9
-        introParagraph = Paragraph(introText,style=oos)
+        introParagraph = self._static_paragraph(introText, "Centered")
         flowables.append(introParagraph)
 
         headingText="GEER Fund Reporting Form"
-        heading=Paragraph(headingText, style=GEER_APR.styles["Heading1"])
+        heading=self._static_paragraph(headingText, "Heading1")
         flowables.append(heading)
 
         lineText=f"State: {row.stateCode}"
@@ -516,14 +597,12 @@ class GEER_APR:
                   "ESF-Governors. To fulfill the annual GEER fund reporting "+
                   "requirements, answer all questions based on the reporting "+
                   "period shown in the Annual Reporting table below.")
-        oos = GEER_APR.styles["Normal"]
-        oos.spaceBefore=9
-        line=Paragraph(lineText, style=oos)
+        line=self._static_paragraph(lineText, "Normal")
         flowables.append(line)
 
         lineText=("<b>Annual Reporting: This report should be completed based "+
                   "on activities in the applicable reporting periods.</b>")
-        line=Paragraph(lineText, style=GEER_APR.styles["Normal"])
+        line=self._static_paragraph(lineText, "Normal")
         flowables.append(line)
 
         reportingPeriods = [["Annual Report",
@@ -541,9 +620,7 @@ class GEER_APR:
         table = Table(reportingPeriods,
                       spaceBefore=18,
                       spaceAfter=18,
-                      style=[('ALIGN',(0,0),(-1,0),'CENTER'),
-                            ('BACKGROUND',(0,0),(-1,0),(0.75,0.75,0.75)),
-                            ('GRID',(0,0),(-1,-1),0.25,(0,0,0))])
+                      style=HEADER_TABLE_STYLE)
         flowables.append(table)
 
         lineText = ("The total grant amount allocated to the State is "+
@@ -558,9 +635,7 @@ class GEER_APR:
         
         lineText = ("1. Which types of entities within the State were awarded "+
                    "Governors Emergency Education Relief (GEER) funds?")
-        oos=GEER_APR.styles["Normal"]
-        oos.spaceBefore=9
-        line=Paragraph(lineText, style=oos)
+        line=self._static_paragraph(lineText, "Normal")
         flowables.append(line)
 
         answer = 'Y' if row.areLeasAwardedGeerFunds else 'N'
@@ -586,7 +661,7 @@ class GEER_APR:
                        "requirements on GEER awards for LEAs to ensure that "+
                        "the funds were spent on specific purposes or "+
                        "activities? Y")
-            line=Paragraph(lineText, style=GEER_APR.styles["Normal"])
+            line=self._static_paragraph(lineText, "Normal")
             flowables.append(line)
 
             if row.isStateLeaGeerAwardConditionChanges:
@@ -599,24 +674,24 @@ class GEER_APR:
                            "State’s LEA GEER award conditions or requirements "+
                            "since the State’s initial 45-day report to the "+
                            "Department of Education? N")
-            line=Paragraph(lineText, style=GEER_APR.styles["BL2"])
+            line=self._static_paragraph(lineText, "BL2")
             flowables.append(line)
             if row.didStatePlaceDistanceLearningConditionsOnLeas:
                 lineText=("<bullet>b.</bullet>Did the State place any funding "+
                           "conditions or requirements directing LEAs to use "+
                           "the funds for activities related to "+
                           "distance-learning and remote education? Y")
-                line=Paragraph(lineText, style=GEER_APR.styles["BL2"])
+                line=self._static_paragraph(lineText, "BL2")
                 flowables.append(line)
                 lineText=("<bullet>ii.</bullet>If yes, what were the "+
                           "directed activities?")
-                line=Paragraph(lineText, style=GEER_APR.styles["BL3"])
+                line=self._static_paragraph(lineText, "BL3")
                 flowables.append(line)
                 if row.isSupportTechInfrastructureForIheDistanceLearning:
                     lineText=("<bullet>&bull;</bullet>Support access to the "+
                               "technology infrastructure required for distance"+
                               "education: Y. If yes,")
-                    line=Paragraph(lineText, style=GEER_APR.styles["BL4"])
+                    line=self._static_paragraph(lineText, "BL4")
                     flowables.append(line)
                     answer='Y' if row.isInternetAccessNeededForLeas else 'N'
                     lineText=("<bullet>&bull;</bullet>For Internet Access: "+
@@ -631,7 +706,7 @@ class GEER_APR:
                     lineText=("<bullet>&bull;</bullet>Support access to the "+
                               "technology infrastructure required for distance"+
                               "education: N.")
-                    line=Paragraph(lineText, style=GEER_APR.styles["BL4"])
+                    line=self._static_paragraph(lineText, "BL4")
                     flowables.append(line)
                 answer='Y' if row.isTrainingStaffNeededForLeas else 'N'
                 lineText=("<bullet>&bull;</bullet>Training staff/faculty for "+
@@ -649,21 +724,21 @@ class GEER_APR:
                               f"{row.otherConditionsForLeas}")
                 else:
                     lineText="Other: N."
-                line=Paragraph(lineText, style=GEER_APR.styles["BL4"])
+                line=self._static_paragraph(lineText, "BL4")
                 flowables.append(line)
             else:
                 lineText=("<bullet>b.</bullet>Did the State place any funding"+
                           "conditions or requirements directing LEAs to use the"+
                           "funds for activities related to distance-learning "+
                           "and remote education? N")
-                line=Paragraph(lineText, style=GEER_APR.styles["BL2"])
+                line=self._static_paragraph(lineText, "BL2")
                 flowables.append(line)
         else:
             lineText = ("2. Did the State place any funding conditions or "+
                         "requirements on GEER awards for LEAs to ensure that"+
                         "the funds were spent on specific purposes or "+
                         "activities? N")
-            line=Paragraph(lineText, style=GEER_APR.styles["Normal"])
+            line=self._static_paragraph(lineText, "Normal")
             flowables.append(line)
 
         if row.wereAnyConditionsPlacedByStateForIheFunds:
@@ -671,7 +746,7 @@ class GEER_APR:
                       "requirements on GEER awards for IHEs to ensure that "+
                       "the funds were spent on specific purposes or "+
                       "activities? Y If yes,")
-            line=Paragraph(lineText, style=GEER_APR.styles["Normal"])
+            line=self._static_paragraph(lineText, "Normal")
             flowables.append(line)
             if row.isStateIheGeerAwardConditionChanges:
                 lineText=("<bullet>a.</bullet>Were there any changes to the "+
@@ -684,24 +759,24 @@ class GEER_APR:
                           "State’s IHE GEER award conditions or requirements "+
                           "since the State’s initial 45-day report to the "+
                           "Department of Education? N")
-            line=Paragraph(lineText, style=GEER_APR.styles["BL1"])
+            line=self._static_paragraph(lineText, "BL1")
             flowables.append(line)
             if row.didStatePlaceDistanceLearningConditionsOnIhes:
                 lineText=("<bullet>b.</bullet>Did the State place any funding "+
                           "conditions or requirements directing IHEs to use "+
                           "the funds for activities related to "+
                           "distance-learning and remote education? Y")
-                line=Paragraph(lineText, style=GEER_APR.styles["BL1"])
+                line=self._static_paragraph(lineText, "BL1")
                 flowables.append(line)
                 lineText=("<bullet>ii.</bullet>If yes, what were the directed "+
                           "activities?")
-                line=Paragraph(lineText, style=GEER_APR.styles["BL2"])
+                line=self._static_paragraph(lineText, "BL2")
                 flowables.append(line)
                 if row.isSupportTechInfrastructureForIheDistanceLearning:
                     lineText=("<bullet>&bull;</bullet>Support access to the "+
                               "technology infrastructure required for distance"+
                               "education: Y. If yes,")
-                    line=Paragraph(lineText, style=GEER_APR.styles["BL3"])
+                    line=self._static_paragraph(lineText, "BL3")
                     flowables.append(line)
                     answer='Y' if row.isInternetAccessNeededForIhes else 'N'
                     lineText=("<bullet>&bull;</bullet>For Internet Access: "+
@@ -716,7 +791,7 @@ class GEER_APR:
                     lineText=("<bullet>&bull;</bullet>Support access to the "+
                               "technology infrastructure required for "+
                               "distance education: N.")
-                    line=Paragraph(lineText, style=GEER_APR.styles["BL3"])
+                    line=self._static_paragraph(lineText, "BL3")
                     flowables.append(line)
                 answer='Y' if row.isTrainingStaffNeededForIhes else 'N'
                 lineText=("<bullet>&bull;</bullet>Training staff/faculty for"+
@@ -733,7 +808,7 @@ class GEER_APR:
                               f"specify: {row.otherConditionsForIhes}")
                 else:
                     lineText="<bullet>&bull;</bullet>Other: N"
-                line=Paragraph(lineText, style=GEER_APR.styles["BL3"])
+                line=self._static_paragraph(lineText, "BL3")
                 flowables.append(line)
                 answer='Y' if row.didStateDirectAnyIhesToUseGeerFundsForEmergency else 'N'
                 lineText=("<bullet>c.</bullet>Did the State direct any IHEs "+
@@ -746,42 +821,37 @@ class GEER_APR:
                           "conditions or requirements directing IHEs to use "+
                           "the funds for activities related to "+
                           "distance-learning and remote education? N")
-                line=Paragraph(lineText, style=GEER_APR.styles["BL1"])
+                line=self._static_paragraph(lineText, "BL1")
                 flowables.append(line)
         else:
             lineText=("3. Did the State place any funding conditions or "+
                       "requirements on GEER awards for IHEs to ensure that "+
                       "the funds were spent on specific purposes or "+
                       "activities? N")
-            line=Paragraph(lineText, style=GEER_APR.styles["Normal"])
+            line=self._static_paragraph(lineText, "Normal")
             flowables.append(line)
 
         # Insert Sub Grantees content here
         flowables.extend(self.generate_subaward_content(subs))
 
         lineText="8. In the table below, indicate the number of K-12 schools (public and non-public) that received GEER funds or received services paid for with GEER funds."
-        line=Paragraph(lineText, style=GEER_APR.styles["Normal"])
+        line=self._static_paragraph(lineText, "Normal")
         flowables.append(line)
-        heading1=Paragraph("<b>School Type</b>", style=GEER_APR.styles["Normal"])
-        heading2=Paragraph("<b>K-12 schools</b>", style=GEER_APR.styles["Normal"])
-        label1=Paragraph("<b>Public Schools</b>", style=GEER_APR.styles["Normal"])
-        label2=Paragraph("<b>Non-public Schools</b>", style=GEER_APR.styles["Normal"])
+        heading1=self._static_paragraph("<b>School Type</b>", "Normal")
+        heading2=self._static_paragraph("<b>K-12 schools</b>", "Normal")
+        label1=self._static_paragraph("<b>Public Schools</b>", "Normal")
+        label2=self._static_paragraph("<b>Non-public Schools</b>", "Normal")
         tableContent=[[heading1, heading2],
                       [label1,f"{row.numberOfPublicSchoolsReceivedGeerFunds}"],
                       [label2,f"{row.numberOfNonPublicSchoolsReceivedGeerFunds}"]]
         table = Table(tableContent,
                       spaceBefore=9,
                       spaceAfter=18,
-                      style=[('ALIGN',(0,0),(-1,0),'CENTER'),
-                            ('BACKGROUND',(0,0),(-1,0),(0.75,0.75,0.75)),
-                            ('BACKGROUND',(0,1),(0,-1),(0.75,0.75,0.75)),
-                            ('GRID',(0,0),(-1,-1),0.25,(0,0,0))])
+                      style=LABELED_TABLE_STYLE)
         flowables.append(table)
 
         lineText="Burden Statement"
-        oos=GEER_APR.styles["Heading1"]
-        oos.spaceBefore=0.5*inch
-        line=Paragraph(lineText, style=oos)
+        line=self._static_paragraph(lineText, "Heading1")
         flowables.append(line)
         lineText=("According to the Paperwork Reduction Act of 1995, no "+
                   "persons are required to respond to a collection of "+
@@ -801,11 +871,14 @@ class GEER_APR:
                   "the status of your individual form, please contact Joanne "+
                   "Bogart, US. Department of Education, 400 Maryland Avenue, "+
                   "SW, Washington, DC 20202.")
-        line=Paragraph(lineText, style=GEER_APR.styles["Normal"])
+        line=self._static_paragraph(lineText, "Normal")
         flowables.append(line)
 
         logging.info('Building document')
         pdf.build(flowables,onFirstPage=self._header_footer,
                   onLaterPages=self._header_footer)
+        for label, seconds in self.layout_times.items():
+            logging.info(f'{pdfName}: {label} laid out in {seconds:.3f} seconds')
+        return pdfName
 
     
@@ -14,20 +14,35 @@ Use the --help command line argument to get a full list of arguments.
 """
 
 import argparse
+from contextlib import nullcontext
+import cProfile
 import datetime
+import io
 import logging
 import glob
 import json
 import os
 import pathlib
+import queue
 import sys
-from typing import List, Iterator
+import threading
+import time
+from typing import Iterable, List, Iterator
 
 from jsonschema import validate,SchemaError,ValidationError
 import openpyxl
 from jinja2 import Environment, FileSystemLoader, Template, select_autoescape, UndefinedError, TemplateAssertionError
 
 from esf_workbook_actions import APRWorkbookList, ESF_APR
+from esf_run_metrics import RunMetrics
+from esf_memory_profile import MemoryProfiler, stage
+from esf_columnar import ColumnarExporter, EXPORT_FORMATS
+from esf_checks import check_rules, write_violations
+from esf_computed_fields import compute_fields
+from esf_table_rows import TableRowsExtension
+from esf_template_fields import prune_config, template_field_usage, unused_fields
+from esf_s3_datafile import DEFAULT_CACHE_DIR, DEFAULT_MEMORY_LIMIT, fetch_s3_datafile, is_s3_uri
+from s3client import DEFAULT_PROFILE as DEFAULT_AWS_PROFILE, get_client
 
 _DEFAULT_SCHEMA = "aprMap.schema.json"
 
@@ -51,6 +66,25 @@ def get_latest_apr_file(datafile_pattern: str) -> pathlib.Path:
 
     return latest_file
 
+def get_datafile(datafile_pattern: str, endpoint_url: str = None, aws_profile: str = None,
+                 cache_dir: pathlib.Path = pathlib.Path(DEFAULT_CACHE_DIR),
+                 memory_limit: int = DEFAULT_MEMORY_LIMIT):
+    """Find the datafile for a datafile pattern, which is either a local filename glob pattern
+    or an s3://bucket/key-pattern URI. Returns a path or an in-memory file for the workbook
+    loader, or None if no datafile matches."""
+    if not is_s3_uri(datafile_pattern):
+        return get_latest_apr_file(datafile_pattern)
+    try:
+        client = get_client(profile=aws_profile, endpoint_url=endpoint_url)
+        return fetch_s3_datafile(client, datafile_pattern, cache_dir=cache_dir, memory_limit=memory_limit)
+    except Exception as e:
+        logging.error(f'Error retrieving datafile {datafile_pattern} from cloud storage.', exc_info=e)
+        return None
+
+def datafile_name(apr_file) -> str:
+    # In-memory datafiles are named by their cloud storage URI.
+    return apr_file.name if isinstance(apr_file, io.BytesIO) else str(apr_file)
+
 def generate_apr(temp : Template, apr : ESF_APR) -> Iterator[str]:
     try:
         return temp.generate(apr = apr)
@@ -58,14 +92,198 @@ def generate_apr(temp : Template, apr : ESF_APR) -> Iterator[str]:
         logging.error(f'Exception encountered generating APR for {apr.output_file_base_name}', exc_info=e)
         return None
 
-def store_html(apr_html: Iterator[str], filename: pathlib.Path) -> None:
+def render_apr(temp : Template, apr : ESF_APR) -> str:
+    """Render the complete HTML for an APR, returning None if rendering fails."""
+    apr_html = generate_apr(temp=temp, apr=apr)
+    if apr_html is None:
+        return None
+    try:
+        return ''.join(apr_html)
+    except Exception as e:
+        logging.error(f'Exception encountered rendering APR for {apr.output_file_base_name}', exc_info=e)
+        return None
+
+def store_html(apr_html: Iterator[str], filename: pathlib.Path) -> int:
+    """Write the HTML to the named file, returning the number of bytes stored or None on failure."""
     try:
         with filename.open(mode="wt", encoding="utf-8") as hfp:
             for html_line in apr_html:
                 hfp.write(html_line)
+        return filename.stat().st_size
     except Exception as e:
         logging.error(f'Exception encountered storing HTML file {filename}.', exc_info=e)
-        return
+        return None
+
+def generate_aprs(aprs: Iterable[ESF_APR], temp: Template, outdir: pathlib.Path, metrics: RunMetrics = None,
+                  memory: MemoryProfiler = None) -> List[pathlib.Path]:
+    """Render and store the HTML file for each APR in the workbook list,
+    returning the paths of the files stored.
+    When metrics are collected, the render and write times and the output size
+    are recorded for each grantee. When memory is profiled, rendering and writing
+    are recorded as the 'render' and 'write' stages."""
+    stored = []
+    for apr in aprs:
+        if apr is None:
+            continue
+        print(f'Generating HTML APR {apr.output_file_base_name}')
+        start = time.perf_counter()
+        with stage(memory, 'render'):
+            apr_html = render_apr(temp=temp, apr=apr)
+        render_seconds = time.perf_counter() - start
+        if apr_html is None:
+            continue
+        if metrics is not None:
+            metrics.add_phase('render', render_seconds)
+            metrics.grantee(apr.output_file_base_name).update(render_seconds=render_seconds)
+
+        with stage(memory, 'write'):
+            html_path = _write_apr(apr.output_file_base_name, apr_html, outdir, metrics)
+        if html_path is not None:
+            stored.append(html_path)
+    return stored
+
+def _html_path(output_file_base_name: str, outdir: pathlib.Path) -> pathlib.Path:
+    html_path = pathlib.Path(output_file_base_name).with_suffix('.html')
+    if outdir:
+        # Prepend the output directory name to the base file name.
+        html_path = outdir / html_path
+    return html_path
+
+def _write_apr(output_file_base_name: str, apr_html: str, outdir: pathlib.Path, metrics: RunMetrics = None) -> pathlib.Path:
+    """Store the HTML for an APR, returning the path stored or None on failure."""
+    start = time.perf_counter()
+    html_path = _html_path(output_file_base_name, outdir)
+    output_bytes = store_html((apr_html,), html_path)
+    write_seconds = time.perf_counter() - start
+    if metrics is not None:
+        metrics.add_phase('write', write_seconds)
+        metrics.grantee(output_file_base_name).update(
+            write_seconds=write_seconds,
+            output_bytes=output_bytes)
+    if output_bytes is None:
+        return None
+    return html_path
+
+def generate_aprs_pipelined(aprs: Iterable[ESF_APR], temp: Template, outdir: pathlib.Path,
+                            queue_depth: int = 8, writers: int = 2, metrics: RunMetrics = None) -> List[pathlib.Path]:
+    """Extract, render and store APRs as overlapping stages connected by bounded queues.
+
+    Extraction runs in the calling thread, since openpyxl read-only workbooks must not
+    be shared between threads. A single thread renders the templates, and the passed
+    number of writer threads store the HTML files. Each queue holds at most queue_depth
+    items, so a slow stage blocks the stages feeding it and memory use stays bounded.
+    Files are written in whatever order the writers finish, and the paths of the
+    files stored are returned in that order."""
+    stored = []
+    render_queue = queue.Queue(maxsize=queue_depth)
+    write_queue = queue.Queue(maxsize=queue_depth)
+
+    def render_stage():
+        try:
+            while True:
+                apr = render_queue.get()
+                if apr is None:
+                    break
+                start = time.perf_counter()
+                apr_html = render_apr(temp=temp, apr=apr)
+                render_seconds = time.perf_counter() - start
+                if apr_html is None:
+                    continue
+                if metrics is not None:
+                    metrics.add_phase('render', render_seconds)
+                    metrics.grantee(apr.output_file_base_name).update(render_seconds=render_seconds)
+                write_queue.put((apr.output_file_base_name, apr_html))
+        except Exception as e:
+            logging.error('Exception encountered in the render stage.', exc_info=e)
+            # Keep draining the render queue so extraction is never blocked indefinitely.
+            while render_queue.get() is not None:
+                pass
+        finally:
+            for _ in range(writers):
+                write_queue.put(None)
+
+    def write_stage():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            output_file_base_name, apr_html = item
+            html_path = _write_apr(output_file_base_name, apr_html, outdir, metrics)
+            if html_path is not None:
+                stored.append(html_path)
+
+    threads = [threading.Thread(target=render_stage, name='render')]
+    threads.extend(threading.Thread(target=write_stage, name=f'write-{i}') for i in range(writers))
+    for thread in threads:
+        thread.start()
+    try:
+        for apr in aprs:
+            if apr is None:
+                continue
+            print(f'Generating HTML APR {apr.output_file_base_name}')
+            render_queue.put(apr)
+    finally:
+        render_queue.put(None)
+        for thread in threads:
+            thread.join()
+    return stored
+
+def parse_shard(value: str) -> tuple:
+    """Parse a shard specification of the form i/N, where 0 <= i < N."""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Shard {value} must have the form i/N.')
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'Shard index in {value} must be between 0 and {count - 1}.')
+    return index, count
+
+def write_shard_manifest(filename: pathlib.Path, config_name: str, config: dict, apr_file,
+                         aprs: APRWorkbookList, shard: tuple, weighted: bool, stored: List[pathlib.Path]) -> None:
+    """Record which grantees a shard generated, for checking with merge_shard_manifests.py."""
+    manifest = {
+        'config': config_name,
+        'subfund': config['subfund'],
+        'reporting_year': config['reporting_year'],
+        'datafile': datafile_name(apr_file),
+        'datafile_size': apr_file.getbuffer().nbytes if isinstance(apr_file, io.BytesIO) else apr_file.stat().st_size,
+        'shard_index': shard[0],
+        'shard_count': shard[1],
+        'weighted': weighted,
+        'all_keys': aprs.all_keys,
+        'keys': aprs.shard_keys,
+        'outputs': [str(path) for path in stored],
+    }
+    try:
+        with pathlib.Path(filename).open(mode='wt', encoding='utf-8') as mfp:
+            json.dump(manifest, mfp, indent=2, default=str)
+    except Exception as e:
+        logging.error(f'Exception encountered storing shard manifest {filename}.', exc_info=e)
+
+def prune_unused_fields(env: Environment, config: dict) -> dict:
+    """Return a copy of the configuration mapping only the fields the configured template
+    uses, warning about the mapped fields it never uses. If the template can not be
+    analyzed, the configuration is returned unchanged."""
+    try:
+        usage = template_field_usage(env, config['template_name'], config)
+    except Exception as e:
+        logging.error(f"Error analyzing template {config['template_name']}; extracting every mapped field.", exc_info=e)
+        return config
+    unused = unused_fields(config, usage)
+    if unused:
+        logging.warning(f"{len(unused)} mapped fields are never used by {config['template_name']}: {', '.join(unused)}")
+    return prune_config(config, usage)
+
+def add_datafile_arguments(ap: argparse.ArgumentParser) -> None:
+    """Add the arguments for reading datafiles named by s3:// datafile patterns."""
+    ap.add_argument('--endpoint-url', default=os.getenv('AWS_ENDPOINT_URL'),
+        help='Endpoint URL of an S3-compatible service to use for s3:// datafile patterns, such as a local test server.')
+    ap.add_argument('--aws-profile', default=os.getenv('AWS_PROFILE', DEFAULT_AWS_PROFILE),
+        help='Profile name to use for cloud storage access with s3:// datafile patterns.')
+    ap.add_argument('--cache-dir', type=pathlib.Path, default=pathlib.Path(DEFAULT_CACHE_DIR),
+        help='Directory in which to cache datafiles from cloud storage that are too large to read into memory.')
+    ap.add_argument('--memory-limit', type=int, default=DEFAULT_MEMORY_LIMIT // (1024 * 1024),
+        help='Size in MB up to which datafiles from cloud storage are read into memory instead of cached.')
 
 def yes_no(value):
     try:
@@ -164,8 +382,57 @@ if __name__ == '__main__':
         help='The path to a schema to use for validating the configuration files.')
     ap.add_argument('-e','--encoding', default='utf-8',
         help="Use the specified encoding for the files.")
+    ap.add_argument('--report',
+        help='Write a JSON run report with per-phase and per-grantee timings to the named file.')
+    ap.add_argument('--prometheus',
+        help='Write the run metrics to the named file in Prometheus textfile collector format.')
+    ap.add_argument('--profile',
+        help='Write cProfile statistics for the run to the named file.')
+    ap.add_argument('--memory-report',
+        help='Trace memory use at each stage boundary and write a JSON memory report to the named file.')
+    ap.add_argument('--memory-top', type=int, default=10,
+        help='Number of top allocation sites to report for each stage in the memory report.')
+    ap.add_argument('--pipeline', action='store_true',
+        help='Run extraction, rendering and writing as overlapping stages connected by bounded queues.')
+    ap.add_argument('--queue-depth', type=int, default=8,
+        help='Maximum number of APRs waiting between pipeline stages.')
+    ap.add_argument('--writers', type=int, default=2,
+        help='Number of threads writing HTML files in pipeline mode.')
+    ap.add_argument('--shard', type=parse_shard,
+        help='Generate only the grantees assigned to shard i of N, given as i/N with i starting at 0.')
+    ap.add_argument('--shard-weighted', action='store_true',
+        help='Balance the shards by subaward row counts instead of assigning grantees by hash alone.')
+    ap.add_argument('--export-dir',
+        help='Also write the extracted APR data as columnar files in the named directory.')
+    ap.add_argument('--export-format', choices=EXPORT_FORMATS, default='csv',
+        help='Format of the columnar export files. Parquet requires the pyarrow package.')
+    ap.add_argument('--export-batch-size', type=int, default=500,
+        help='Number of rows to buffer for each table before writing them to the export files.')
+    ap.add_argument('--export-only', action='store_true',
+        help='Write only the columnar export files, without rendering HTML.')
+    ap.add_argument('--check',
+        help='Evaluate the consistency rules in the configuration before rendering, writing the violations to the named CSV or JSON file.')
+    ap.add_argument('--check-only', action='store_true',
+        help='Stop after evaluating the consistency rules.')
+    ap.add_argument('--prune-columns', action='store_true',
+        help='Extract only the mapped fields the template uses, warning about the mapped fields it never uses.')
+    ap.add_argument('--shard-manifest',
+        help='Name of the shard manifest file. Defaults to a name built from the subfund, reporting year and shard in the output directory.')
+    add_datafile_arguments(ap)
     args = ap.parse_args()
 
+    metrics = None
+    if args.report or args.prometheus:
+        metrics = RunMetrics()
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    memory = None
+    if args.memory_report:
+        memory = MemoryProfiler(top=args.memory_top)
+        memory.start()
+
     # Read the JSON schema and configuration file.
     with open(args.schema,'r',encoding=args.encoding) as sfp, open(args.config,'r',encoding=args.encoding) as ifp:
         schema = json.load(sfp)
@@ -186,16 +453,19 @@ if __name__ == '__main__':
                     outdir.mkdir(parents = True, exist_ok = True)
 
             # Find the latest file matching the datafile pattern in the configuration.
-            apr_file = get_latest_apr_file(config['datafile_pattern'])
+            apr_file = get_datafile(config['datafile_pattern'], endpoint_url=args.endpoint_url,
+                aws_profile=args.aws_profile, cache_dir=args.cache_dir, memory_limit=args.memory_limit * 1024 * 1024)
             if apr_file is None:
                 logging.error(f'No datafile found matching pattern {config["datafile_pattern"]}')
                 exit()
             else:
-                print(f'Using data file {apr_file}')
+                print(f'Using data file {datafile_name(apr_file)}')
 
             # Create the jinja2 environment for generating HTML files from templates.
             # Excplicitly turn off autoescaping to avoid interfering with inserting HTML character code references.
-            env = Environment(loader=FileSystemLoader(config['template_path']),autoescape=select_autoescape(enabled_extensions=(),default_for_string=False))
+            # The tablerows tag renders the rows of large subaward tables with a compiled row formatter.
+            env = Environment(loader=FileSystemLoader(config['template_path']),autoescape=select_autoescape(enabled_extensions=(),default_for_string=False),
+                              extensions=[TableRowsExtension])
 
             # Add custom filters for translating boolean values into "Yes" or "No" strings or checkboxes,
             # and for formatting dollar values and percentages
@@ -206,23 +476,79 @@ if __name__ == '__main__':
 
             temp = env.get_template(name=config['template_name'])
 
-            efp = openpyxl.load_workbook(filename=apr_file, read_only=True, data_only=True)
-            aprs = APRWorkbookList(wb=efp, config=config)
-            for apr in aprs:
-                if apr is None:
-                    continue
-                print(f'Generating HTML APR {apr.output_file_base_name}')
-                apr_html = generate_apr(temp=temp, apr=apr)
-                if apr_html is None:
-                    continue
-                html_path = pathlib.Path(apr.output_file_base_name).with_suffix('.html')
-                if outdir:
-                    # Prepend the output directory name to the base file name.
-                    html_path = outdir / html_path
-
-                store_html(apr_html, html_path)
+            if metrics is not None:
+                metrics.labels.update(subfund=config['subfund'], reporting_year=config['reporting_year'])
+            with metrics.phase('workbook_open') if metrics is not None else nullcontext(), stage(memory, 'workbook_open'):
+                efp = openpyxl.load_workbook(filename=apr_file, read_only=True, data_only=True)
+            if args.check or args.check_only:
+                with metrics.phase('check') if metrics is not None else nullcontext():
+                    violations = check_rules(efp, config)
+                print(f'Found {len(violations)} consistency rule violations.')
+                if args.check:
+                    write_violations(violations, args.check)
+                if args.check_only:
+                    exit()
+
+            apr_config = config
+            if args.prune_columns:
+                if args.export_dir or args.export_only:
+                    logging.warning('Columns are not pruned when exporting, since the export files hold every mapped field.')
+                else:
+                    apr_config = prune_unused_fields(env, config)
+            computed = None
+            if apr_config.get('computed'):
+                with metrics.phase('computed') if metrics is not None else nullcontext():
+                    computed = compute_fields(efp, apr_config)
+            aprs = APRWorkbookList(wb=efp, config=apr_config, metrics=metrics, memory=memory,
+                shard=args.shard, shard_weighted=args.shard_weighted, computed=computed)
+            apr_source = aprs
+            exporter = None
+            if args.export_dir or args.export_only:
+                exporter = ColumnarExporter(config, args.export_dir or outdir or pathlib.Path('.'),
+                    export_format=args.export_format, batch_size=args.export_batch_size, shard=args.shard)
+                apr_source = exporter.tee(aprs)
+            try:
+                if args.export_only:
+                    stored = []
+                    for apr in apr_source:
+                        if apr is not None:
+                            print(f'Exporting APR data {apr.output_file_base_name}')
+                elif args.pipeline:
+                    if memory is not None:
+                        logging.warning('Memory stages are not traced for rendering and writing in pipeline mode.')
+                    stored = generate_aprs_pipelined(apr_source, temp, outdir, queue_depth=max(args.queue_depth, 1),
+                        writers=max(args.writers, 1), metrics=metrics)
+                else:
+                    stored = generate_aprs(apr_source, temp, outdir, metrics=metrics, memory=memory)
+            finally:
+                if exporter is not None:
+                    for table_name, rows in exporter.close().items():
+                        print(f'Exported {rows} rows to the {table_name} table.')
+
+            if args.shard is not None:
+                manifest_path = args.shard_manifest
+                if manifest_path is None:
+                    manifest_path = pathlib.Path(
+                        f"{config['subfund']}-{config['reporting_year']}-shard-{args.shard[0]}-of-{args.shard[1]}.json")
+                    if outdir:
+                        manifest_path = outdir / manifest_path
+                write_shard_manifest(manifest_path, args.config, config, apr_file, aprs,
+                    args.shard, args.shard_weighted, stored)
 
         except SchemaError as se:
             logging.error("Schema error.", exc_info=se)
         except ValidationError as ve:
-            logging.error("Instance validation error.", exc_info=ve)
\ No newline at end of file
+            logging.error("Instance validation error.", exc_info=ve)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(args.profile)
+            if memory is not None:
+                memory.write_json(args.memory_report)
+                memory.stop()
+            if metrics is not None:
+                metrics.finish()
+                if args.report:
+                    metrics.write_json(args.report)
+                if args.prometheus:
+                    metrics.write_prometheus(args.prometheus)
\ No newline at end of file
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Python program for generating cross-grantee summaries of ESF APR data.
+
+Python command-line program for computing aggregate figures, such as
+national totals of the amounts allocated, expended and remaining, over
+all the grantees in the datafiles named by one or more APR
+configuration files. Every float and int typed column in the
+configuration's main and subs maps is read from the worksheets in a
+single pass and summed with NumPy, without building an APR object for
+each grantee.
+
+Figures are grouped by grantee key and by subfund, and subaward
+figures are also split by a boolean field (isLea by default). The
+summary is written as a CSV file in long format (one row per group and
+field), or rendered through a Jinja2 template. Each row carries the
+field's type and whether it holds an amount of money, so templates
+format dollar amounts apart from counts and FTEs. Month and day fields,
+such as the end of a fiscal year, are not summed.
+
+Use the --help command line argument to get a full list of arguments.
+
+@author: Keith.Tucker
+"""
+
+import argparse
+import csv
+import datetime
+import json
+import logging
+import os
+import pathlib
+import re
+import sys
+from typing import Dict, Iterator, List
+
+from jsonschema import validate,SchemaError,ValidationError
+import numpy as np
+import openpyxl
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+from esf_columns import read_columns, numeric_fields, group_aggregates
+from generate_esf_apr import add_datafile_arguments, datafile_name, get_datafile, yes_no, check, dollars, percent
+
+_DEFAULT_SCHEMA = "aprMap.schema.json"
+_DEFAULT_SPLIT_FIELD = "isLea"
+
+SUMMARY_COLUMNS = ['subfund', 'reporting_year', 'table', 'level', 'group', 'split', 'field', 'type', 'money', 'count', 'sum']
+
+# Calendar fields, such as esserFiscalEndMonth, whose totals mean nothing.
+_CALENDAR_FIELD = re.compile(r'(Month|Day)$')
+# Float fields holding counts, FTEs or ratios rather than amounts of money.
+_NON_MONEY_FIELD = re.compile(r'Fte|^fte|NumberEmployed|Proportion|Percent(?!\w*Amount)|Rate$')
+
+
+def summed_fields(field_map: List[dict]) -> List[dict]:
+    """Return the numeric fields of a field map to sum, leaving out calendar fields."""
+    return [field for field in numeric_fields(field_map) if not _CALENDAR_FIELD.search(field['name'])]
+
+
+def is_money(field: dict) -> bool:
+    """Return True if a numeric field holds an amount of money."""
+    return field.get('type') == 'float' and not _NON_MONEY_FIELD.search(field['name'])
+
+
+def _summary_rows(config: dict, table: str, keys: np.ndarray, columns: Dict[str, np.ndarray],
+                  fields: List[dict], split: str = '') -> Iterator[dict]:
+    """Aggregate the columns by grantee key and for the whole subfund, yielding one row per group and field."""
+    subfund = config['subfund']
+    fields_by_name = {field['name']: field for field in fields}
+    levels = (('grantee', keys), ('subfund', np.full(len(keys), subfund)))
+    for level, groups in levels:
+        unique, counts, sums = group_aggregates(groups, columns)
+        for position, group in enumerate(unique):
+            for name, total in sums.items():
+                yield {'subfund': subfund, 'reporting_year': config['reporting_year'],
+                       'table': table, 'level': level, 'group': str(group), 'split': split,
+                       'field': name, 'type': fields_by_name[name]['type'], 'money': is_money(fields_by_name[name]),
+                       'count': int(counts[position]), 'sum': float(total[position])}
+
+
+def summarize(config: dict, wb, split_field: str = _DEFAULT_SPLIT_FIELD) -> List[dict]:
+    """Compute the summary rows for the main worksheet and every child worksheet named in a configuration."""
+    rows = []
+    ws = wb[config['primary_grantee_worksheet_name']]
+    key_index = config['primary_grantee_key_worksheet_column'] - 1
+    fields = summed_fields(config['main'])
+    keys, columns = read_columns(ws, fields, key_index)
+    present = np.array([key is not None for key in keys], dtype=bool)
+    rows.extend(_summary_rows(config, 'main', keys[present].astype(str),
+                              {name: column[present] for name, column in columns.items()}, fields))
+
+    for sub in config.get('subs', ()):
+        for child in sub.get('children', ()):
+            field_map = child.get('field_map', ())
+            fields = summed_fields(field_map)
+            split = [field for field in field_map if field.get('name') == split_field and field.get('type') == 'bool']
+            keys, columns = read_columns(wb[child['worksheet_name']], fields + split[:1], child['key_offset'])
+            present = np.array([key is not None for key in keys], dtype=bool)
+            split_values = columns.pop(split_field, None) if split else None
+            table = f"{sub['name']}:{child['worksheet_name']}"
+            masks = [('', present)]
+            if split_values is not None:
+                masks.append((f'{split_field}=true', present & split_values))
+                masks.append((f'{split_field}=false', present & ~split_values))
+            for split_label, mask in masks:
+                rows.extend(_summary_rows(config, table, keys[mask].astype(str),
+                                          {name: column[mask] for name, column in columns.items()},
+                                          fields, split=split_label))
+    return rows
+
+
+def write_csv(rows: List[dict], filename: pathlib.Path) -> None:
+    with pathlib.Path(filename).open(mode='wt', encoding='utf-8', newline='') as cfp:
+        writer = csv.DictWriter(cfp, fieldnames=SUMMARY_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def render_summary(rows: List[dict], configs: List[dict], template_file: pathlib.Path, filename: pathlib.Path) -> None:
+    template_file = pathlib.Path(template_file)
+    env = Environment(loader=FileSystemLoader(str(template_file.parent)),
+                      autoescape=select_autoescape(enabled_extensions=(),default_for_string=False))
+    env.filters["yes_no"] = yes_no
+    env.filters["check"] = check
+    env.filters["dollars"] = dollars
+    env.filters["percent"] = percent
+    temp = env.get_template(name=template_file.name)
+    with pathlib.Path(filename).open(mode='wt', encoding='utf-8') as hfp:
+        for html_line in temp.generate(rows=rows, configs=configs,
+                                       generated=datetime.datetime.now(tz=datetime.timezone.utc)):
+            hfp.write(html_line)
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=os.environ.get("LOGLEVEL",logging.ERROR))
+
+    ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Generate cross-grantee summaries of the numeric APR data for the ESF grants.
+
+  One or more JSON configuration files name the datafiles and the columns to summarize.''')
+    ap.add_argument('config', nargs='+', help='Names of the configuration files specifying the APR data to summarize.')
+    ap.add_argument('-o','--output', required=True,
+        help='Name of the file to write. Without --template, the summary is written as CSV.')
+    ap.add_argument('-t','--template',
+        help='Path to a Jinja2 template for rendering the summary. The template receives the summary rows as "rows" and the configurations as "configs".')
+    ap.add_argument('--split-field', default=_DEFAULT_SPLIT_FIELD,
+        help='Name of a boolean subaward field by which to split the subaward figures.')
+    ap.add_argument('-s','--schema', default=_DEFAULT_SCHEMA,
+        help='The path to a schema to use for validating the configuration files.')
+    ap.add_argument('-e','--encoding', default='utf-8',
+        help="Use the specified encoding for the files.")
+    add_datafile_arguments(ap)
+    args = ap.parse_args()
+
+    with open(args.schema,'r',encoding=args.encoding) as sfp:
+        schema = json.load(sfp)
+
+    rows = []
+    configs = []
+    for config_name in args.config:
+        try:
+            with open(config_name,'r',encoding=args.encoding) as ifp:
+                config = json.load(ifp)
+            validate(instance=config,schema=schema)
+            apr_file = get_datafile(config['datafile_pattern'], endpoint_url=args.endpoint_url,
+                aws_profile=args.aws_profile, cache_dir=args.cache_dir, memory_limit=args.memory_limit * 1024 * 1024)
+            if apr_file is None:
+                logging.error(f'No datafile found matching pattern {config["datafile_pattern"]}')
+                continue
+            print(f'Summarizing data file {datafile_name(apr_file)}')
+            efp = openpyxl.load_workbook(filename=apr_file, read_only=True, data_only=True)
+            rows.extend(summarize(config, efp, split_field=args.split_field))
+            configs.append(config)
+        except SchemaError as se:
+            logging.error("Schema error.", exc_info=se)
+        except ValidationError as ve:
+            logging.error("Instance validation error.", exc_info=ve)
+
+    if not configs:
+        sys.exit(1)
+    if args.template:
+        render_summary(rows, configs, args.template, args.output)
+    else:
+        write_csv(rows, args.output)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Python program for checking the shard manifests of a sharded APR run.
+
+When generate_esf_apr.py runs with the --shard option, each node
+generates the APRs for its slice of the grantees and writes a shard
+manifest. This program reads the manifests from all the nodes and
+checks that together they cover every grantee exactly once, using the
+same configuration and datafile.
+
+Use the --help command line argument to get a full list of arguments.
+
+@author: Keith.Tucker
+"""
+
+import argparse
+import json
+import logging
+import os
+import pathlib
+import sys
+from typing import List
+
+
+def load_manifests(filenames: List[str]) -> List[dict]:
+    manifests = []
+    for filename in filenames:
+        with open(filename, 'r', encoding='utf-8') as mfp:
+            manifest = json.load(mfp)
+            manifest['manifest_file'] = str(filename)
+            manifests.append(manifest)
+    return manifests
+
+
+def check_manifests(manifests: List[dict]) -> List[str]:
+    """Return a list of problems found in the passed shard manifests. An empty list means the
+    shards agree on the run parameters and cover every grantee exactly once."""
+    problems = []
+    if not manifests:
+        return ['No shard manifests provided.']
+    first = manifests[0]
+    for field in ('config', 'subfund', 'reporting_year', 'datafile', 'datafile_size', 'shard_count', 'weighted', 'all_keys'):
+        for manifest in manifests[1:]:
+            if manifest.get(field) != first.get(field):
+                problems.append(f"{manifest['manifest_file']} has {field} {manifest.get(field)!r}, "
+                                f"but {first['manifest_file']} has {first.get(field)!r}.")
+
+    shard_count = first.get('shard_count')
+    seen_shards = {}
+    for manifest in manifests:
+        index = manifest.get('shard_index')
+        if index in seen_shards:
+            problems.append(f"Shard {index} appears in both {seen_shards[index]} and {manifest['manifest_file']}.")
+        else:
+            seen_shards[index] = manifest['manifest_file']
+    for index in range(shard_count or 0):
+        if index not in seen_shards:
+            problems.append(f'No manifest for shard {index} of {shard_count}.')
+
+    owners = {}
+    for manifest in manifests:
+        for key in manifest.get('keys') or ():
+            if key in owners:
+                problems.append(f"Grantee {key} generated by both shard {owners[key]} and shard {manifest.get('shard_index')}.")
+            else:
+                owners[key] = manifest.get('shard_index')
+    all_keys = first.get('all_keys') or []
+    for key in all_keys:
+        if key not in owners:
+            problems.append(f'Grantee {key} not generated by any shard.')
+    expected = set(all_keys)
+    for key in owners:
+        if key not in expected:
+            problems.append(f'Grantee {key} generated by shard {owners[key]} is not in the list of all grantees.')
+    return problems
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=os.environ.get("LOGLEVEL",logging.ERROR))
+
+    ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Check that the shard manifests of a sharded APR run cover every grantee exactly once.''')
+    ap.add_argument('manifest', nargs='+', help='Shard manifest files written by generate_esf_apr.py --shard.')
+    ap.add_argument('-o', '--output', help='Write a merged manifest listing all the outputs to the named file.')
+    args = ap.parse_args()
+
+    try:
+        manifests = load_manifests(args.manifest)
+    except Exception as e:
+        logging.error('Error reading shard manifests.', exc_info=e)
+        sys.exit(2)
+
+    problems = check_manifests(manifests)
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit(1)
+
+    first = manifests[0]
+    print(f"{len(first['all_keys'])} grantees covered exactly once by {first['shard_count']} shards.")
+    if args.output:
+        merged = {field: first[field] for field in ('config', 'subfund', 'reporting_year', 'datafile',
+                                                    'datafile_size', 'shard_count', 'weighted', 'all_keys')}
+        merged['shards'] = {manifest['shard_index']: manifest['keys'] for manifest in manifests}
+        merged['outputs'] = [output for manifest in manifests for output in manifest.get('outputs', ())]
+        with pathlib.Path(args.output).open(mode='wt', encoding='utf-8') as ofp:
+            json.dump(merged, ofp, indent=2)
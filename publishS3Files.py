@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Keith.Tucker
+
+Python command-line script for publishing generated APRs to cloud storage.
+
+This program uploads the files in one or more local folders (or in the
+output_path folders of APR configuration files) to an S3 bucket under a
+key prefix, several at a time. Files larger than the multipart threshold
+are uploaded in parts. The bucket prefix is listed once, and a file is
+skipped when its content matches the remote object: the MD5 of the file
+(or of its parts, for objects uploaded in parts) equals the object's
+ETag, or its SHA-256 equals the digest stored in the object's metadata
+when it was published. A publish manifest records the key, size,
+digests and action taken for every file.
+
+Parameters for the session and service connection can be obtained from
+the environment variables listed below.
+
+     AWS_ACCESS_KEY_ID
+     AWS_SECRET_ACCESS_KEY
+     AWS_PROFILE
+     AWS_DEFAULT_REGION
+     AWS_ENDPOINT_URL
+"""
+
+import argparse
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import datetime
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import pathlib
+import time
+
+from s3client import DEFAULT_PROFILE, DEFAULT_REGION, get_client
+
+DEFAULT_WORKERS = 8
+DEFAULT_INCLUDE = '*.html'
+PUBLISH_MANIFEST = 'publish-manifest.json'
+SHA256_METADATA = 'sha256'
+MB = 1024 * 1024
+READ_SIZE = MB
+
+def file_digests(path: pathlib.Path, part_size: int) -> dict:
+    """Compute, in one pass, a file's MD5, SHA-256, and the ETag S3 gives the file when
+    it is uploaded in parts of part_size bytes."""
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    part_digests = []
+    part = hashlib.md5()
+    part_length = 0
+    with path.open('rb') as f:
+        while block := f.read(READ_SIZE):
+            md5.update(block)
+            sha256.update(block)
+            while block:
+                taken = block[:part_size - part_length]
+                part.update(taken)
+                part_length += len(taken)
+                block = block[len(taken):]
+                if part_length == part_size:
+                    part_digests.append(part.digest())
+                    part = hashlib.md5()
+                    part_length = 0
+    if part_length:
+        part_digests.append(part.digest())
+    return {'md5': md5.hexdigest(), 'sha256': sha256.hexdigest(),
+            'multipart_etag': f'{hashlib.md5(b"".join(part_digests)).hexdigest()}-{len(part_digests)}'}
+
+def collect_files(directories, include_patterns) -> list:
+    """Return (file path, relative key) pairs for the files in the folders matching any include pattern.
+    Raises ValueError if files in different folders have the same relative key, since they would
+    be uploaded to the same object."""
+    files = {}
+    for directory in directories:
+        directory = pathlib.Path(directory)
+        for pattern in include_patterns:
+            for path in directory.rglob(pattern):
+                if path.is_file():
+                    # The same file reached through overlapping folders is published once.
+                    files.setdefault(path.resolve(), (path, path.relative_to(directory).as_posix()))
+    paths_by_key = {}
+    for path, key in files.values():
+        paths_by_key.setdefault(key, []).append(path)
+    duplicates = {key: paths for key, paths in paths_by_key.items() if len(paths) > 1}
+    if duplicates:
+        raise ValueError('Files in different folders would be published to the same key: ' +
+                         '; '.join(f"{key} ({', '.join(str(path) for path in paths)})" for key, paths in duplicates.items()))
+    return sorted(files.values())
+
+def list_remote(client, bucket_name: str, prefix: str) -> dict:
+    remote = {}
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', ()):
+            remote[obj['Key']] = obj
+    return remote
+
+def _remote_matches(client, bucket_name: str, key: str, remote: dict, digests: dict, size: int) -> bool:
+    if remote is None or remote['Size'] != size:
+        return False
+    etag = remote['ETag'].strip('"')
+    if etag in (digests['md5'], digests['multipart_etag']):
+        return True
+    # Objects uploaded with other part sizes or encryption are compared by the published digest.
+    head = client.head_object(Bucket=bucket_name, Key=key)
+    return head.get('Metadata', {}).get(SHA256_METADATA) == digests['sha256']
+
+def publish_file(client, bucket_name: str, key: str, path: pathlib.Path, remote: dict,
+                 transfer_config: TransferConfig, force: bool = False) -> dict:
+    """Upload a file unless the remote object already has the same content.
+    Runs on a worker thread, so it only uses the thread-safe client.
+    Returns the publish manifest record for the file."""
+    size = path.stat().st_size
+    digests = file_digests(path, transfer_config.multipart_chunksize)
+    record = {'path': str(path), 'key': key, 'size': size, 'md5': digests['md5'], 'sha256': digests['sha256']}
+    if not force and _remote_matches(client, bucket_name, key, remote, digests, size):
+        record.update(action='skipped', etag=remote['ETag'])
+        return record
+    extra_args = {'Metadata': {SHA256_METADATA: digests['sha256']}}
+    content_type, _ = mimetypes.guess_type(path.name)
+    if content_type:
+        extra_args['ContentType'] = content_type
+    client.upload_file(str(path), bucket_name, key, ExtraArgs=extra_args, Config=transfer_config)
+    logging.info(f'Uploaded {path} to {key}')
+    record.update(action='uploaded',
+                  etag=digests['multipart_etag'] if size >= transfer_config.multipart_threshold else digests['md5'])
+    return record
+
+def publish(client, bucket_name: str, prefix: str, files: list, workers: int = DEFAULT_WORKERS,
+            transfer_config: TransferConfig = None, force: bool = False) -> list:
+    """Publish the (file path, relative key) pairs under the key prefix, using a pool of
+    worker threads. Returns the publish manifest records, in file order."""
+    transfer_config = transfer_config or TransferConfig()
+    remote = list_remote(client, bucket_name, prefix)
+    records = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for path, relative in files:
+            key = prefix + relative
+            future = executor.submit(publish_file, client, bucket_name, key, path, remote.get(key),
+                                     transfer_config, force)
+            futures[future] = (path, key)
+        for future in as_completed(futures):
+            path, key = futures[future]
+            try:
+                records[path] = future.result()
+            except Exception as e:
+                logging.error(f'Error publishing {path}.', exc_info=e)
+                records[path] = {'path': str(path), 'key': key, 'action': 'failed', 'error': str(e)}
+    return [records[path] for path, _ in files]
+
+def write_publish_manifest(filename: pathlib.Path, bucket_name: str, prefix: str, records: list) -> None:
+    manifest = {
+        'bucket': bucket_name,
+        'prefix': prefix,
+        'published': datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+        'uploaded': sum(1 for record in records if record['action'] == 'uploaded'),
+        'skipped': sum(1 for record in records if record['action'] == 'skipped'),
+        'failed': sum(1 for record in records if record['action'] == 'failed'),
+        'files': records,
+    }
+    try:
+        with pathlib.Path(filename).open(mode='wt', encoding='utf-8') as mfp:
+            json.dump(manifest, mfp, indent=2)
+    except Exception as e:
+        logging.error(f'Exception encountered storing publish manifest {filename}.', exc_info=e)
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=os.environ.get("LOGLEVEL",logging.ERROR))
+
+    ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Publish generated APR files to cloud storage, uploading only the files that changed.
+''',
+        epilog='''The program uses defaults for cloud storage access, which can be overridden with the following environment variables:
+  AWS_ACCESS_KEY_ID: The identifier for authenticating access to cloud storage
+  AWS_SECRET_ACCESS_KEY: The associated access key for authenticating access to cloud storage
+  AWS_PROFILE: The name of the cloud storage location
+  AWS_DEFAULT_REGION: The name of the associated Cloud Service Provider region in which the cloud storage is located
+''')
+    ap.add_argument('-b','--bucket',required=True,help='The name of the cloud storage location to publish to.')
+    ap.add_argument('--prefix',default='',help='Key prefix under which to publish the files, such as esser-2022/.')
+    ap.add_argument('-i','--input',action='append',default=[],
+        help='Folder containing files to publish. May be given more than once.')
+    ap.add_argument('-c','--config',action='append',default=[],
+        help='APR configuration file whose output_path folder contains files to publish. May be given more than once.')
+    ap.add_argument('--include',action='append',
+        help=f'Filename glob pattern of the files to publish (by default, {DEFAULT_INCLUDE}). May be given more than once.')
+    ap.add_argument('--force',action='store_true',help='Upload every file, even if the remote copy is the same.')
+    ap.add_argument('--publish-manifest',default=PUBLISH_MANIFEST,
+        help='Name of the JSON file recording the files published.')
+    ap.add_argument('-w','--workers',type=int,default=DEFAULT_WORKERS,
+        help='Number of files to upload at the same time.')
+    ap.add_argument('--multipart-threshold',type=int,default=64,
+        help='Size in MB at which files are uploaded in multiple parts.')
+    ap.add_argument('--multipart-chunksize',type=int,default=16,
+        help='Size in MB of each part of a multipart upload.')
+    ap.add_argument('--max-concurrency',type=int,default=4,
+        help='Number of parts of a single file to upload at the same time.')
+    ap.add_argument('-p','--profile',dest='profile',default=os.getenv('AWS_PROFILE', DEFAULT_PROFILE),
+        help='Profile name to use for cloud storage access.')
+    ap.add_argument('-r','--region',dest='region',default=os.getenv('AWS_DEFAULT_REGION', DEFAULT_REGION),
+        help='Region name to use for cloud storage access.')
+    ap.add_argument('-k','--key',help='Access key for cloud storage access.',dest='key',
+        default=os.getenv('AWS_ACCESS_KEY_ID'))
+    ap.add_argument('-s','--secret',dest='secret',help='Secret access key for cloud storage access.',
+        default=os.getenv('AWS_SECRET_ACCESS_KEY'))
+    ap.add_argument('-e','--endpoint-url',dest='endpoint_url',default=os.getenv('AWS_ENDPOINT_URL'),
+        help='Endpoint URL of an S3-compatible service to use instead of AWS, such as a local test server.')
+    ap.add_argument('-n','--noverify',action='store_false',dest='verify',default=None,
+        help='Turn off SSL certificate validation.')
+    args = ap.parse_args()
+
+    directories = list(args.input)
+    for config_name in args.config:
+        try:
+            with open(config_name, 'r', encoding='utf-8') as cfp:
+                directories.append(json.load(cfp).get('output_path', '.'))
+        except Exception as e:
+            logging.error(f'Error reading configuration {config_name}.', exc_info=e)
+    if not directories:
+        ap.error('at least one --input or --config is required')
+
+    workers = max(args.workers, 1)
+    transfer_config = TransferConfig(multipart_threshold=args.multipart_threshold * MB,
+                                     multipart_chunksize=args.multipart_chunksize * MB,
+                                     max_concurrency=max(args.max_concurrency, 1))
+    try:
+        # Allow enough pooled connections for every part of every concurrent upload.
+        client = get_client(profile=args.profile, region=args.region, key=args.key, secret=args.secret,
+                            endpoint_url=args.endpoint_url, verify=args.verify,
+                            max_pool_connections=workers * transfer_config.max_request_concurrency)
+    except Exception as e:
+        logging.error('Error creating cloud session.',exc_info=e)
+        exit()
+
+    try:
+        startTime = time.time()
+        files = collect_files(directories, args.include or [DEFAULT_INCLUDE])
+        records = publish(client, args.bucket, args.prefix, files, workers=workers,
+                          transfer_config=transfer_config, force=args.force)
+        write_publish_manifest(args.publish_manifest, args.bucket, args.prefix, records)
+        uploaded = [record for record in records if record['action'] == 'uploaded']
+        print(f"Uploaded {len(uploaded)} of {len(records)} files "
+              f"({sum(record['size'] for record in uploaded) / MB:.1f} MB) to {args.bucket} "
+              f"in {time.time() - startTime:.1f} seconds.")
+    except Exception as e:
+        logging.error('Error publishing files.', exc_info=e)
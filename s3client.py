@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Keith.Tucker
+
+Python module for creating the S3 clients used by the cloud storage
+programs.
+
+Every client is created with the same connection settings: a connection
+pool sized for the number of threads using it, adaptive retries,
+connect and read timeouts, and TCP keep-alive, so connections are
+reused instead of being set up again for each request. S3 clients are
+thread-safe, so a single client is created for each combination of
+credentials, endpoint and pool size, and shared by all threads.
+
+Parameters for the session and service connection can be obtained from
+the environment variables listed below.
+
+     AWS_ACCESS_KEY_ID
+     AWS_SECRET_ACCESS_KEY
+     AWS_PROFILE
+     AWS_DEFAULT_REGION
+     AWS_ENDPOINT_URL
+"""
+
+import threading
+
+import boto3
+from botocore.config import Config
+
+DEFAULT_REGION = 'us-east-1'
+DEFAULT_PROFILE = 'esf_dmp_published'
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_MAX_ATTEMPTS = 10
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def client_config(max_pool_connections: int = DEFAULT_MAX_POOL_CONNECTIONS,
+                  connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                  read_timeout: float = DEFAULT_READ_TIMEOUT,
+                  max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> Config:
+    return Config(max_pool_connections=max(max_pool_connections, 1),
+                  connect_timeout=connect_timeout,
+                  read_timeout=read_timeout,
+                  retries={'mode': 'adaptive', 'max_attempts': max_attempts},
+                  tcp_keepalive=True)
+
+def get_client(profile: str = None, region: str = None, key: str = None, secret: str = None,
+               endpoint_url: str = None, verify: bool = None,
+               max_pool_connections: int = DEFAULT_MAX_POOL_CONNECTIONS):
+    """Return the shared S3 client for the given credentials, endpoint and pool size,
+    creating it on first use. Leaving verify as None uses the default certificate validation."""
+    cache_key = (profile, region, key, secret, endpoint_url, verify, max_pool_connections)
+    with _clients_lock:
+        client = _clients.get(cache_key)
+        if client is None:
+            session = boto3.Session(aws_access_key_id=key,
+                                    aws_secret_access_key=secret,
+                                    profile_name=profile,
+                                    region_name=region)
+            client = session.client('s3', endpoint_url=endpoint_url, verify=verify,
+                                    config=client_config(max_pool_connections))
+            _clients[cache_key] = client
+    return client
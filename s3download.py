@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Keith.Tucker
+
+Python module for downloading objects from cloud storage so that an
+interrupted download never leaves a truncated file in place.
+
+An object is downloaded to a part file next to the target file, named
+with the object's ETag. The object is fetched in ranges, several at a
+time, and the ranges are appended to the part file in order, so the
+part file always holds the beginning of the object and an interrupted
+download resumes from its end. The ranged requests are conditional on
+the ETag, so a download is restarted if the object changes. The
+complete part file is verified against the object's ETag (the MD5 of
+the content, or of the part MD5s for objects uploaded in parts) or,
+for encrypted objects, its stored checksum, and only then renamed to
+the target file.
+"""
+
+import base64
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import hashlib
+import logging
+import math
+import os
+import pathlib
+import re
+import zlib
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+MB = 1024 * 1024
+READ_SIZE = MB
+_MULTIPART_ETAG = re.compile(r'^([0-9a-f]{32})-(\d+)$')
+_SINGLE_PART_ETAG = re.compile(r'^[0-9a-f]{32}$')
+
+class ChecksumMismatch(Exception):
+    pass
+
+def part_path(filepath: pathlib.Path, etag: str) -> pathlib.Path:
+    token = etag.strip('"')
+    return filepath.with_name(f'{filepath.name}.{token}.part')
+
+def _remove_stale_parts(filepath: pathlib.Path, current: pathlib.Path) -> None:
+    # Part files left from earlier versions of the object can never be resumed.
+    for stale in filepath.parent.glob(f'{glob.escape(filepath.name)}.*.part'):
+        if stale != current:
+            stale.unlink(missing_ok=True)
+
+def _fetch_range(client, bucket_name: str, key: str, etag: str, start: int, end: int) -> bytes:
+    response = client.get_object(Bucket=bucket_name, Key=key, IfMatch=etag, Range=f'bytes={start}-{end}')
+    return response['Body'].read()
+
+def _file_blocks(path: pathlib.Path, start: int = 0, length: int = None):
+    with path.open('rb') as f:
+        f.seek(start)
+        remaining = length
+        while remaining is None or remaining > 0:
+            block = f.read(READ_SIZE if remaining is None else min(READ_SIZE, remaining))
+            if not block:
+                break
+            if remaining is not None:
+                remaining -= len(block)
+            yield block
+
+def _multipart_etag(path: pathlib.Path, size: int, part_size: int) -> str:
+    digests = []
+    for start in range(0, size, part_size):
+        md5 = hashlib.md5()
+        for block in _file_blocks(path, start, part_size):
+            md5.update(block)
+        digests.append(md5.digest())
+    return f'{hashlib.md5(b"".join(digests)).hexdigest()}-{len(digests)}'
+
+def _stored_checksum(head: dict):
+    """Return the algorithm and value of a stored checksum covering the whole object, if any."""
+    for algorithm in ('SHA256', 'SHA1', 'CRC32'):
+        value = head.get(f'Checksum{algorithm}')
+        if value and '-' not in value:
+            return algorithm, value
+    return None, None
+
+def verify_part(client, bucket_name: str, key: str, path: pathlib.Path, head: dict) -> str:
+    """Check a downloaded part file against the object's ETag or stored checksum.
+    Raises ChecksumMismatch if they differ, and returns a description of the check made."""
+    etag = head['ETag'].strip('"')
+    size = head['ContentLength']
+    # The ETag of an object encrypted with a KMS key is not a digest of its content.
+    if head.get('ServerSideEncryption') != 'aws:kms':
+        if _SINGLE_PART_ETAG.match(etag):
+            md5 = hashlib.md5()
+            for block in _file_blocks(path):
+                md5.update(block)
+            if md5.hexdigest() != etag:
+                raise ChecksumMismatch(f'MD5 of {path} does not match the ETag of {key}')
+            return 'MD5'
+        multipart = _MULTIPART_ETAG.match(etag)
+        if multipart:
+            # The size of the first part gives the part size used to upload the object. Where the
+            # service does not report it, assume the smallest whole number of MB giving the part count.
+            parts = int(multipart.group(2))
+            part_size = client.head_object(Bucket=bucket_name, Key=key, PartNumber=1)['ContentLength']
+            if not part_size * (parts - 1) < size <= part_size * parts:
+                part_size = math.ceil(size / parts / MB) * MB
+            if _multipart_etag(path, size, part_size) != etag:
+                raise ChecksumMismatch(f'Part MD5s of {path} do not match the ETag of {key}')
+            return 'multipart MD5'
+    algorithm, expected = _stored_checksum(head)
+    if algorithm is None:
+        logging.warning(f'No usable ETag or checksum to verify {key}.')
+        return 'none'
+    if algorithm == 'CRC32':
+        crc = 0
+        for block in _file_blocks(path):
+            crc = zlib.crc32(block, crc)
+        digest = crc.to_bytes(4, 'big')
+    else:
+        hasher = hashlib.new(algorithm.lower())
+        for block in _file_blocks(path):
+            hasher.update(block)
+        digest = hasher.digest()
+    if base64.b64encode(digest).decode('ascii') != expected:
+        raise ChecksumMismatch(f'{algorithm} checksum of {path} does not match {key}')
+    return algorithm
+
+def download_object(client, bucket_name: str, key: str, filepath: pathlib.Path,
+                    transfer_config: TransferConfig = None) -> dict:
+    """Download an object to a file through a verified, resumable part file.
+    Objects larger than the transfer configuration's multipart threshold are fetched
+    in chunks of its multipart chunk size, up to its maximum concurrency at a time.
+    Returns the object's HEAD response."""
+    transfer_config = transfer_config or TransferConfig()
+    filepath = pathlib.Path(filepath)
+    head = client.head_object(Bucket=bucket_name, Key=key, ChecksumMode='ENABLED')
+    size = head['ContentLength']
+    part = part_path(filepath, head['ETag'])
+    filepath.parent.mkdir(parents = True, exist_ok = True)
+    _remove_stale_parts(filepath, part)
+
+    offset = part.stat().st_size if part.exists() else 0
+    if offset > size:
+        part.unlink()
+        offset = 0
+    if offset:
+        logging.info(f'Resuming download of {key} at byte {offset}')
+    chunk_size = size if size <= transfer_config.multipart_threshold else transfer_config.multipart_chunksize
+    concurrency = max(transfer_config.max_request_concurrency, 1)
+    try:
+        with part.open('ab') as pf, ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # Write the chunks in order as they arrive, keeping a bounded number in flight.
+            window = deque()
+            for start in range(offset, size, max(chunk_size, 1)):
+                window.append(executor.submit(_fetch_range, client, bucket_name, key, head['ETag'],
+                                              start, min(start + chunk_size, size) - 1))
+                if len(window) >= concurrency:
+                    pf.write(window.popleft().result())
+            while window:
+                pf.write(window.popleft().result())
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', '412'):
+            # The object changed during the download, so the part file can not be resumed.
+            part.unlink(missing_ok=True)
+        raise
+
+    try:
+        check = verify_part(client, bucket_name, key, part, head)
+    except ChecksumMismatch:
+        part.unlink(missing_ok=True)
+        raise
+    logging.info(f'Verified {filepath} ({check})')
+    os.replace(part, filepath)
+    return head
@@ -6,6 +6,11 @@ Created on Thu Aug 18 15:57:55 2022
 
 Python command-line script for listing objects in an S3 bucket.
 
+The buckets are listed with the paginated ListObjectsV2 operation. Each
+bucket is first listed with a delimiter to find its top-level prefixes,
+and the prefixes of all the buckets are then listed in parallel, with the
+objects written as they arrive, as text, JSON Lines or CSV.
+
 Parameters for the session and service connection can be obtained from
 the environment variables listed below.
 
@@ -23,22 +28,106 @@ https://boto3.amazonaws.com/v1/documentation/api/latest/guide/credentials.html
 """
 
 import argparse
-import boto3
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import json
 import logging
 import os
+import queue
+import sys
 
-DEFAULT_REGION = 'us-east-1'
-DEFAULT_PROFILE = 'esf_dmp_published'
+from s3client import DEFAULT_PROFILE, DEFAULT_REGION, get_client
+
+DEFAULT_WORKERS = 8
+DEFAULT_PAGE_SIZE = 1000
+OUTPUT_FORMATS = ['text', 'jsonl', 'csv']
+OBJECT_COLUMNS = ['bucket', 'key', 'size', 'etag', 'last_modified']
+ROLLUP_COLUMNS = ['bucket', 'prefix', 'count', 'size']
+
+def _object_record(bucketName, obj):
+    return {'bucket': bucketName, 'key': obj['Key'], 'size': obj['Size'],
+            'etag': obj.get('ETag'), 'last_modified': obj['LastModified']}
+
+def _list_pages(client, pages, bucketName, prefix, page_size, delimiter=None):
+    """List a bucket prefix, putting a list of object records on the pages queue for
+    each page. Returns the common prefixes found when listing with a delimiter."""
+    paginator = client.get_paginator('list_objects_v2')
+    kwargs = {'Bucket': bucketName, 'Prefix': prefix, 'PaginationConfig': {'PageSize': page_size}}
+    if delimiter is not None:
+        kwargs['Delimiter'] = delimiter
+    common_prefixes = []
+    for page in paginator.paginate(**kwargs):
+        contents = page.get('Contents', ())
+        if contents:
+            pages.put([_object_record(bucketName, obj) for obj in contents])
+        common_prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', ()))
+    return common_prefixes
+
+def list_s3_objects(client, bucketNames, workers=DEFAULT_WORKERS, page_size=DEFAULT_PAGE_SIZE):
+    """Generate a record of every object in the buckets, listing the buckets and their
+    top-level prefixes in parallel. Records are generated in the order pages arrive."""
+    pages = queue.Queue()
+    pending = []
+
+    def done(future):
+        # Wake the generator when a listing finishes, so it can schedule the prefixes found.
+        pages.put(future)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit(bucketName, prefix, delimiter=None):
+            future = executor.submit(_list_pages, client, pages, bucketName, prefix, page_size, delimiter)
+            future.bucket_name = bucketName
+            future.delimited = delimiter is not None
+            pending.append(future)
+            future.add_done_callback(done)
+
+        for bucketName in bucketNames:
+            submit(bucketName, '', delimiter='/')
+        while pending:
+            item = pages.get()
+            if isinstance(item, list):
+                yield from item
+                continue
+            pending.remove(item)
+            try:
+                prefixes = item.result()
+            except Exception as e:
+                logging.error(f'Error listing contents of bucket {item.bucket_name}.', exc_info=e)
+                continue
+            if item.delimited:
+                for prefix in prefixes:
+                    submit(item.bucket_name, prefix)
+
+def rollup(records):
+    """Total the number and size of the objects under each top-level prefix.
+    Objects at the top level of a bucket are totaled under an empty prefix."""
+    totals = {}
+    for record in records:
+        separator = record['key'].find('/')
+        prefix = record['key'][:separator + 1] if separator >= 0 else ''
+        total = totals.setdefault((record['bucket'], prefix), {'bucket': record['bucket'], 'prefix': prefix,
+                                                               'count': 0, 'size': 0})
+        total['count'] += 1
+        total['size'] += record['size']
+    return [totals[key] for key in sorted(totals)]
+
+def write_records(records, output_format, columns, out=sys.stdout):
+    """Write the records as they are generated, one per line."""
+    if output_format == 'csv':
+        writer = csv.DictWriter(out, fieldnames=columns, lineterminator='\n')
+        writer.writeheader()
+    for record in records:
+        match output_format:
+            case 'jsonl':
+                out.write(json.dumps(record, default=str) + '\n')
+            case 'csv':
+                writer.writerow(record)
+            case _:
+                if 'key' in record:
+                    out.write(f"{record['bucket']}/{record['key']} last modified {record['last_modified']}\n")
+                else:
+                    out.write(f"{record['bucket']}/{record['prefix']} {record['count']} objects, {record['size']} bytes\n")
 
-def list_s3_objects(session,bucketName):
-    try:
-        s3 = session.resource('s3')
-        bucket=s3.Bucket(bucketName)
-        for bucketObj in bucket.objects.all():
-            print(f'{bucketObj.key} last modified {bucketObj.last_modified}')
-    except Exception as e:
-        logging.error('Error listing bucket contents.', exc_info=e)
-    
 if __name__ == '__main__':
 
     logging.basicConfig(level=os.environ.get("LOGLEVEL",logging.ERROR))
@@ -63,18 +152,34 @@ if __name__ == '__main__':
         default=os.getenv('AWS_ACCESS_KEY_ID'))
     ap.add_argument('-s','--secret',dest='secret',help='Secret access key for cloud storage access.',
         default=os.getenv('AWS_SECRET_ACCESS_KEY'))
+    ap.add_argument('-e','--endpoint-url',dest='endpoint_url',default=os.getenv('AWS_ENDPOINT_URL'),
+        help='Endpoint URL of an S3-compatible service to use instead of AWS, such as a local test server.')
+    ap.add_argument('-n','--noverify',action='store_false',dest='verify',default=None,
+        help='Turn off SSL certificate validation.')
+    ap.add_argument('-f','--format',dest='format',choices=OUTPUT_FORMATS,default='text',
+        help='Format in which to write the listing.')
+    ap.add_argument('-w','--workers',type=int,default=DEFAULT_WORKERS,
+        help='Number of bucket prefixes to list at the same time.')
+    ap.add_argument('--page-size',type=int,default=DEFAULT_PAGE_SIZE,
+        help='Number of objects to request in each page of a listing (at most 1000).')
+    ap.add_argument('--rollup',action='store_true',
+        help='Write the number of objects and total size under each top-level prefix instead of the objects.')
     args = ap.parse_args()
 
     try:
-        session = boto3.Session(aws_access_key_id=args.key,
-                                aws_secret_access_key=args.secret,
-                                profile_name=args.profile,
-                                region_name=args.region)
-        for bucket in args.bucket:
-            print(f'Contents of bucket {bucket}:')
-            list_s3_objects(session,bucket)
-
+        workers = max(args.workers, 1)
+        client = get_client(profile=args.profile, region=args.region, key=args.key, secret=args.secret,
+                            endpoint_url=args.endpoint_url, verify=args.verify, max_pool_connections=workers)
     except Exception as e:
         logging.error('Error creating session.',exc_info=e)
+        exit()
 
-
+    try:
+        records = list_s3_objects(client, args.bucket, workers=workers,
+                                  page_size=min(max(args.page_size, 1), DEFAULT_PAGE_SIZE))
+        if args.rollup:
+            write_records(rollup(records), args.format, ROLLUP_COLUMNS)
+        else:
+            write_records(records, args.format, OBJECT_COLUMNS)
+    except Exception as e:
+        logging.error('Error listing bucket contents.', exc_info=e)
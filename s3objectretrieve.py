@@ -8,6 +8,9 @@ This program connects to an S3 bucket, finds the most reccent file
 matching a file naming pattern, and downloads the file if the version in
 cloud storage is newer than a local copy, or no local copy exists.
 
+The ETag of each file downloaded is recorded in a manifest in the output
+directory, so a file is only downloaded again when its ETag changes.
+
 Parameters for the session and service connection can be obtained from
 the environment variables listed below.
 
@@ -25,36 +28,74 @@ https://boto3.amazonaws.com/v1/documentation/api/latest/guide/credentials.html
 """
 
 import argparse
-import datetime
 import logging
 import os
 import pathlib
 import re
 import sys
 
-import boto3
-
-DEFAULT_REGION = 'us-east-1'
-DEFAULT_PROFILE = 'esf_dmp_published'
-
-def find_latest_apr_files(bucket, file_name_patterns):
+from s3client import DEFAULT_PROFILE, DEFAULT_REGION, get_client
+from s3download import download_object
+from s3syncmanifest import MANIFEST_NAME, SyncManifest, local_copy_current
+
+_REGEX_SPECIAL = set('.^$*+?{}[]\\|()')
+
+def literal_prefix(pattern: str) -> str:
+    """Return the literal text every key matching a regular expression pattern
+    (with re.match) must begin with, for use as a server-side listing prefix."""
+    if '|' in pattern:
+        # An alternative may begin differently, so no prefix is safe.
+        return ''
+    prefix = []
+    i = 1 if pattern.startswith('^') else 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            if i + 1 < len(pattern) and not pattern[i+1].isalnum():
+                literal, step = pattern[i+1], 2
+            else:
+                break
+        elif c in _REGEX_SPECIAL:
+            break
+        else:
+            literal, step = c, 1
+        quantifier = pattern[i+step:i+step+1]
+        if quantifier in ('*', '?', '{'):
+            # The character is optional, so it ends the prefix.
+            break
+        prefix.append(literal)
+        if quantifier == '+':
+            break
+        i += step
+    return ''.join(prefix)
+
+def listing_prefixes(prefixes) -> list:
+    """Reduce a collection of prefixes to the fewest that cover them all,
+    dropping any prefix that begins with another one."""
+    covering = []
+    for prefix in sorted(set(prefixes)):
+        if not covering or not prefix.startswith(covering[-1]):
+            covering.append(prefix)
+    return covering
+
+def find_latest_apr_files(client, bucket_name, file_name_patterns):
+    """Find the most recently modified object matching each pattern, in a single pass over
+    listings restricted to the literal prefixes of the patterns. Returns a list of
+    (key, last modified, ETag, size) tuples, in pattern order, for the patterns matched."""
     file_list = []
     try:
-        # Gather all the object names and last modified dates from the bucket,
-        # for faster repeated iterations,
-        cloud_file_list = []
-        for bucket_obj in bucket.objects.all():
-            cloud_file_list.append((bucket_obj.key,bucket_obj.last_modified))
-        for pattern in file_name_patterns:
-            latest = None
-            file_name = None
-            for bucket_file, bucket_latest in cloud_file_list:
-                if latest is None or bucket_latest > latest:
-                    if re.match(pattern,bucket_file):
-                        file_name = bucket_file
-                        latest = bucket_latest
-            if file_name is not None:
-                file_list.append((file_name,latest))
+        matchers = [(literal_prefix(pattern), re.compile(pattern)) for pattern in file_name_patterns]
+        latest = [None] * len(matchers)
+        paginator = client.get_paginator('list_objects_v2')
+        for prefix in listing_prefixes(prefix for prefix, _ in matchers):
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+                for bucket_obj in page.get('Contents', ()):
+                    key = bucket_obj['Key']
+                    for i, (pattern_prefix, matcher) in enumerate(matchers):
+                        if key.startswith(pattern_prefix) and matcher.match(key):
+                            if latest[i] is None or bucket_obj['LastModified'] > latest[i][1]:
+                                latest[i] = (key, bucket_obj['LastModified'], bucket_obj['ETag'], bucket_obj['Size'])
+        file_list = [file_info for file_info in latest if file_info is not None]
     except Exception as e:
         logging.error('Error searching for latest files in cloud storage.', exc_info=e)
     return file_list
@@ -85,15 +126,17 @@ if __name__ == '__main__':
         default=os.getenv('AWS_ACCESS_KEY_ID'))
     ap.add_argument('-s', '--secret', dest='secret', help='Secret access key for cloud storage access.',
         default=os.getenv('AWS_SECRET_ACCESS_KEY'))
-    ap.add_argument('-n', '--noverify', action='store_false', help='Turn off SSL certificate validation.')
+    ap.add_argument('-e', '--endpoint-url', dest='endpoint_url', default=os.getenv('AWS_ENDPOINT_URL'),
+        help='Endpoint URL of an S3-compatible service to use instead of AWS, such as a local test server.')
+    ap.add_argument('-n', '--noverify', action='store_false', dest='verify', default=None,
+        help='Turn off SSL certificate validation.')
+    ap.add_argument('-m', '--manifest',
+        help=f'File recording the files downloaded, used to download only files whose ETag changed. Defaults to {MANIFEST_NAME} in the output directory.')
     args = ap.parse_args()
 
     try:
-        session = boto3.Session(aws_access_key_id=args.key,
-                                aws_secret_access_key=args.secret,
-                                profile_name=args.profile,
-                                region_name=args.region)
-        s3 = session.resource('s3', verify=args.noverify)
+        client = get_client(profile=args.profile, region=args.region, key=args.key, secret=args.secret,
+                            endpoint_url=args.endpoint_url, verify=args.verify)
 
         if args.output:
             outdir = pathlib.Path(args.output).resolve(strict=False)
@@ -107,33 +150,32 @@ if __name__ == '__main__':
                 outdir.mkdir(parents = True, exist_ok = True)
                 os.chdir(outdir)
 
+        # The manifest path is resolved after changing to the output directory.
+        manifest = SyncManifest(args.manifest or MANIFEST_NAME)
+
         file_not_found = True
-        for bucket_name in args.bucket:
-            bucket = s3.Bucket(bucket_name)
-
-            file_name_list = find_latest_apr_files(bucket, args.pattern)
-
-            for file_name, latest in file_name_list:
-                file_not_found = False
-
-                # If the file does not already exist or is older than the copy found in
-                # cloud storage, download it for local use.
-                download = False
-                try:
-                    fstat = os.stat(file_name)
-                    if datetime.datetime.fromtimestamp(fstat.st_mtime,
-                                                        tz=datetime.timezone.utc) < latest:
-                        download = True
-                except os.error:
-                    # The file must not exist, so download it.
-                    download = True
-                if download:
-                    # Download the object as a local file.
-                    with open(file_name, 'wb') as f:
-                        bucket.download_fileobj(file_name, f)
-                    print(f'File named {file_name} downloaded from bucket {bucket_name}.')
-                else:
-                    print(f'File named {file_name} was already the latest.')
+        with manifest:
+            for bucket_name in args.bucket:
+                file_name_list = find_latest_apr_files(client, bucket_name, args.pattern)
+
+                for file_name, latest, etag, size in file_name_list:
+                    file_not_found = False
+
+                    # Download the file if its ETag differs from the recorded copy. Files not
+                    # yet recorded are downloaded if they do not already exist or are older
+                    # than the copy found in cloud storage.
+                    entry = manifest.get(bucket_name, file_name)
+                    if entry is not None:
+                        download = entry['etag'] != etag
+                    else:
+                        download = not local_copy_current(file_name, size, latest)
+                    if download:
+                        # Download the object as a local file, through a verified part file.
+                        download_object(client, bucket_name, file_name, pathlib.Path(file_name))
+                        print(f'File named {file_name} downloaded from bucket {bucket_name}.')
+                    else:
+                        print(f'File named {file_name} was already the latest.')
+                    manifest.record(bucket_name, file_name, etag, size, latest, pathlib.Path(file_name).resolve())
 
         if file_not_found:
             print('No files found in cloud storage matching provided naming patterns.')
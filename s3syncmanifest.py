@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Keith.Tucker
+
+Python module for recording the cloud storage objects copied to a local
+folder.
+
+The manifest is a SQLite database holding the bucket, key, ETag, size
+and last modified date of every object synchronized. Comparing the
+ETags in a bucket listing with the manifest shows which objects changed
+without checking the local files, so restoring, copying or extracting a
+folder (which resets file modification times) does not cause the
+objects to be downloaded again.
+
+The manifest also records the name, size and CRC of each member of the
+ZIP archives extracted, so only new or changed members are extracted
+again when an archive changes.
+"""
+
+import datetime
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+
+MANIFEST_NAME = '.s3sync-manifest.sqlite'
+
+class SyncManifest:
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        # The connection is shared by worker threads, so access is serialized with a lock.
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._lock:
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS objects (
+                bucket TEXT NOT NULL,
+                key TEXT NOT NULL,
+                etag TEXT,
+                size INTEGER,
+                last_modified TEXT,
+                local_path TEXT,
+                synced TEXT,
+                PRIMARY KEY (bucket, key))''')
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS archive_members (
+                bucket TEXT NOT NULL,
+                key TEXT NOT NULL,
+                member TEXT NOT NULL,
+                size INTEGER,
+                crc INTEGER,
+                PRIMARY KEY (bucket, key, member))''')
+            self._connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def objects(self, bucket: str) -> dict:
+        """Return the recorded entries for every object in a bucket, keyed by object key."""
+        with self._lock:
+            cursor = self._connection.execute(
+                'SELECT key, etag, size, last_modified, local_path FROM objects WHERE bucket = ?', (bucket,))
+            return {key: {'etag': etag, 'size': size, 'last_modified': last_modified, 'local_path': local_path}
+                    for key, etag, size, last_modified, local_path in cursor}
+
+    def get(self, bucket: str, key: str) -> dict:
+        """Return the recorded entry for an object, or None if the object was never synchronized."""
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT etag, size, last_modified, local_path FROM objects WHERE bucket = ? AND key = ?',
+                (bucket, key)).fetchone()
+        if row is None:
+            return None
+        etag, size, last_modified, local_path = row
+        return {'etag': etag, 'size': size, 'last_modified': last_modified, 'local_path': local_path}
+
+    def record(self, bucket: str, key: str, etag: str, size: int, last_modified: datetime.datetime,
+               local_path) -> None:
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (bucket, key, etag, size,
+                 last_modified.isoformat() if last_modified is not None else None,
+                 str(local_path),
+                 datetime.datetime.now(tz=datetime.timezone.utc).isoformat()))
+
+    def archive_members(self, bucket: str, key: str) -> dict:
+        """Return the (size, CRC) recorded for each member extracted from an archive, keyed by member name."""
+        with self._lock:
+            cursor = self._connection.execute(
+                'SELECT member, size, crc FROM archive_members WHERE bucket = ? AND key = ?', (bucket, key))
+            return {member: (size, crc) for member, size, crc in cursor}
+
+    def record_archive_members(self, bucket: str, key: str, members: dict) -> None:
+        """Replace the members recorded for an archive with the (size, CRC) of each member name."""
+        with self._lock:
+            self._connection.execute('DELETE FROM archive_members WHERE bucket = ? AND key = ?', (bucket, key))
+            self._connection.executemany(
+                'INSERT INTO archive_members VALUES (?, ?, ?, ?, ?)',
+                [(bucket, key, member, size, crc) for member, (size, crc) in members.items()])
+
+    def commit(self) -> None:
+        with self._lock:
+            self._connection.commit()
+
+    def close(self) -> None:
+        try:
+            self.commit()
+            self._connection.close()
+        except Exception as e:
+            logging.error(f'Error closing sync manifest {self.path}.', exc_info=e)
+
+def local_copy_current(filepath, size: int, last_modified: datetime.datetime) -> bool:
+    """Check a local file against an object not yet recorded in a manifest, using the
+    file size and modification time the way the programs did before keeping manifests."""
+    try:
+        fstat = os.stat(filepath)
+    except os.error:
+        return False
+    return (fstat.st_size == size and
+            datetime.datetime.fromtimestamp(fstat.st_mtime, tz=datetime.timezone.utc) >= last_modified)
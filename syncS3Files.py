@@ -1,15 +1,246 @@
 import argparse
-import boto3
-import datetime
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+import json
 import logging
 import os
 import pathlib
+import subprocess
+import sys
+import tempfile
 import time
 import zipfile
 
+from esf_s3_datafile import find_latest_s3_object, is_s3_uri
+from s3client import DEFAULT_PROFILE, DEFAULT_REGION, get_client
+from s3download import download_object
+from s3syncmanifest import MANIFEST_NAME, SyncManifest, local_copy_current
+
 DEST_FOLDER = "S3_Data"
-DEFAULT_REGION = 'us-east-1'
-DEFAULT_PROFILE = 'esf_dmp_published'
+DATAFILE_BUCKET = 'prod-esf-dmp-published'
+PRIORITIES = ['smallest', 'recent']
+GENERATOR = pathlib.Path(__file__).with_name('generate_esf_apr.py')
+GENERATOR_SCHEMA = pathlib.Path(__file__).with_name('aprMap.schema.json')
+DEFAULT_WORKERS = 8
+DEFAULT_EXTRACT_WORKERS = 2
+MB = 1024 * 1024
+# Archives extracted without being stored are held in memory up to this size.
+SPOOL_SIZE = 64 * MB
+
+def extract_zip(archive, destination: pathlib.Path, manifest: SyncManifest = None,
+                bucket_name: str = None, key: str = None) -> int:
+    """Extract the members of a ZIP archive (a file path or a seekable file object) into a folder.
+    With a manifest, only members whose size or CRC differ from the ones recorded for the
+    archive, or which are missing locally, are extracted. Returns the number of members extracted."""
+    logging.info(f'Extracting ZIP archive contents of {key or archive}.')
+    extracted = 0
+    try:
+        recorded = manifest.archive_members(bucket_name, key) if manifest is not None else {}
+        members = {}
+        with zipfile.ZipFile(archive, 'r') as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                members[info.filename] = (info.file_size, info.CRC)
+                if (recorded.get(info.filename) == members[info.filename] and
+                        (destination / info.filename).exists()):
+                    continue
+                zf.extract(info, path=destination)
+                extracted += 1
+        if manifest is not None:
+            manifest.record_archive_members(bucket_name, key, members)
+    except Exception as e:
+        logging.error(f'Error extracting ZIP archive {key or archive}.', exc_info=e)
+    return extracted
+
+def _is_zip(filepath: pathlib.Path) -> bool:
+    return filepath.suffix.lower() == ".zip"
+
+def sync_object(client, bucket_name: str, key: str, filepath: pathlib.Path, download: bool, unzip: bool,
+                transfer_config: TransferConfig = None, manifest: SyncManifest = None,
+                extractor: ThreadPoolExecutor = None, discard_archives: bool = False):
+    """Download one object if needed and extract it if it is a ZIP archive.
+    Runs on a worker thread, so it only uses the thread-safe low-level client.
+    Returns whether the object was downloaded, and the number of archive members
+    extracted, or a future for the extraction when it is handed to the extractor."""
+    extraction = 0
+    if download and discard_archives and _is_zip(filepath):
+        # Extract the archive from a temporary copy, without writing the archive itself.
+        filepath.parent.mkdir(parents = True, exist_ok = True)
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as archive:
+            client.download_fileobj(bucket_name, key, archive, Config=transfer_config)
+            logging.info(f'Retrieved archive {key}')
+            archive.seek(0)
+            extraction = extract_zip(archive, filepath.parent, manifest, bucket_name, key)
+        return download, extraction
+    if download:
+        # Download the object as a local file, through a verified part file.
+        download_object(client, bucket_name, key, filepath, transfer_config)
+        logging.info(f'Copied file {filepath}')
+    if (download or unzip) and _is_zip(filepath) and filepath.exists():
+        if extractor is not None:
+            # Extract on another thread, so this worker can go on to the next download.
+            extraction = extractor.submit(extract_zip, filepath, filepath.parent, manifest, bucket_name, key)
+        else:
+            extraction = extract_zip(filepath, filepath.parent, manifest, bucket_name, key)
+    return download, extraction
+
+def _list_objects(client, bucket_name: str):
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name):
+        yield from page.get('Contents', ())
+
+def sync_bucket(client, bucket_name: str, output: str, unzip: bool = False, workers: int = DEFAULT_WORKERS,
+                transfer_config: TransferConfig = None, manifest: SyncManifest = None,
+                rescan: bool = False, extract_workers: int = DEFAULT_EXTRACT_WORKERS,
+                discard_archives: bool = False) -> dict:
+    """Copy the objects in a bucket that changed since they were last copied, using a pool of worker threads.
+    With a manifest, objects are compared by ETag with the recorded copies, and only objects not yet
+    recorded (or every object, when rescan is set) are compared with the local files.
+    ZIP archives are extracted on a separate pool of threads while the downloads continue.
+    Returns the number of files copied, the bytes transferred, the archive members extracted
+    and the elapsed seconds."""
+    logging.info(f'Synchronizing {bucket_name}')
+    startTime = time.time()
+    recorded = manifest.objects(bucket_name) if manifest is not None and not rescan else {}
+    filesCopied = 0
+    bytesCopied = 0
+    membersExtracted = 0
+    extractions = []
+    with ThreadPoolExecutor(max_workers=max(extract_workers, 1)) as extractor:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for bucketObject in _list_objects(client, bucket_name):
+                key, etag, size, last_modified = (bucketObject['Key'], bucketObject['ETag'],
+                                                  bucketObject['Size'], bucketObject['LastModified'])
+                if key[-1] == '/':
+                    # This object is just a folder designator, so skip it.
+                    continue
+                filepath = pathlib.Path(f'{output}/{key}').resolve(strict=False)
+                entry = recorded.get(key)
+                if entry is not None:
+                    logging.info(f'Checking ETag of {key}')
+                    download = entry['etag'] != etag
+                else:
+                    logging.info(f'Checking timestamp on {filepath}')
+                    download = not local_copy_current(filepath, size, last_modified)
+                    if not download and manifest is not None:
+                        # The local copy is current, so record it without downloading it again.
+                        manifest.record(bucket_name, key, etag, size, last_modified, filepath)
+                if download or (unzip and _is_zip(filepath)):
+                    future = executor.submit(sync_object, client, bucket_name, key, filepath,
+                                             download, unzip, transfer_config, manifest, extractor,
+                                             discard_archives)
+                    futures[future] = (key, etag, size, last_modified, filepath)
+            for future in as_completed(futures):
+                key, etag, size, last_modified, filepath = futures[future]
+                try:
+                    downloaded, extraction = future.result()
+                    if downloaded:
+                        filesCopied += 1
+                        bytesCopied += size
+                        if manifest is not None:
+                            manifest.record(bucket_name, key, etag, size, last_modified, filepath)
+                    if isinstance(extraction, Future):
+                        extractions.append(extraction)
+                    else:
+                        membersExtracted += extraction
+                except Exception as e:
+                    logging.error(f'Error copying object {key}.', exc_info=e)
+        for extraction in extractions:
+            membersExtracted += extraction.result()
+    if manifest is not None:
+        manifest.commit()
+    return {'files': filesCopied, 'bytes': bytesCopied, 'members': membersExtracted,
+            'seconds': time.time() - startTime}
+
+def find_config_datafiles(client, config_names, bucket_names, encoding: str = 'utf-8') -> list:
+    """Find the newest object in the buckets matching the file name part of each configuration's
+    datafile pattern. Returns one target per object, giving the bucket, the object listing entry,
+    the local file to copy it to (in the folder named by the pattern) and the configurations using it."""
+    targets = {}
+    for config_name in config_names:
+        try:
+            with open(config_name, 'r', encoding=encoding) as cfp:
+                pattern = json.load(cfp)['datafile_pattern']
+        except Exception as e:
+            logging.error(f'Error reading configuration {config_name}.', exc_info=e)
+            continue
+        if is_s3_uri(pattern):
+            print(f'{config_name} reads its datafile directly from {pattern}.')
+            continue
+        local = pathlib.Path(pattern)
+        newest = None
+        for bucket_name in bucket_names:
+            obj = find_latest_s3_object(client, bucket_name, local.name)
+            if obj is not None and (newest is None or obj['LastModified'] > newest[1]['LastModified']):
+                newest = (bucket_name, obj)
+        if newest is None:
+            logging.error(f'No object found matching datafile pattern {pattern} of {config_name}.')
+            continue
+        bucket_name, obj = newest
+        target = targets.setdefault((bucket_name, obj['Key']), {
+            'bucket': bucket_name, 'object': obj,
+            'filepath': (local.parent / pathlib.PurePosixPath(obj['Key']).name).resolve(strict=False),
+            'configs': []})
+        target['configs'].append(config_name)
+    return list(targets.values())
+
+def launch_generation(config_name: str) -> subprocess.Popen:
+    print(f'Generating APRs for {config_name}')
+    return subprocess.Popen([sys.executable, str(GENERATOR), '-s', str(GENERATOR_SCHEMA), config_name])
+
+def sync_configs(client, targets: list, workers: int = DEFAULT_WORKERS, transfer_config: TransferConfig = None,
+                 manifest: SyncManifest = None, priority: str = 'smallest', generate: bool = False,
+                 rescan: bool = False) -> dict:
+    """Copy the datafiles found for a set of configurations, starting with the smallest or most
+    recently changed. With generate set, APRs are generated for each configuration as soon as its
+    datafile is copied, while the remaining datafiles are still downloading, and right away for
+    each configuration whose datafile is already the latest.
+    Returns the number of files copied, the bytes transferred and the elapsed seconds."""
+    startTime = time.time()
+    if priority == 'recent':
+        targets = sorted(targets, key=lambda target: target['object']['LastModified'], reverse=True)
+    else:
+        targets = sorted(targets, key=lambda target: target['object']['Size'])
+    filesCopied = 0
+    bytesCopied = 0
+    generators = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for target in targets:
+            bucket_name, obj, filepath = target['bucket'], target['object'], target['filepath']
+            entry = manifest.get(bucket_name, obj['Key']) if manifest is not None and not rescan else None
+            if entry is not None:
+                current = entry['etag'] == obj['ETag'] and filepath.exists()
+            else:
+                current = local_copy_current(filepath, obj['Size'], obj['LastModified'])
+            if current:
+                print(f'File {filepath} is already the latest.')
+                if generate:
+                    generators.extend((config_name, launch_generation(config_name)) for config_name in target['configs'])
+                continue
+            future = executor.submit(download_object, client, bucket_name, obj['Key'], filepath, transfer_config)
+            futures[future] = target
+        for future in as_completed(futures):
+            target = futures[future]
+            bucket_name, obj, filepath = target['bucket'], target['object'], target['filepath']
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"Error copying object {obj['Key']}.", exc_info=e)
+                continue
+            print(f'Copied file {filepath}')
+            filesCopied += 1
+            bytesCopied += obj['Size']
+            if manifest is not None:
+                manifest.record(bucket_name, obj['Key'], obj['ETag'], obj['Size'], obj['LastModified'], filepath)
+                manifest.commit()
+            if generate:
+                generators.extend((config_name, launch_generation(config_name)) for config_name in target['configs'])
+    for config_name, process in generators:
+        if process.wait() != 0:
+            logging.error(f'Generating APRs for {config_name} failed with exit status {process.returncode}.')
+    return {'files': filesCopied, 'bytes': bytesCopied, 'seconds': time.time() - startTime}
 
 if __name__ == '__main__':
     ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -23,9 +254,19 @@ if __name__ == '__main__':
 ''')
     ap.add_argument('-o','--output',help='Copy files to the specified directory.', dest='output', default=DEST_FOLDER)
     ap.add_argument('-u','--unzip', help='Force unzip of all archive files.', action='store_true', dest='unzip')
-    ap.add_argument('-b','--bucket',action='append',dest='bucket', required=True,
+    ap.add_argument('-x','--extract-workers',type=int,default=DEFAULT_EXTRACT_WORKERS,dest='extract_workers',
+        help='Number of ZIP archives to extract at the same time.')
+    ap.add_argument('--discard-archives',action='store_true',dest='discard_archives',
+        help='Extract downloaded ZIP archives without storing the archives themselves.')
+    ap.add_argument('-b','--bucket',action='append',dest='bucket',
         choices=['prod-esf-dmp-published', 'esftp-dmp-prod-curated','esftp-dmp-prod-analyzed'],
-        help=f'The names of the cloud storage locations to synchronize.')
+        help=f'The names of the cloud storage locations to synchronize. With --config, the locations to search for datafiles (by default, {DATAFILE_BUCKET}).')
+    ap.add_argument('-c','--config',action='append',dest='config',
+        help='Copy only the newest datafile matching the datafile pattern of each named APR configuration file, to the folder the pattern names.')
+    ap.add_argument('--priority',choices=PRIORITIES,default='smallest',
+        help='With --config, copy the smallest or the most recently changed datafiles first.')
+    ap.add_argument('-g','--generate',action='store_true',
+        help='With --config, generate the APRs for each configuration as soon as its datafile is copied, or right away if it is already the latest.')
     ap.add_argument('-p','--profile',dest='profile',default=os.getenv('AWS_PROFILE', DEFAULT_PROFILE),
         help='Profile name to use for cloud storage access.')
     ap.add_argument('-r','--region',dest='region',default=os.getenv('AWS_DEFAULT_REGION', DEFAULT_REGION),
@@ -34,59 +275,74 @@ if __name__ == '__main__':
         default=os.getenv('AWS_ACCESS_KEY_ID'))
     ap.add_argument('-s','--secret',dest='secret',help='Secret access key for cloud storage access.',
         default=os.getenv('AWS_SECRET_ACCESS_KEY'))
+    ap.add_argument('-e','--endpoint-url',dest='endpoint_url',default=os.getenv('AWS_ENDPOINT_URL'),
+        help='Endpoint URL of an S3-compatible service to use instead of AWS, such as a local test server.')
+    ap.add_argument('-n','--noverify',action='store_false',dest='verify',default=None,
+        help='Turn off SSL certificate validation.')
+    ap.add_argument('-w','--workers',type=int,default=DEFAULT_WORKERS,
+        help='Number of objects to download at the same time.')
+    ap.add_argument('--multipart-threshold',type=int,default=64,
+        help='Size in MB at which objects are downloaded in multiple parts.')
+    ap.add_argument('--multipart-chunksize',type=int,default=16,
+        help='Size in MB of each part of a multipart download.')
+    ap.add_argument('--max-concurrency',type=int,default=4,
+        help='Number of parts of a single object to download at the same time.')
+    ap.add_argument('-m','--manifest',
+        help=f'File recording the objects copied, used to copy only objects whose ETag changed. Defaults to {MANIFEST_NAME} in the output directory.')
+    ap.add_argument('--no-manifest',action='store_true',dest='no_manifest',
+        help='Compare local file timestamps instead of keeping a manifest.')
+    ap.add_argument('--rescan',action='store_true',
+        help='Ignore the recorded objects, compare local file timestamps, and rebuild the manifest.')
     args = ap.parse_args()
+    if not args.bucket and not args.config:
+        ap.error('at least one --bucket or --config is required')
 
     logging.basicConfig(level=os.environ.get("LOGLEVEL",logging.ERROR))
 
-    try:    
-        session = boto3.Session(profile_name=args.profile,
-                                region_name=args.region,
-                                aws_access_key_id=args.key,
-                                aws_secret_access_key=args.secret)
-        s3 = session.resource('s3')
+    workers = max(args.workers, 1)
+    transfer_config = TransferConfig(multipart_threshold=args.multipart_threshold * MB,
+                                     multipart_chunksize=args.multipart_chunksize * MB,
+                                     max_concurrency=max(args.max_concurrency, 1))
+    try:
+        # Allow enough pooled connections for every part of every concurrent download.
+        client = get_client(profile=args.profile, region=args.region, key=args.key, secret=args.secret,
+                            endpoint_url=args.endpoint_url, verify=args.verify,
+                            max_pool_connections=workers * transfer_config.max_request_concurrency)
     except Exception as e:
         logging.error('Error creating cloud session.',exc_info=e)
         exit()
 
-    for bucket in args.bucket:
+    manifest = None
+    if not args.no_manifest:
         try:
-            logging.info(f'Synchronizing {bucket}')
-            startTime = time.time()
-            bucket = s3.Bucket(bucket)
-            filesCopied = 0
-            for bucketObject in bucket.objects.all():
-                if bucketObject.key[-1] == '/':
-                    # This object is just a folder designator, so skip it.
-                    continue
-                filepath = pathlib.Path(f'{args.output}/{bucketObject.key}').resolve(strict=False)
-                foldername = filepath.parent
-                logging.info(f'Checking timestamp on {filepath}')
-                download = False
-                try:
-                    fstat = os.stat(filepath)
-                    if datetime.datetime.fromtimestamp(fstat.st_mtime, tz=datetime.timezone.utc) < bucketObject.last_modified:
-                        download = True
-                except os.error:
-                    # The file must not exist, so download it.
-                    download = True
-                if download:
-                    # Create a corresponding directory locally for the object, if needed.
-                    if not foldername.exists():
-                        foldername.mkdir(parents = True, exist_ok = True)
-                    # Download the object as a local file.
-                    s3.Object(bucketObject.bucket_name, bucketObject.key).download_file(str(filepath))
-                    filesCopied += 1
-                    logging.info(f'Copied file {filepath}')
-                if download or args.unzip:
-                    # Extract files from ZIP archives
-                    if filepath.suffix.lower() == ".zip":
-                        logging.info('Extracting ZIP archive contents.')
-                        try:
-                            with zipfile.ZipFile(filepath, 'r') as zf:
-                                zf.extractall(path=foldername)
-                        except Exception as e:
-                            logging.error(e)
-
-            logging.info(f'\nTook {(time.time() - startTime):.1f} seconds to copy {filesCopied} files')
+            manifest = SyncManifest(args.manifest or pathlib.Path(args.output) / MANIFEST_NAME)
         except Exception as e:
-            logging.error('Error synchronizing bucket.', exc_info=e)
+            logging.error('Error opening sync manifest.', exc_info=e)
+            exit()
+
+    try:
+        if args.config:
+            try:
+                targets = find_config_datafiles(client, args.config, args.bucket or [DATAFILE_BUCKET])
+                stats = sync_configs(client, targets, workers=workers, transfer_config=transfer_config,
+                                     manifest=manifest, priority=args.priority, generate=args.generate,
+                                     rescan=args.rescan)
+                print(f"Copied {stats['files']} of {len(targets)} datafiles ({stats['bytes'] / MB:.1f} MB) "
+                      f"in {stats['seconds']:.1f} seconds.")
+            except Exception as e:
+                logging.error('Error synchronizing configuration datafiles.', exc_info=e)
+        else:
+            for bucket in args.bucket:
+                try:
+                    stats = sync_bucket(client, bucket, args.output, unzip=args.unzip, workers=workers,
+                                        transfer_config=transfer_config, manifest=manifest, rescan=args.rescan,
+                                        extract_workers=args.extract_workers, discard_archives=args.discard_archives)
+                    throughput = stats['bytes'] / MB / stats['seconds'] if stats['seconds'] > 0 else 0.0
+                    print(f"Copied {stats['files']} files ({stats['bytes'] / MB:.1f} MB) from {bucket} "
+                          f"in {stats['seconds']:.1f} seconds ({throughput:.1f} MB/s), "
+                          f"extracting {stats['members']} archive members.")
+                except Exception as e:
+                    logging.error('Error synchronizing bucket.', exc_info=e)
+    finally:
+        if manifest is not None:
+            manifest.close()
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Keith.Tucker
+
+Python command-line script for regenerating ESF APRs when new datafiles
+arrive.
+
+This program runs until interrupted, watching for new datafiles matching
+the datafile patterns of one or more APR configuration files. Cloud
+storage is polled by listing only the keys after the last key seen under
+the literal prefix of each pattern (the StartAfter watermark), which is
+cheap because reopen datafiles are named with increasing dates. A full
+listing is made periodically to catch replaced objects. New matching
+objects are copied to the folder named by the pattern. The local data
+folders are also watched, using the watchdog package if it is installed,
+or by checking file modification times at each poll otherwise.
+
+When a configuration's datafile changes, its APRs are regenerated with
+generate_esf_apr.py once no further changes have arrived for the
+debounce interval. Each configuration is regenerated one run at a time;
+changes arriving during a run cause one more run after it finishes.
+
+Parameters for the session and service connection can be obtained from
+the environment variables listed below.
+
+     AWS_ACCESS_KEY_ID
+     AWS_SECRET_ACCESS_KEY
+     AWS_PROFILE
+     AWS_DEFAULT_REGION
+     AWS_ENDPOINT_URL
+"""
+
+import argparse
+import fnmatch
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+from esf_s3_datafile import glob_prefix, is_s3_uri
+from s3client import DEFAULT_PROFILE, DEFAULT_REGION, get_client
+from s3download import download_object
+from s3syncmanifest import MANIFEST_NAME, SyncManifest, local_copy_current
+from syncS3Files import DATAFILE_BUCKET, launch_generation
+
+DEFAULT_INTERVAL = 60
+DEFAULT_DEBOUNCE = 30
+DEFAULT_FULL_SCAN_EVERY = 60
+TICK = 1.0
+
+class DatafileWatcher:
+    def __init__(self, client, config_names, bucket_names, manifest: SyncManifest = None,
+                 debounce: float = DEFAULT_DEBOUNCE, encoding: str = 'utf-8'):
+        self.client = client
+        self.bucket_names = bucket_names
+        self.manifest = manifest
+        self.debounce = debounce
+        # The local datafile pattern of each configuration.
+        self.patterns = {}
+        for config_name in config_names:
+            with open(config_name, 'r', encoding=encoding) as cfp:
+                pattern = json.load(cfp)['datafile_pattern']
+            if is_s3_uri(pattern):
+                logging.warning(f'{config_name} reads its datafile directly from {pattern}, so it is not watched.')
+                continue
+            self.patterns[config_name] = pathlib.Path(pattern)
+        # The configurations watching each bucket prefix, and the last key seen under it.
+        self.prefixes = {}
+        for config_name, pattern in self.patterns.items():
+            for bucket_name in bucket_names:
+                self.prefixes.setdefault((bucket_name, glob_prefix(pattern.name)), []).append(config_name)
+        self.watermarks = {}
+        self.latest = {}
+        self.local_mtimes = None
+        # Configurations waiting to be regenerated, with the time at which to start, and
+        # the regeneration running for each configuration.
+        self.pending = {}
+        self.running = {}
+        self._lock = threading.Lock()
+
+    def schedule(self, config_name: str) -> None:
+        """Regenerate a configuration once no further changes arrive for the debounce interval."""
+        with self._lock:
+            self.pending[config_name] = time.monotonic() + self.debounce
+
+    def poll_bucket(self, full: bool = False) -> int:
+        """List the new keys under each watched prefix, copying new datafiles.
+        Returns the number of datafiles copied."""
+        copied = 0
+        for (bucket_name, prefix), config_names in self.prefixes.items():
+            kwargs = {'Bucket': bucket_name, 'Prefix': prefix}
+            watermark = self.watermarks.get((bucket_name, prefix))
+            if watermark is not None and not full:
+                kwargs['StartAfter'] = watermark
+            for page in self.client.get_paginator('list_objects_v2').paginate(**kwargs):
+                for obj in page.get('Contents', ()):
+                    if watermark is None or obj['Key'] > watermark:
+                        self.watermarks[(bucket_name, prefix)] = watermark = obj['Key']
+                    for config_name in config_names:
+                        if not fnmatch.fnmatchcase(obj['Key'], self.patterns[config_name].name):
+                            continue
+                        latest = self.latest.get(config_name)
+                        if latest is None or obj['LastModified'] > latest[1]['LastModified'] or (
+                                obj['Key'] == latest[1]['Key'] and obj['ETag'] != latest[1]['ETag']):
+                            self.latest[config_name] = (bucket_name, obj)
+            for config_name in config_names:
+                if config_name in self.latest and self.fetch(config_name):
+                    copied += 1
+        return copied
+
+    def fetch(self, config_name: str) -> bool:
+        """Copy the newest datafile for a configuration, if it is not already copied."""
+        bucket_name, obj = self.latest[config_name]
+        filepath = (self.patterns[config_name].parent / pathlib.PurePosixPath(obj['Key']).name).resolve(strict=False)
+        entry = self.manifest.get(bucket_name, obj['Key']) if self.manifest is not None else None
+        if entry is not None:
+            if entry['etag'] == obj['ETag'] and filepath.exists():
+                return False
+        elif local_copy_current(filepath, obj['Size'], obj['LastModified']):
+            return False
+        try:
+            download_object(self.client, bucket_name, obj['Key'], filepath)
+        except Exception as e:
+            logging.error(f"Error copying object {obj['Key']}.", exc_info=e)
+            return False
+        print(f'Copied file {filepath}')
+        if self.manifest is not None:
+            self.manifest.record(bucket_name, obj['Key'], obj['ETag'], obj['Size'], obj['LastModified'], filepath)
+            self.manifest.commit()
+        self.local_changed(filepath)
+        return True
+
+    def local_changed(self, path) -> None:
+        """Schedule the configurations whose datafile pattern matches a changed local file."""
+        path = pathlib.Path(path).resolve(strict=False)
+        for config_name, pattern in self.patterns.items():
+            if pattern.parent.resolve(strict=False) == path.parent and fnmatch.fnmatch(path.name, pattern.name):
+                logging.info(f'Datafile {path} changed.')
+                self.schedule(config_name)
+
+    def poll_local(self) -> None:
+        """Check the modification times of the local datafiles, for use without watchdog.
+        The first check only records the files present."""
+        first = self.local_mtimes is None
+        mtimes = {}
+        for pattern in self.patterns.values():
+            for path in pattern.parent.glob(pattern.name):
+                mtimes[path] = path.stat().st_mtime
+                if not first and self.local_mtimes.get(path) != mtimes[path]:
+                    self.local_changed(path)
+        self.local_mtimes = mtimes
+
+    def watch_local(self):
+        """Watch the local data folders with watchdog. Returns the observer, or None if
+        watchdog is not installed."""
+        if Observer is None:
+            return None
+        watcher = self
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if not event.is_directory and event.event_type in ('created', 'modified', 'moved'):
+                    watcher.local_changed(getattr(event, 'dest_path', None) or event.src_path)
+        observer = Observer()
+        for folder in {pattern.parent.resolve(strict=False) for pattern in self.patterns.values()}:
+            folder.mkdir(parents=True, exist_ok=True)
+            observer.schedule(Handler(), str(folder), recursive=False)
+        observer.start()
+        return observer
+
+    def run_pending(self) -> None:
+        """Start the regenerations whose debounce interval has passed, one at a time per configuration."""
+        for config_name, process in list(self.running.items()):
+            if process.poll() is not None:
+                del self.running[config_name]
+                if process.returncode != 0:
+                    logging.error(f'Generating APRs for {config_name} failed with exit status {process.returncode}.')
+        now = time.monotonic()
+        with self._lock:
+            ready = [name for name, due in self.pending.items() if due <= now and name not in self.running]
+            for config_name in ready:
+                del self.pending[config_name]
+        for config_name in ready:
+            self.running[config_name] = launch_generation(config_name)
+
+    def idle(self) -> bool:
+        with self._lock:
+            return not self.pending and not self.running
+
+    def run(self, interval: float = DEFAULT_INTERVAL, full_scan_every: int = DEFAULT_FULL_SCAN_EVERY,
+            once: bool = False) -> None:
+        """Poll and regenerate until interrupted, or, with once set, until the
+        regenerations for a single poll have finished."""
+        observer = self.watch_local() if not once else None
+        if observer is None and not once:
+            logging.info('The watchdog package is not installed, so local datafiles are checked at each poll.')
+        polls = 0
+        next_poll = time.monotonic()
+        try:
+            while True:
+                if time.monotonic() >= next_poll and not (once and polls):
+                    try:
+                        self.poll_bucket(full=polls % max(full_scan_every, 1) == 0)
+                    except Exception as e:
+                        logging.error('Error polling cloud storage.', exc_info=e)
+                    if observer is None:
+                        self.poll_local()
+                    polls += 1
+                    next_poll = time.monotonic() + interval
+                self.run_pending()
+                if once and self.idle():
+                    break
+                time.sleep(TICK)
+        except KeyboardInterrupt:
+            print('Stopping; waiting for running regenerations to finish.')
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+            for process in self.running.values():
+                process.wait()
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=os.environ.get("LOGLEVEL",logging.ERROR))
+
+    ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Watch for new datafiles matching the datafile patterns of APR configuration files,
+copying them from cloud storage and regenerating the APRs of the affected configurations.
+''',
+        epilog='''The program uses defaults for cloud storage access, which can be overridden with the following environment variables:
+  AWS_ACCESS_KEY_ID: The identifier for authenticating access to cloud storage
+  AWS_SECRET_ACCESS_KEY: The associated access key for authenticating access to cloud storage
+  AWS_PROFILE: The name of the cloud storage location
+  AWS_DEFAULT_REGION: The name of the associated Cloud Service Provider region in which the cloud storage is located
+''')
+    ap.add_argument('config', nargs='+', help='Names of the configuration files whose datafiles to watch.')
+    ap.add_argument('-b','--bucket',action='append',dest='bucket',
+        choices=['prod-esf-dmp-published', 'esftp-dmp-prod-curated','esftp-dmp-prod-analyzed'],
+        help=f'The names of the cloud storage locations to watch (by default, {DATAFILE_BUCKET}).')
+    ap.add_argument('-i','--interval',type=float,default=DEFAULT_INTERVAL,
+        help='Number of seconds between polls of cloud storage.')
+    ap.add_argument('-d','--debounce',type=float,default=DEFAULT_DEBOUNCE,
+        help='Number of seconds without further changes to wait before regenerating a configuration.')
+    ap.add_argument('--full-scan-every',type=int,default=DEFAULT_FULL_SCAN_EVERY,
+        help='Make a full listing of the watched prefixes every this many polls, to catch replaced objects.')
+    ap.add_argument('--once',action='store_true',
+        help='Poll once, regenerate the configurations whose datafiles changed, and exit.')
+    ap.add_argument('-m','--manifest',default=MANIFEST_NAME,
+        help='File recording the datafiles copied, used to copy only datafiles whose ETag changed.')
+    ap.add_argument('-p','--profile',dest='profile',default=os.getenv('AWS_PROFILE', DEFAULT_PROFILE),
+        help='Profile name to use for cloud storage access.')
+    ap.add_argument('-r','--region',dest='region',default=os.getenv('AWS_DEFAULT_REGION', DEFAULT_REGION),
+        help='Region name to use for cloud storage access.')
+    ap.add_argument('-k','--key',help='Access key for cloud storage access.',dest='key',
+        default=os.getenv('AWS_ACCESS_KEY_ID'))
+    ap.add_argument('-s','--secret',dest='secret',help='Secret access key for cloud storage access.',
+        default=os.getenv('AWS_SECRET_ACCESS_KEY'))
+    ap.add_argument('-e','--endpoint-url',dest='endpoint_url',default=os.getenv('AWS_ENDPOINT_URL'),
+        help='Endpoint URL of an S3-compatible service to use instead of AWS, such as a local test server.')
+    ap.add_argument('-n','--noverify',action='store_false',dest='verify',default=None,
+        help='Turn off SSL certificate validation.')
+    args = ap.parse_args()
+
+    try:
+        client = get_client(profile=args.profile, region=args.region, key=args.key, secret=args.secret,
+                            endpoint_url=args.endpoint_url, verify=args.verify)
+    except Exception as e:
+        logging.error('Error creating cloud session.',exc_info=e)
+        exit()
+
+    with SyncManifest(args.manifest) as manifest:
+        watcher = DatafileWatcher(client, args.config, args.bucket or [DATAFILE_BUCKET], manifest=manifest,
+                                  debounce=0 if args.once else args.debounce)
+        watcher.run(interval=args.interval, full_scan_every=args.full_scan_every, once=args.once)